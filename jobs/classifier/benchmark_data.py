@@ -0,0 +1,131 @@
+import json
+import threading
+import time
+from typing import List
+
+import click
+import numpy as np
+import pandas as pd
+
+from emotion_classifier.data import SHARDING_STRATEGIES, FetchStats, get_batch_iterator
+from emotion_classifier.utils import init_logger
+
+logger = init_logger(__name__)
+
+
+class SyntheticResultBatch:
+    """
+    Stands in for an ArrowResultBatch, `to_pandas` sleeps like a download of the batch
+    """
+
+    def __init__(self, batch_id: int, first_id: int, rowcount: int, fetch_sec: float):
+        self.id = batch_id
+        self.rowcount = rowcount
+        # ID and TEXT of every row as pandas columns, known before the download like in ArrowResultBatch
+        self.uncompressed_size = rowcount * 64
+        self._first_id = first_id
+        self._fetch_sec = fetch_sec
+        self.fetches = 0
+        self._lock = threading.Lock()
+
+    def to_pandas(self) -> pd.DataFrame:
+        with self._lock:
+            self.fetches += 1
+        time.sleep(self._fetch_sec)
+        ids = np.arange(self._first_id, self._first_id + self.rowcount)
+        return pd.DataFrame({"ID": ids, "TEXT": ids.astype(str)})
+
+
+def _create_batches(
+    num_batches: int, min_rows: int, max_rows: int, fetch_ms: float, seed: int
+) -> List[SyntheticResultBatch]:
+    rng = np.random.default_rng(seed)
+    batches, first_id = [], 0
+    for i, rowcount in enumerate(rng.integers(min_rows, max_rows + 1, num_batches)):
+        batches.append(
+            SyntheticResultBatch(i, first_id, int(rowcount), fetch_ms / 1000)
+        )
+        first_id += int(rowcount)
+    return batches
+
+
+@click.command()
+@click.option("--result-batches", default=200, help="Number of result batches")
+@click.option("--min-rows", default=500, help="Min rows per result batch")
+@click.option("--max-rows", default=5000, help="Max rows per result batch")
+@click.option("--fetch-ms", default=20.0, help="Download time of a result batch")
+@click.option("--world-size", default=4, help="Number of workers")
+@click.option("--batch-size", default=512, help="Rows per model batch")
+@click.option("--fetch-threads", default=4, help="Parallel downloads")
+@click.option(
+    "--prefetch-mb", default=256, help="Max MiB of result batches downloaded ahead"
+)
+@click.option("--process-ms", default=5.0, help="Model time per model batch")
+def main(
+    result_batches: int,
+    min_rows: int,
+    max_rows: int,
+    fetch_ms: float,
+    world_size: int,
+    batch_size: int,
+    fetch_threads: int,
+    prefetch_mb: int,
+    process_ms: float,
+):
+    """
+    Compares the sharding strategies on synthetic result batches: time to iterate all model batches of rank 0,
+    result batches fetched per rank and whether the ranks cover every row exactly once
+    """
+    results = []
+    for strategy in SHARDING_STRATEGIES:
+        for threads in sorted({1, fetch_threads}):
+            batches = _create_batches(result_batches, min_rows, max_rows, fetch_ms, 0)
+            total_rows = sum(batch.rowcount for batch in batches)
+            seen_ids, fetches, rank0_sec, rank0_stats = [], [], 0.0, FetchStats()
+            for rank in range(world_size):
+                for batch in batches:
+                    batch.fetches = 0
+                start_time = time.perf_counter()
+                stats = FetchStats()
+                for _, df in get_batch_iterator(
+                    batches,
+                    rank,
+                    world_size,
+                    batch_size,
+                    strategy,
+                    threads,
+                    prefetch_mb * 2**20,
+                    stats,
+                ):
+                    seen_ids.append(df["ID"].to_numpy())
+                    # the model runs while the next result batches are downloaded
+                    time.sleep(process_ms / 1000)
+                if rank == 0:
+                    rank0_sec, rank0_stats = time.perf_counter() - start_time, stats
+                fetches.append(sum(batch.fetches for batch in batches))
+            seen_ids = np.sort(np.concatenate(seen_ids))
+            result = {
+                "strategy": strategy,
+                "fetch_threads": threads,
+                "rank0_sec": rank0_sec,
+                "rank0_fetch_wait_sec": rank0_stats.fetch_wait_sec,
+                "fetched_batches_per_rank": fetches,
+                "exactly_once": bool(np.array_equal(seen_ids, np.arange(total_rows))),
+            }
+            logger.info(f"{result}")
+            results.append(result)
+    print(
+        json.dumps(
+            {
+                "result_batches": result_batches,
+                "world_size": world_size,
+                "batch_size": batch_size,
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,98 @@
+import json
 import os
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 
+import numpy as np
 import torch
-from transformers import pipeline, AutoModelForSequenceClassification, AutoTokenizer
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
 
+from emotion_classifier.model_cache import from_pretrained
 from emotion_classifier.utils import init_logger
 
 logger = init_logger("TextClassifier")
 
+TEXT = "text"
+IDS = "ids"
+OBJECT = "object"
+
+OUTPUT_FORMATS = [TEXT, IDS, OBJECT]
+
 
 class EmotionClassifier:
     def __init__(self, config: Dict[str, Any], batch_size: int):
         self._config = config
-        self._classifier_pipeline = self._create_classifier_pipeline(
-            _get_cuda_device(),
-            batch_size,
-            config["general"]["model_name"],
+        self._batch_size = batch_size
+        self._top_k = config["general"].get("top_k", 2)
+        self.output_format = config["general"].get("output_format", TEXT)
+        if self.output_format not in OUTPUT_FORMATS:
+            raise ValueError(
+                f"Unknown output format: {self.output_format}, supported: {OUTPUT_FORMATS}"
+            )
+        self._device = torch.device(
+            f"cuda:{_get_cuda_device()}" if torch.cuda.is_available() else "cpu"
         )
+        self._model, self._tokenizer = self._create_model(
+            self._device, config["general"]["model_name"]
+        )
+        self.labels = [
+            self._model.config.id2label[i] for i in range(self._model.config.num_labels)
+        ]
 
     def classify(self, input_texts: List[str]) -> List[str]:
-        classifier_outputs = self._classifier_pipeline(input_texts)
-        max_scores_outputs = []
-        for output_list in classifier_outputs:
-            max_scores_outputs.append(str(output_list))
-        return max_scores_outputs
-
-    def _create_classifier_pipeline(
-        self, device: int, batch_size: int, model_name: str
-    ):
+        """
+        Classifies the texts
+        :return: top k labels and scores of every text, as text or as json of {label: score} for the object format
+        """
+        label_ids, scores = self.classify_top_k(input_texts)
+        if self.output_format == OBJECT:
+            return [
+                json.dumps(dict(zip([self.labels[i] for i in row_ids], row_scores)))
+                for row_ids, row_scores in zip(label_ids.tolist(), scores.tolist())
+            ]
+        return [
+            str(
+                [
+                    {"label": self.labels[i], "score": score}
+                    for i, score in zip(row_ids, row_scores)
+                ]
+            )
+            for row_ids, row_scores in zip(label_ids.tolist(), scores.tolist())
+        ]
+
+    def classify_top_k(self, input_texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Runs the model on the texts in batches, softmax and top k are computed on the device,
+        only the top k label ids and scores are copied to the host
+        :return: int32 [len(texts), k] label ids, highest score first, and float32 [len(texts), k] scores,
+            label names are in `labels`
+        """
+        top_k = min(self._top_k, len(self.labels))
+        label_ids = np.empty((len(input_texts), top_k), dtype=np.int32)
+        scores = np.empty((len(input_texts), top_k), dtype=np.float32)
+        for start in range(0, len(input_texts), self._batch_size):
+            end = start + self._batch_size
+            inputs = self._tokenizer(
+                input_texts[start:end],
+                padding=True,
+                truncation=True,
+                return_tensors="pt",
+            ).to(self._device)
+            with torch.inference_mode():
+                logits = self._model(**inputs).logits.float()
+                batch_scores, batch_ids = torch.topk(
+                    torch.softmax(logits, dim=-1), top_k, dim=-1
+                )
+            label_ids[start:end] = batch_ids.cpu().numpy()
+            scores[start:end] = batch_scores.cpu().numpy()
+        return label_ids, scores
+
+    def _create_model(self, device: torch.device, model_name: str):
         num_gpus = torch.cuda.device_count()
-        logger.info(f"Creating classifier pipeline, available gpus: {num_gpus}")
-
-        model = AutoModelForSequenceClassification.from_pretrained(model_name)
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
-
-        classifier = pipeline(
-            "text-classification",
-            model=model,
-            tokenizer=tokenizer,
-            top_k=2,
-            device=torch.device(
-                f"cuda:{device}" if torch.cuda.is_available() else "cpu"
-            ),
-            batch_size=batch_size,
-        )
-        return classifier
+        logger.info(f"Creating classifier model, available gpus: {num_gpus}")
+
+        model = from_pretrained(AutoModelForSequenceClassification, model_name)
+        tokenizer = from_pretrained(AutoTokenizer, model_name)
+        return model.eval().to(device), tokenizer
 
 
 def _get_cuda_device() -> int:
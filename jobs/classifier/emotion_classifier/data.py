@@ -1,4 +1,21 @@
-from typing import List, Generator
+import bisect
+import json
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from itertools import accumulate
+from typing import (
+    AbstractSet,
+    Dict,
+    List,
+    Generator,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import numpy as np
 
 from snowflake.connector.result_batch import ArrowResultBatch
 
@@ -9,10 +26,151 @@ import pandas as pd
 
 logger = init_logger("DataIterator")
 
+STRIDED = "strided"
+CONTIGUOUS = "contiguous"
+
+SHARDING_STRATEGIES = [STRIDED, CONTIGUOUS]
+
+NO_DEDUP = "none"
+BATCH_DEDUP = "batch"
+SQL_DEDUP = "sql"
+
+DEDUP_MODES = [NO_DEDUP, BATCH_DEDUP, SQL_DEDUP]
+
+_FETCH_THREADS = 4
+_PREFETCH_BYTES = 256 * 2**20
+
+
+@dataclass
+class FetchStats:
+    """
+    Statistics of the result batch downloads, fetch_wait_sec is the time the caller waited for a download
+    """
+
+    fetched_batches: int = 0
+    fetched_bytes: int = 0
+    fetch_wait_sec: float = 0.0
+
+
+@dataclass
+class DedupStats:
+    """
+    Input rows and distinct texts classified for them, ratio is the number of rows per classified text
+    """
+
+    input_rows: int = 0
+    unique_texts: int = 0
+
+    @property
+    def ratio(self) -> float:
+        return self.input_rows / self.unique_texts if self.unique_texts else 1.0
+
+
+class ResultBatchPrefetcher:
+    """
+    Downloads and converts result batches to pandas on a thread pool, in the given order, ahead of the caller.
+    The downloads ahead are bounded by bytes rather than by count: a batch is submitted while the uncompressed
+    bytes of the batches in flight and of the ones the caller holds stay under `max_bytes`, the first one always.
+    """
+
+    def __init__(
+        self,
+        batches: List[ArrowResultBatch],
+        fetch_order: List[int],
+        num_threads: int = _FETCH_THREADS,
+        max_bytes: int = _PREFETCH_BYTES,
+        stats: Optional[FetchStats] = None,
+    ):
+        self._batches = batches
+        self._fetch_order = fetch_order
+        self._next_fetch = 0
+        self._max_bytes = max_bytes
+        self._used_bytes = 0
+        self._futures: Dict[int, Future] = {}
+        self._dataframes: Dict[int, DataFrame] = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=num_threads, thread_name_prefix="fetch"
+        )
+        self.stats = stats if stats is not None else FetchStats()
+
+    def __enter__(self):
+        self._submit()
+        return self
+
+    def __exit__(self, *args):
+        for future in self._futures.values():
+            future.cancel()
+        self._executor.shutdown(wait=True)
+
+    def get(self, batch_index: int) -> DataFrame:
+        """
+        Returns the batch, waits for its download if needed, the batch is kept until it is released
+        """
+        if batch_index not in self._dataframes:
+            while batch_index not in self._futures:
+                if self._next_fetch >= len(self._fetch_order):
+                    raise KeyError(
+                        f"Result batch {batch_index} is not in the fetch order"
+                    )
+                # the caller is ahead of the fetch order or over the byte budget
+                self._submit(force=True)
+            start_time = time.perf_counter()
+            self._dataframes[batch_index] = self._futures.pop(batch_index).result()
+            self.stats.fetch_wait_sec += time.perf_counter() - start_time
+            self.stats.fetched_batches += 1
+        return self._dataframes[batch_index]
+
+    def release(self, batch_index: int):
+        """
+        Frees the batch and its share of the byte budget, so the next batches can be downloaded
+        """
+        self._dataframes.pop(batch_index, None)
+        self._used_bytes -= self._get_size(batch_index)
+        self._submit()
+
+    def _submit(self, force: bool = False):
+        while self._next_fetch < len(self._fetch_order):
+            batch_index = self._fetch_order[self._next_fetch]
+            size = self._get_size(batch_index)
+            in_use = self._futures or self._dataframes
+            if in_use and not force and self._used_bytes + size > self._max_bytes:
+                return
+            self._futures[batch_index] = self._executor.submit(
+                self._batches[batch_index].to_pandas
+            )
+            self._used_bytes += size
+            self.stats.fetched_bytes += size
+            self._next_fetch += 1
+            force = False
+
+    def _get_size(self, batch_index: int) -> int:
+        batch = self._batches[batch_index]
+        # the size is known before the download, falls back to a row estimate without it
+        return getattr(batch, "uncompressed_size", None) or batch.rowcount * 1024
+
+
+class BatchSlice(NamedTuple):
+    """
+    Rows [start, end) of a single result batch
+    """
+
+    batch_index: int
+    start: int
+    end: int
+
 
 def get_batch_iterator_from_sql(
-    cursor: SnowflakeCursor, sql: str, rank: int, world_size: int, batch_size: int
-) -> Generator[DataFrame, None, None]:
+    cursor: SnowflakeCursor,
+    sql: str,
+    rank: int,
+    world_size: int,
+    batch_size: int,
+    strategy: str = STRIDED,
+    fetch_threads: int = _FETCH_THREADS,
+    prefetch_bytes: int = _PREFETCH_BYTES,
+    stats: Optional[FetchStats] = None,
+    skip_batches: AbstractSet[int] = frozenset(),
+) -> Generator[Tuple[int, DataFrame], None, None]:
     """
     Generator to yield batches of files for distributed processing.
     :param cursor: The cursor to execute the SQL query.
@@ -20,75 +178,198 @@ def get_batch_iterator_from_sql(
     :param rank: The rank of the current worker.
     :param world_size: The total number of workers.
     :param batch_size: The size of each batch.
-    :return: Generator yielding batches of files.
+    :param strategy: How the rows are split between the workers, see `get_rank_slices`.
+    :param fetch_threads: Number of result batches downloaded in parallel.
+    :param prefetch_bytes: Max uncompressed bytes of the result batches downloaded ahead.
+    :param stats: Updated with the fetch statistics while iterating.
+    :param skip_batches: Indexes of the batches to skip, their rows are not fetched.
+    :return: Generator yielding the index of every batch of the worker and its rows.
     """
     batches = cursor.execute(sql).get_result_batches()
-    return get_batch_iterator(batches, rank, world_size, batch_size)
+    return get_batch_iterator(
+        batches,
+        rank,
+        world_size,
+        batch_size,
+        strategy,
+        fetch_threads,
+        prefetch_bytes,
+        stats,
+        skip_batches,
+    )
 
 
 def get_batch_iterator(
-    bathces: List[ArrowResultBatch], rank: int, world_size: int, batch_size: int
-) -> Generator[DataFrame, None, None]:
+    batches: List[ArrowResultBatch],
+    rank: int,
+    world_size: int,
+    batch_size: int,
+    strategy: str = STRIDED,
+    fetch_threads: int = _FETCH_THREADS,
+    prefetch_bytes: int = _PREFETCH_BYTES,
+    stats: Optional[FetchStats] = None,
+    skip_batches: AbstractSet[int] = frozenset(),
+) -> Generator[Tuple[int, DataFrame], None, None]:
     """
     Generator to yield batches of files for distributed processing.
+    Only the result batches that hold rows of this worker are downloaded and converted to pandas,
+    the next ones are prefetched while the current one is being processed, see `ResultBatchPrefetcher`.
+    :param batches: Result batches of the query.
+    :param rank: The rank of the current worker.
+    :param world_size: The total number of workers.
+    :param batch_size: The size of each batch.
+    :param strategy: How the rows are split between the workers, see `get_rank_slices`.
+    :param fetch_threads: Number of result batches downloaded in parallel.
+    :param prefetch_bytes: Max uncompressed bytes of the result batches downloaded ahead.
+    :param stats: Updated with the fetch statistics while iterating.
+    :param skip_batches: Indexes of the batches to skip, their rows are not fetched.
+    :return: Generator yielding the index of every batch of the worker and its rows.
+    """
+    rank_slices = get_rank_slices(
+        [batch.rowcount for batch in batches], rank, world_size, batch_size, strategy
+    )
+    todo = [
+        (i, slices) for i, slices in enumerate(rank_slices) if i not in skip_batches
+    ]
+    # result batches in the order of first use, each one is fetched once
+    fetch_order = list(
+        dict.fromkeys(s.batch_index for _, slices in todo for s in slices)
+    )
+    logger.info(
+        f"Rows split by {strategy}, model batches: {len(rank_slices)}, skipped: {len(rank_slices) - len(todo)}, "
+        f"result batches to fetch: {len(fetch_order)}/{len(batches)}"
+    )
+    last_use = {}
+    for i, slices in todo:
+        for s in slices:
+            last_use[s.batch_index] = i
+
+    with ResultBatchPrefetcher(
+        batches, fetch_order, fetch_threads, prefetch_bytes, stats
+    ) as prefetcher:
+        for i, slices in todo:
+            parts = []
+            for s in slices:
+                parts.append(prefetcher.get(s.batch_index).iloc[s.start : s.end])
+                if last_use[s.batch_index] == i:
+                    prefetcher.release(s.batch_index)
+            yield i, parts[0] if len(parts) == 1 else pd.concat(parts)
+    logger.info(f"Fetched result batches: {prefetcher.stats}")
+
+
+def get_rank_slices(
+    row_counts: Sequence[int],
+    rank: int,
+    world_size: int,
+    batch_size: int,
+    strategy: str = STRIDED,
+) -> List[List[BatchSlice]]:
+    """
+    Computes the rows of every model batch of the worker from the row counts of the result batches,
+    without fetching any of them.
+    :param row_counts: Row counts of the result batches.
     :param rank: The rank of the current worker.
     :param world_size: The total number of workers.
     :param batch_size: The size of each batch.
-    :param files: List of files to be processed.
-    :return: Generator yielding batches of files.
-    """
-    total_records = 0
-    for batch in bathces:
-        total_records += batch.rowcount
-    batch_iter = iter(bathces)
-    try:
-        next_batch = next(batch_iter)
-    except StopIteration:
-        return
-    curr_data_rows = 0
-    cached_dataframe_id = None
-    cached_pd_dataframe = None
-    # Loop through the batches, skipping the ones that are not for this worker
-    for idx in range(rank * batch_size, total_records, world_size * batch_size):
-        # Calculate the first and last row of the batch
-        first_row, last_row = idx, idx + batch_size - 1
-        try:
-            while True:
-                # Skip the batch if it is not for this worker
-                if curr_data_rows + next_batch.rowcount > first_row:
-                    break
-                curr_data_rows += next_batch.rowcount
-                next_batch = next(batch_iter)
-            # Load the batch if it is for this worker
-            if cached_dataframe_id is None or cached_dataframe_id != next_batch.id:
-                pd_batch = next_batch.to_pandas()
-                cached_dataframe_id = next_batch.id
-                cached_pd_dataframe = pd_batch
-            else:
-                pd_batch = cached_pd_dataframe
-
-            # Check if the batch is within the current batch
-            if last_row < curr_data_rows + next_batch.rowcount:
-                # Calculate the start and end row of the batch
-                start_row = first_row - curr_data_rows
-                end_row = last_row - curr_data_rows
-                yield pd_batch.iloc[start_row : end_row + 1]
-
-            else:
-                # The batch spans multiple dataframes, so we need to merge them
-                start_row = first_row - curr_data_rows
-                output = pd_batch.iloc[start_row : next_batch.rowcount]
-                try:
-                    while last_row >= curr_data_rows + next_batch.rowcount:
-                        curr_data_rows += next_batch.rowcount
-                        next_batch = next(batch_iter)
-                        # Get the data from the batch and add it to the output
-                        leftover_data = next_batch.to_pandas().iloc[
-                            0 : last_row - curr_data_rows + 1
-                        ]
-                        output = pd.concat([output, leftover_data])
-                except StopIteration:
-                    pass  # Iterator is exhausted, stop iteration
-                yield output
-        except StopIteration:
-            pass  # Iterator is exhausted, stop iteration
+    :param strategy:
+        * strided - model batches are dealt to the workers in turn, batch i goes to worker i % world_size
+        * contiguous - every worker gets one contiguous block of rows, so it fetches the fewest result batches
+    :return: Slices of the result batches of every model batch of the worker, in order.
+    """
+    # offsets[i] is the first row of result batch i, a row is found by binary search
+    offsets = [0, *accumulate(row_counts)]
+    total_records = offsets[-1]
+    if strategy == STRIDED:
+        ranges = [
+            (first_row, min(first_row + batch_size, total_records))
+            for first_row in range(
+                rank * batch_size, total_records, world_size * batch_size
+            )
+        ]
+    elif strategy == CONTIGUOUS:
+        block_start = rank * total_records // world_size
+        block_end = (rank + 1) * total_records // world_size
+        ranges = [
+            (first_row, min(first_row + batch_size, block_end))
+            for first_row in range(block_start, block_end, batch_size)
+        ]
+    else:
+        raise ValueError(
+            f"Unknown sharding strategy: {strategy}, supported: {SHARDING_STRATEGIES}"
+        )
+    return [_get_slices(offsets, first_row, end_row) for first_row, end_row in ranges]
+
+
+def _get_slices(offsets: List[int], first_row: int, end_row: int) -> List[BatchSlice]:
+    slices = []
+    batch_index = bisect.bisect_right(offsets, first_row) - 1
+    row = first_row
+    while row < end_row:
+        batch_end = min(offsets[batch_index + 1], end_row)
+        if batch_end > row:
+            slices.append(
+                BatchSlice(
+                    batch_index,
+                    row - offsets[batch_index],
+                    batch_end - offsets[batch_index],
+                )
+            )
+        row = batch_end
+        batch_index += 1
+    return slices
+
+
+def get_distinct_text_sql(sql: str) -> str:
+    """
+    Pushes the deduplication down into the query, every distinct text is returned once with the ids of its rows,
+    see `expand_grouped_ids`. The texts are sorted, every rank runs the query and splits the rows by their position,
+    so all runs of the query must return the rows in the same order.
+    """
+    return f"SELECT TEXT, ARRAY_AGG(ID) AS IDS FROM ({sql}) GROUP BY TEXT ORDER BY TEXT"
+
+
+def expand_grouped_ids(df: DataFrame) -> DataFrame:
+    """
+    Restores a row per id from the rows of `get_distinct_text_sql`. ARRAY_AGG leaves out NULL ids, a text whose ids
+    are all NULL has an empty array, it has no rows to write and is dropped.
+    """
+    # arrays are returned by the connector as json strings
+    ids = df["IDS"].map(
+        lambda value: json.loads(value) if isinstance(value, str) else value
+    )
+    rows = df.drop(columns="IDS").assign(ID=ids).explode("ID")[["ID", "TEXT"]]
+    no_ids = rows["ID"].isna()
+    if no_ids.any():
+        logger.warning(f"Dropped {int(no_ids.sum())} texts without ids")
+        rows = rows[~no_ids]
+    return rows
+
+
+def index_texts(texts: Sequence[Optional[str]]) -> Tuple[List[str], np.ndarray]:
+    """
+    :return: the texts that are not NULL, and the index of the text of every row, -1 for the NULL texts,
+        see `fan_out`
+    """
+    is_text = pd.Series(texts, dtype=object).notna().to_numpy()
+    return list(np.asarray(texts, dtype=object)[is_text]), np.where(
+        is_text, np.cumsum(is_text) - 1, -1
+    )
+
+
+def deduplicate_texts(texts: Sequence[Optional[str]]) -> Tuple[List[str], np.ndarray]:
+    """
+    :return: the distinct texts that are not NULL, in the order of first occurrence, and the index of the distinct
+        text of every row, -1 for the NULL texts, see `fan_out`
+    """
+    inverse, unique_texts = pd.factorize(
+        pd.Series(texts, dtype=object), use_na_sentinel=True
+    )
+    return list(unique_texts), inverse
+
+
+def fan_out(outputs: Sequence, inverse: np.ndarray) -> List:
+    """
+    Copies the outputs of the texts to their rows, the rows of the index -1, the NULL texts, get a NULL output
+    """
+    values = [*outputs, None]
+    return [values[i] for i in inverse]
@@ -0,0 +1,134 @@
+from typing import NamedTuple, Set
+
+import pandas as pd
+from snowflake.connector.pandas_tools import write_pandas
+
+from emotion_classifier.utils import init_logger
+
+logger = init_logger("ProgressLedger")
+
+
+class BatchLayout(NamedTuple):
+    """
+    Settings that decide the rows of every batch index, a job can only be resumed with the same layout
+    """
+
+    world_size: int
+    batch_size: int
+    sharding: str
+    dedup: str
+
+
+class ProgressLedger:
+    """
+    Records the input batches of every rank whose outputs were written, in a side table keyed by
+    (job name, rank, batch index range). The outputs and their ledger entry are committed in one transaction,
+    so a rerun of a failed job skips exactly the batches that are in the output table.
+    Batches are identified by their index in the rows of the rank, so the query must return the rows
+    in the same order in every run, e.g. with ORDER BY ID, and the run must use the same `BatchLayout`.
+    """
+
+    def __init__(
+        self, conn, table_name: str, job_name: str, rank: int, layout: BatchLayout
+    ):
+        """
+        :param conn: Snowflake connection, the transactions of `commit` run on it.
+        :param table_name: Ledger table, created if it doesn't exist.
+        :param job_name: The job whose progress is recorded, a rerun of the job uses the same name.
+        :param rank: The rank of the current worker.
+        :param layout: Settings that decide the rows of the batches, recorded with every entry.
+        """
+        self._conn = conn
+        self._table_name = _quote(table_name)
+        self._job_name = job_name
+        self._rank = rank
+        self._layout = layout
+        self._conn.cursor().execute(
+            f"CREATE TABLE IF NOT EXISTS {self._table_name} ("
+            "JOB_NAME STRING, RANK INT, WORLD_SIZE INT, BATCH_SIZE INT, SHARDING STRING, DEDUP STRING, "
+            "FIRST_BATCH INT, LAST_BATCH INT, "
+            "FIRST_ID STRING, LAST_ID STRING, NUM_ROWS INT, "
+            "COMMITTED_AT TIMESTAMP_LTZ DEFAULT CURRENT_TIMESTAMP())"
+        )
+
+    def get_committed_batches(self) -> Set[int]:
+        """
+        :return: Indexes of the batches of the rank whose outputs were committed by previous runs of the job
+        """
+        rows = (
+            self._conn.cursor()
+            .execute(
+                f"SELECT WORLD_SIZE, BATCH_SIZE, SHARDING, DEDUP, FIRST_BATCH, LAST_BATCH FROM {self._table_name} "
+                "WHERE JOB_NAME = %s AND RANK = %s",
+                (self._job_name, self._rank),
+            )
+            .fetchall()
+        )
+        committed = set()
+        for *layout, first_batch, last_batch in rows:
+            layout = BatchLayout(*layout)
+            if layout != self._layout:
+                raise ValueError(
+                    f"Job {self._job_name} was run with {layout} and can't be resumed with {self._layout}, "
+                    f"the batch indexes point to different rows, delete its rows from {self._table_name} "
+                    f"to start over"
+                )
+            committed.update(range(first_batch, last_batch + 1))
+        logger.info(
+            f"Committed batches of job: {self._job_name}, rank: {self._rank}: {len(committed)}"
+        )
+        return committed
+
+    def commit(
+        self, df: pd.DataFrame, output_table: str, first_batch: int, last_batch: int
+    ):
+        """
+        Writes the outputs of the batches first_batch..last_batch to the output table and records them,
+        both or none are committed. The rows are loaded into a temporary staging table first, which is
+        copied to the output table in the transaction of the ledger entry.
+        """
+        staging_table = f"{output_table}_STAGING_{self._rank}"
+        cur = self._conn.cursor()
+        cur.execute(f"DROP TABLE IF EXISTS {_quote(staging_table)}")
+        write_pandas(
+            self._conn,
+            df,
+            staging_table,
+            auto_create_table=True,
+            table_type="temporary",
+        )
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS {_quote(output_table)} LIKE {_quote(staging_table)}"
+        )
+        columns = ", ".join(_quote(column) for column in df.columns)
+        ids = df["ID"]
+        cur.execute("BEGIN")
+        try:
+            cur.execute(
+                f"INSERT INTO {_quote(output_table)} ({columns}) "
+                f"SELECT {columns} FROM {_quote(staging_table)}"
+            )
+            cur.execute(
+                f"INSERT INTO {self._table_name} (JOB_NAME, RANK, WORLD_SIZE, BATCH_SIZE, SHARDING, DEDUP, "
+                "FIRST_BATCH, LAST_BATCH, FIRST_ID, LAST_ID, NUM_ROWS) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                (
+                    self._job_name,
+                    self._rank,
+                    *self._layout,
+                    first_batch,
+                    last_batch,
+                    str(ids.iloc[0]),
+                    str(ids.iloc[-1]),
+                    len(df),
+                ),
+            )
+            cur.execute("COMMIT")
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+
+
+def _quote(name: str) -> str:
+    # same quoting as write_pandas, which creates the tables with quoted identifiers
+    return f'"{name}"'
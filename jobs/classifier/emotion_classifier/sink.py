@@ -0,0 +1,155 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+import pandas as pd
+from snowflake.connector.pandas_tools import write_pandas
+
+from emotion_classifier.ledger import ProgressLedger
+from emotion_classifier.utils import init_logger
+
+logger = init_logger("OutputSink")
+
+_FLUSH_ROWS = 10000
+_FLUSH_INTERVAL_SEC = 30.0
+_MAX_PENDING_FLUSHES = 1
+
+
+@dataclass
+class SinkStats:
+    flushes: int = 0
+    rows_written: int = 0
+    write_sec: float = 0.0
+    blocked_sec: float = 0.0
+
+
+class TableSink:
+    """
+    Buffers output rows and writes them to the table on a background thread. A flush writes the buffered rows
+    as a single parquet file with one PUT and one COPY, instead of a round trip per model batch.
+    The caller blocks only when `max_pending_flushes` flushes are already waiting for the writer.
+    With a ledger, every flush is committed together with the ledger entry of its input batches.
+    """
+
+    def __init__(
+        self,
+        conn,
+        table_name: str,
+        flush_rows: int = _FLUSH_ROWS,
+        flush_interval_sec: float = _FLUSH_INTERVAL_SEC,
+        max_pending_flushes: int = _MAX_PENDING_FLUSHES,
+        ledger: Optional[ProgressLedger] = None,
+    ):
+        """
+        :param conn: Snowflake connection used by the writer thread.
+        :param table_name: Output table, created on the first write if it doesn't exist.
+        :param flush_rows: The buffer is flushed when it holds at least this many rows.
+        :param flush_interval_sec: The buffer is flushed on the next write after this many seconds since the last flush.
+        :param max_pending_flushes: Number of flushes queued for the writer before `write` blocks.
+        :param ledger: Records the input batches of every flush, see `ProgressLedger.commit`.
+        """
+        self._conn = conn
+        self._table_name = table_name
+        self._flush_rows = flush_rows
+        self._flush_interval_sec = flush_interval_sec
+        self._buffer: List[pd.DataFrame] = []
+        self._buffered_rows = 0
+        self._first_batch: Optional[int] = None
+        self._last_batch: Optional[int] = None
+        self._ledger = ledger
+        self._last_flush_time = time.monotonic()
+        self._queue = queue.Queue(maxsize=max_pending_flushes)
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(
+            target=self._run, name="table-sink", daemon=True
+        )
+        self.stats = SinkStats()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # buffered rows are written on a clean exit only, a failed job is rerun
+        self.close(flush=exc_type is None)
+
+    def write(self, df: pd.DataFrame, batch_index: Optional[int] = None):
+        """
+        Adds the rows to the buffer, flushes the buffer when it is full or old enough
+        :param batch_index: Index of the input batch of the rows, required with a ledger.
+        :raises: the error of a previous background write
+        """
+        self._raise_error()
+        self._buffer.append(df)
+        self._buffered_rows += len(df)
+        if self._first_batch is None:
+            self._first_batch = batch_index
+        self._last_batch = batch_index
+        if (
+            self._buffered_rows >= self._flush_rows
+            or time.monotonic() - self._last_flush_time >= self._flush_interval_sec
+        ):
+            self.flush()
+
+    def flush(self):
+        """
+        Hands the buffered rows to the writer thread, blocks while the queue of pending flushes is full
+        """
+        if not self._buffer:
+            return
+        df = pd.concat(self._buffer, ignore_index=True)
+        batches = (self._first_batch, self._last_batch)
+        self._buffer, self._buffered_rows = [], 0
+        self._first_batch = self._last_batch = None
+        self._last_flush_time = time.monotonic()
+        start_time = time.perf_counter()
+        self._queue.put((df, batches))
+        self.stats.blocked_sec += time.perf_counter() - start_time
+
+    def close(self, flush: bool = True):
+        """
+        Flushes the remaining rows and waits until the writer thread wrote all of them
+        :raises: the error of a background write
+        """
+        if flush:
+            self._raise_error()
+            self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        logger.info(f"Closed sink of {self._table_name}, {self.stats}")
+        if flush:
+            self._raise_error()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            df, (first_batch, last_batch) = item
+            if self._error is not None:
+                # rows after a failed write are dropped, the error is raised in the caller
+                continue
+            try:
+                start_time = time.perf_counter()
+                if self._ledger is not None:
+                    self._ledger.commit(df, self._table_name, first_batch, last_batch)
+                else:
+                    write_pandas(
+                        self._conn, df, self._table_name, auto_create_table=True
+                    )
+                self.stats.write_sec += time.perf_counter() - start_time
+                self.stats.flushes += 1
+                self.stats.rows_written += len(df)
+                logger.info(
+                    f"Wrote {len(df)} rows to {self._table_name}, total rows written: {self.stats.rows_written}"
+                )
+            except BaseException as e:
+                self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError(
+                f"Writing to {self._table_name} failed: {self._error!r}"
+            ) from self._error
@@ -1,9 +1,26 @@
 #!/opt/conda/bin/python3
 
 import click
+import pandas as pd
 from typing import Dict
-from emotion_classifier.classifier import EmotionClassifier
-from emotion_classifier.data import get_batch_iterator_from_sql
+from emotion_classifier.classifier import IDS, EmotionClassifier
+from emotion_classifier.data import (
+    BATCH_DEDUP,
+    DEDUP_MODES,
+    NO_DEDUP,
+    SQL_DEDUP,
+    STRIDED,
+    DedupStats,
+    FetchStats,
+    deduplicate_texts,
+    expand_grouped_ids,
+    fan_out,
+    get_batch_iterator_from_sql,
+    get_distinct_text_sql,
+    index_texts,
+)
+from emotion_classifier.ledger import BatchLayout, ProgressLedger
+from emotion_classifier.sink import TableSink
 from emotion_classifier.utils import (
     init_logger,
     load_toml_config,
@@ -26,22 +43,123 @@ def process(config: Dict[str, str], output_table: str, sql: str, batch_size: int
             f"Starting processing, job: {job_name}, rank: {rank}, world_size: {world_size}, sql: {sql}"
         )
         classifier = EmotionClassifier(config, batch_size)
+        if classifier.output_format == IDS and rank == 0:
+            write_label_table(conn, classifier, output_table)
         cur = conn.cursor()
         batch_idx = 0
         total_records_processed = 0
-        for pd_df in get_batch_iterator_from_sql(
-            cur, sql, rank, world_size, batch_size
-        ):
-            total_records_processed += len(pd_df)
-            batch_idx += 1
-            input_rows = list(pd_df["TEXT"])
-            ids = list(pd_df["ID"])
-            output_rows = classifier.classify(input_rows)
-            output_df = pd_df.assign(OUTPUT=output_rows).reset_index(drop=True)
-            write_pandas(conn, output_df, output_table, auto_create_table=True)
-            logger.info(
-                f"Processed batch: {batch_idx}, total records processed: {total_records_processed}, ids: {ids[0]}-{ids[-1]}"
+        data_config = config.get("data", {})
+        output_config = config.get("output", {})
+        progress_config = config.get("progress", {})
+        fetch_stats = FetchStats()
+        dedup = data_config.get("dedup", NO_DEDUP)
+        if dedup not in DEDUP_MODES:
+            raise ValueError(f"Unknown dedup mode: {dedup}, supported: {DEDUP_MODES}")
+        dedup_stats = DedupStats()
+        read_batch_size = batch_size
+        if dedup == BATCH_DEDUP:
+            # duplicates are found within the rows read at once, the model still runs batch_size texts at a time
+            read_batch_size = max(batch_size, data_config.get("dedup_rows", 10000))
+        sharding = data_config.get("sharding", STRIDED)
+        ledger, committed_batches = None, set()
+        if progress_config.get("enabled", False):
+            # the outputs of the batches committed by a previous run of the job are not computed again
+            ledger = ProgressLedger(
+                conn,
+                progress_config.get("ledger_table") or f"{output_table}_PROGRESS",
+                job_name,
+                rank,
+                BatchLayout(world_size, read_batch_size, sharding, dedup),
             )
+            committed_batches = ledger.get_committed_batches()
+        if dedup == SQL_DEDUP:
+            sql = get_distinct_text_sql(sql)
+        batches = get_batch_iterator_from_sql(
+            cur,
+            sql,
+            rank,
+            world_size,
+            read_batch_size,
+            sharding,
+            data_config.get("fetch_threads", 4),
+            data_config.get("prefetch_mb", 256) * 2**20,
+            fetch_stats,
+            committed_batches,
+        )
+        # outputs are buffered and written by a background thread, one COPY per flush
+        with TableSink(
+            conn,
+            output_table,
+            output_config.get("flush_rows", 10000),
+            output_config.get("flush_interval_sec", 30),
+            output_config.get("max_pending_flushes", 1),
+            ledger,
+        ) as sink:
+            for batch_index, pd_df in batches:
+                if dedup == SQL_DEDUP:
+                    pd_df = expand_grouped_ids(pd_df)
+                total_records_processed += len(pd_df)
+                batch_idx += 1
+                ids = list(pd_df["ID"])
+                sink.write(
+                    classify_batch(classifier, pd_df, dedup, dedup_stats), batch_index
+                )
+                logger.info(
+                    f"Processed batch: {batch_idx}, batch index: {batch_index}, total records processed: {total_records_processed}, ids: {ids[0]}-{ids[-1]}, "
+                    f"dedup ratio: {dedup_stats.ratio:.2f}, fetch wait: {fetch_stats.fetch_wait_sec:.1f} s, "
+                    f"write wait: {sink.stats.blocked_sec:.1f} s"
+                )
+
+
+def classify_batch(
+    classifier: EmotionClassifier,
+    pd_df: pd.DataFrame,
+    dedup: str,
+    dedup_stats: DedupStats,
+) -> pd.DataFrame:
+    """
+    Classifies the texts of the batch, with dedup every distinct text is classified once
+    and its output is copied to all of its rows
+    :return: the rows of the batch with the output columns
+    """
+    # NULL texts are not classified, their outputs are NULL
+    if dedup == NO_DEDUP:
+        input_rows, inverse = index_texts(pd_df["TEXT"])
+    else:
+        input_rows, inverse = deduplicate_texts(pd_df["TEXT"])
+    dedup_stats.input_rows += len(pd_df)
+    dedup_stats.unique_texts += len(input_rows)
+    if classifier.output_format == IDS:
+        # label ids and scores arrays, label names are in the label table
+        label_ids, scores = classifier.classify_top_k(input_rows)
+        output_df = pd_df.assign(
+            OUTPUT_LABEL_IDS=fan_out(list(label_ids), inverse),
+            OUTPUT_SCORES=fan_out(list(scores), inverse),
+        )
+    else:
+        output_df = pd_df.assign(
+            OUTPUT=fan_out(classifier.classify(input_rows), inverse)
+        )
+    return output_df.reset_index(drop=True)
+
+
+def write_label_table(conn, classifier: EmotionClassifier, output_table: str):
+    """
+    Writes the label names of the label ids once per job, to the {output_table}_LABELS table
+    """
+    labels_df = pd.DataFrame(
+        {"LABEL_ID": range(len(classifier.labels)), "LABEL": classifier.labels}
+    )
+    write_pandas(
+        conn,
+        labels_df,
+        f"{output_table}_LABELS",
+        auto_create_table=True,
+        overwrite=True,
+    )
+    logger.info(
+        f"Wrote label table: {output_table}_LABELS, labels: {classifier.labels}"
+    )
 
 
 @click.command()
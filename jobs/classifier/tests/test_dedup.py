@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+from emotion_classifier.data import (
+    deduplicate_texts,
+    expand_grouped_ids,
+    fan_out,
+    index_texts,
+)
+
+
+def test_deduplicate_texts_with_null_texts():
+    texts = ["a", "b", "a", None, None]
+    unique_texts, inverse = deduplicate_texts(texts)
+    assert unique_texts == ["a", "b"]
+    assert fan_out(["out_a", "out_b"], inverse) == [
+        "out_a",
+        "out_b",
+        "out_a",
+        None,
+        None,
+    ]
+
+
+def test_index_texts_with_null_texts():
+    texts = pd.Series(["a", None, "b", np.nan, "a"])
+    input_texts, inverse = index_texts(texts)
+    assert input_texts == ["a", "b", "a"]
+    assert fan_out(["o1", "o2", "o3"], inverse) == ["o1", None, "o2", None, "o3"]
+
+
+def test_expand_grouped_ids_drops_texts_without_ids():
+    df = pd.DataFrame({"TEXT": ["a", "b", None], "IDS": ["[1, 3]", "[]", "[2]"]})
+    rows = expand_grouped_ids(df)
+    assert list(rows["ID"]) == [1, 3, 2]
+    assert list(rows["TEXT"][:2]) == ["a", "a"] and pd.isna(rows["TEXT"].iloc[2])
@@ -9,13 +9,18 @@ spec:
   - name: main
     image: /AIVANOUDB/PUBLIC/EMBEDDINGS_REPO/embeddings_service:01
     command:
-     - python
-     - -u
-     - src/main_service.py
-     - --ip
-     - 0.0.0.0
-     - --port
-     - 9000
+     - gunicorn
+     - -k
+     - uvicorn.workers.UvicornWorker
+     - --bind
+     - 0.0.0.0:9000
+     - --workers
+     - 1
+     - --timeout
+     - 0
+     - -c
+     - gunicorn_conf.py
+     - async_app:app
     env:
       OBJC_DISABLE_INITIALIZE_FORK_SAFETY: YES
     resources:
@@ -33,9 +38,25 @@ MAX_INSTANCES = 1
 EXTERNAL_ACCESS_INTEGRATIONS=(hf_access_eai);
 
 
-CREATE OR REPLACE FUNCTION EMBEDDING_SERVICE_FN (n VARCHAR)
+CREATE OR REPLACE FUNCTION EMBEDDING_SERVICE_EMBEDDING_FN (n VARCHAR)
   returns VARCHAR
   service=EMBEDDING_SERVICE
   endpoint='main'
   MAX_BATCH_ROWS=1024
-  as '/process';
\ No newline at end of file
+  as '/extract_embeddings';
+
+
+CREATE OR REPLACE FUNCTION EMBEDDING_SERVICE_EMBEDDING_ARRAY_FN (n VARCHAR)
+  returns ARRAY
+  service=EMBEDDING_SERVICE
+  endpoint='main'
+  MAX_BATCH_ROWS=1024
+  as '/extract_embeddings/array';
+
+
+CREATE OR REPLACE FUNCTION EMBEDDING_SERVICE_CLASSIFY_FN (n VARCHAR)
+  returns VARCHAR
+  service=EMBEDDING_SERVICE
+  endpoint='main'
+  MAX_BATCH_ROWS=1024
+  as '/classify_texts';
\ No newline at end of file
@@ -0,0 +1,214 @@
+import asyncio
+import collections
+import time
+from dataclasses import dataclass
+from typing import Deque, Optional
+
+from spcs_utils import init_logger
+
+logger = init_logger("AdmissionController")
+
+_LATENCY_SMOOTHING = 0.2
+
+QUEUE_FULL = 'queue_full'
+TIMEOUT = 'timeout'
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, message: str):
+        """
+        :param reason: queue_full or timeout
+        """
+        super().__init__(message)
+        self.reason = reason
+
+
+@dataclass
+class AdmissionStats:
+    admitted: int = 0
+    completed: int = 0
+    failed: int = 0
+    rejected_queue_full: int = 0
+    rejected_timeout: int = 0
+    limit_increases: int = 0
+    limit_decreases: int = 0
+
+
+class AdmissionController:
+    """
+    Limits the number of requests processed at the same time and queues the requests over the limit.
+
+    A request is rejected only when the queue is full, or when its expected wait, the queued requests ahead of it times
+    the average request latency divided by the limit, is longer than `queue_timeout_sec`, the time the caller is
+    willing to wait. The limit adapts to the latency of the model batches reported by `observe_batch`, the request
+    latency includes the wait for the batch and grows with the limit itself: the limit grows by one request per `limit`
+    batches completed within `target_batch_latency_sec` and is cut by `decrease_factor` when a batch takes longer.
+    """
+
+    def __init__(self,
+                 max_limit: int,
+                 min_limit: int = 1,
+                 initial_limit: Optional[int] = None,
+                 max_queued: int = 64,
+                 queue_timeout_sec: float = 30.0,
+                 target_batch_latency_sec: float = 2.0,
+                 decrease_factor: float = 0.5):
+        """
+        :param max_limit: max number of requests processed at the same time
+        :param min_limit: the limit never goes below this number of requests
+        :param initial_limit: limit before any latency was observed, defaults to `max_limit`
+        :param max_queued: max number of requests waiting for admission
+        :param queue_timeout_sec: max time a request waits for admission
+        :param target_batch_latency_sec: latency of the model batches the limit is adapted to
+        :param decrease_factor: multiplier of the limit when a batch is slower than the target latency
+        """
+        self.stats = AdmissionStats()
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.limit = float(initial_limit or max_limit)
+        self.running = 0
+        self._max_queued = max_queued
+        self._queue_timeout_sec = queue_timeout_sec
+        self._target_batch_latency_sec = target_batch_latency_sec
+        self._decrease_factor = decrease_factor
+        self._avg_latency_sec: Optional[float] = None
+        self._last_decrease_time = 0.0
+        self._waiters: Deque[asyncio.Future] = collections.deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def get_expected_wait(self) -> float:
+        """
+        Expected time a new request waits for admission, 0 until a request latency was observed
+        """
+        if self._avg_latency_sec is None:
+            return 0.0
+        return (len(self._waiters) + 1) * self._avg_latency_sec / max(int(self.limit), 1)
+
+    def get_stats(self) -> dict:
+        return {
+            'limit': int(self.limit),
+            'running': self.running,
+            'queued': self.queued,
+            'admitted': self.stats.admitted,
+            'completed': self.stats.completed,
+            'failed': self.stats.failed,
+            'rejected': self.stats.rejected_queue_full + self.stats.rejected_timeout,
+            'rejected_queue_full': self.stats.rejected_queue_full,
+            'rejected_timeout': self.stats.rejected_timeout,
+            'limit_increases': self.stats.limit_increases,
+            'limit_decreases': self.stats.limit_decreases,
+            'avg_latency_sec': self._avg_latency_sec,
+            'expected_wait_sec': self.get_expected_wait(),
+        }
+
+    async def acquire(self):
+        """
+        Waits until the request is admitted, the caller must call `release` when the request is done
+        :raises AdmissionRejected: if the request can't be admitted within the queue timeout
+        """
+        if self.running < int(self.limit) and not self._waiters:
+            self._admit()
+            return
+        if len(self._waiters) >= self._max_queued:
+            self.stats.rejected_queue_full += 1
+            raise AdmissionRejected(QUEUE_FULL, f"queue is full, queued requests: {len(self._waiters)}")
+        expected_wait = self.get_expected_wait()
+        if expected_wait > self._queue_timeout_sec:
+            self.stats.rejected_timeout += 1
+            raise AdmissionRejected(TIMEOUT, f"expected wait: {expected_wait:.2f} s")
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self._queue_timeout_sec)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # admitted while the wait was interrupted, the slot goes to the next request
+                self.running -= 1
+                self._admit_waiters()
+            else:
+                self._remove_waiter(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats.rejected_timeout += 1
+                raise AdmissionRejected(TIMEOUT, f"waited for {self._queue_timeout_sec} s")
+            raise
+
+    def release(self, latency_sec: float, success: bool = True):
+        """
+        :param latency_sec: time the request took after it was admitted
+        :param success: latencies of failed requests are not averaged
+        """
+        self.running -= 1
+        if success:
+            self.stats.completed += 1
+            if self._avg_latency_sec is None:
+                self._avg_latency_sec = latency_sec
+            else:
+                self._avg_latency_sec += _LATENCY_SMOOTHING * (latency_sec - self._avg_latency_sec)
+        else:
+            self.stats.failed += 1
+        self._admit_waiters()
+
+    def observe_batch(self, latency_sec: float):
+        """
+        Adapts the limit to the latency of a model batch, must be called on the event loop
+        :param latency_sec: time the model took for the batch
+        """
+        self._adapt_limit(latency_sec)
+        self._admit_waiters()
+
+    def _adapt_limit(self, latency_sec: float):
+        if latency_sec <= self._target_batch_latency_sec:
+            if self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self.stats.limit_increases += 1
+            return
+        now = time.monotonic()
+        # batches that were running during the last decrease report the same overload, don't decrease again for them
+        if now - self._last_decrease_time < latency_sec:
+            return
+        self._last_decrease_time = now
+        limit = max(self.min_limit, self.limit * self._decrease_factor)
+        if limit < self.limit:
+            logger.info(f"Decreasing the concurrency limit from {int(self.limit)} to {int(limit)}, "
+                        f"batch latency: {latency_sec:.2f} s, target: {self._target_batch_latency_sec:.2f} s")
+            self.limit = limit
+            self.stats.limit_decreases += 1
+
+    def _admit(self):
+        self.running += 1
+        self.stats.admitted += 1
+
+    def _admit_waiters(self):
+        while self._waiters and self.running < int(self.limit):
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            self._admit()
+            waiter.set_result(None)
+
+    def _remove_waiter(self, waiter: asyncio.Future):
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+
+
+def create_admission_controller(service_config, compute_pool_config,
+                                default_max_concurrent_requests: int) -> Optional[AdmissionController]:
+    """
+    Creates the admission controller from the [service] section of config.toml and the target batch latency of the
+    compute pool, which depends on its hardware, backend and batch size. Returns None when `max_concurrent_requests` is 0
+    """
+    max_concurrent_requests = service_config.get('max_concurrent_requests', default_max_concurrent_requests)
+    if not max_concurrent_requests:
+        return None
+    target_batch_latency_ms = compute_pool_config.get('target_batch_latency_ms', 2000)
+    return AdmissionController(max_limit=max_concurrent_requests,
+                               min_limit=service_config.get('min_concurrent_requests', 1),
+                               initial_limit=service_config.get('initial_concurrent_requests'),
+                               max_queued=service_config.get('max_queued_requests', 64),
+                               queue_timeout_sec=service_config.get('queue_timeout_ms', 30000) / 1000,
+                               target_batch_latency_sec=target_batch_latency_ms / 1000)
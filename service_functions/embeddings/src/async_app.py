@@ -1,113 +1,409 @@
 import asyncio
+import collections
 import contextlib
 import http
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from typing import AsyncIterator, cast
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Dict, List, Optional, Sequence, cast
 
 from starlette import concurrency
 from starlette.applications import Starlette
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response, StreamingResponse
 from starlette.routing import Route
-from spcs_utils import init_logger, load_toml_config, get_compute_pool_type, InputRow, OutputRow, ModelConfiguration
+from spcs_utils import init_logger, load_toml_config, get_compute_pool_type, create_model_configurations, \
+    ModelConfiguration, DEFAULT_MODEL, iter_batches
 
-from feature_extractor import extract_embeddings
-from classifier import run_classifier
+from admission import AdmissionRejected, create_admission_controller
+from batching import MicroBatcher
+from codec import AUTO, InvalidRequestError, ServiceFunctionRequest, create_codec, decode_request, encode_response, \
+    encode_response_fields, encode_response_rows
+from embedding_formats import ARRAY, EMBEDDING_OUTPUT_FORMATS, encode_embeddings
+from feature_extractor import EMBEDDING_MAX_LENGTH, compute_embeddings
+from classifier import classify, get_labels
+from classifier_formats import CLASSIFIER_OUTPUT_FORMATS, IDS, encode_classifications
+from inference_cache import NDArrayCodec, create_inference_cache
+from metrics import CONTENT_TYPE_LATEST, PARSE, QUEUE, INFERENCE, SERIALIZE, TOTAL, generate_metrics, \
+    get_process_memory, observe_admission, observe_batch, observe_rejection, observe_request
+from model_registry import model_registry
 
 logger = init_logger("EmbeddingsProcessorApp")
 
-_CONCURRENT_REQUESTS_MAX = 1
+_CONCURRENT_REQUESTS_MAX = 16
+_MAX_BATCH_WAIT_MS = 20
+_MODEL_HEADER = 'X-Model-Name'
+# model batches of a streamed response submitted ahead of the one being written
+_STREAM_PREFETCH_BATCHES = 1
+_RESPONSE_ENVELOPE_START = b'{"data":['
+
+
+@dataclass
+class _InferenceRoute:
+    inference_function: Callable
+    cache_codec: type
+    get_model_name: Callable
+
+
+def _get_embedding_model_name(model_configuration: ModelConfiguration) -> str:
+    # embeddings of the same model with a different tokenizer, max length or pooling are cached separately
+    normalized = ':normalized' if model_configuration.embedding_normalize else ''
+    return (f"{model_configuration.embedding_model_name}:{model_configuration.embedding_tokenizer_name}:"
+            f"{EMBEDDING_MAX_LENGTH}:{model_configuration.embedding_pooling}{normalized}")
+
+
+_INFERENCE_ROUTES = {
+    'extract_embeddings': _InferenceRoute(compute_embeddings, NDArrayCodec, _get_embedding_model_name),
+    # top k label ids and scores, see `classify`
+    'classify_texts': _InferenceRoute(classify, NDArrayCodec, lambda c: f"{c.classifier_model_name}:top_k"),
+}
+
+
+class UnknownModelError(Exception):
+    pass
+
+
+class _FinishingStreamingResponse(StreamingResponse):
+    """
+    Streamed response that calls `finish_request` with the status once the body is sent or the stream is aborted,
+    a body that was not sent completely is reported as an error, its status line was already sent
+    """
+
+    def __init__(self, response: StreamingResponse, finish_request: Callable[[int], None]):
+        super().__init__(self._iter_body(response.body_iterator), status_code=response.status_code,
+                         media_type=response.media_type)
+        self._finish_request = finish_request
+        self._completed = False
+
+    async def _iter_body(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        async for chunk in chunks:
+            yield chunk
+        self._completed = True
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        except Exception as e:
+            logger.error(f'Streamed response failed: {e!r}')
+            raise
+        finally:
+            self._finish_request(self.status_code if self._completed else http.HTTPStatus.INTERNAL_SERVER_ERROR)
 
 
 @contextlib.asynccontextmanager
 async def lifespan(app: Starlette) -> AsyncIterator[dict]:
     app.state.model_loading_event = asyncio.Event()
     config = load_toml_config()
-    app.state.max_concurrent_requests = _CONCURRENT_REQUESTS_MAX
-    app.state.success_requests = 0
-    app.state.throttle_requests = 0
-    app.state.concurrent_requests = 0
-    app.state.semaphore = asyncio.Semaphore(_CONCURRENT_REQUESTS_MAX)
-    app.state.batch_size = config["compute_pool"][get_compute_pool_type()]['batch_size']
-    app.state.model_configuration = ModelConfiguration(classifier_model_name=config['general']['classifier_model_name'],
-                                                       embedding_model_name=config['general']['embedding_model_name'],
-                                                       embedding_tokenizer_name=config['general'][
-                                                           'embedding_tokenizer_name'])
-    yield {}
-
-
-def health(_input_json) -> JSONResponse:
+    service_config = config.get('service', {})
+    compute_pool_config = config["compute_pool"][get_compute_pool_type()]
+    app.state.admission_controller = create_admission_controller(service_config, compute_pool_config,
+                                                                 _CONCURRENT_REQUESTS_MAX)
+    app.state.batch_size = compute_pool_config['batch_size']
+    app.state.max_tokens_per_batch = compute_pool_config.get('max_tokens_per_batch')
+    app.state.model_configurations = create_model_configurations(config)
+    model_registry.set_memory_budget(service_config.get('model_memory_budget_mb', 0) * 2 ** 20)
+    # single model thread, batches of all endpoints and models never run on the model at the same time
+    app.state.model_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='model')
+    app.state.max_batch_wait_sec = service_config.get('max_batch_wait_ms', _MAX_BATCH_WAIT_MS) / 1000
+    app.state.inference_cache = create_inference_cache(config)
+    app.state.codec = create_codec(service_config.get('json_codec', AUTO))
+    app.state.stream_min_rows = service_config.get('stream_min_rows', 0)
+    app.state.batchers = {}
+    for route_name in _INFERENCE_ROUTES:
+        _get_batcher(route_name, DEFAULT_MODEL)
+    try:
+        yield {}
+    finally:
+        for batcher in app.state.batchers.values():
+            await batcher.stop()
+        app.state.model_executor.shutdown(wait=False)
+
+
+def _get_batcher(route_name: str, model: str) -> MicroBatcher:
+    """
+    Returns the batcher of the route and model, rows of different models are never batched together
+    """
+    model_configuration = _get_model_configuration(model)
+    key = f"{model}/{route_name}"
+    batcher = app.state.batchers.get(key)
+    if batcher is None:
+        batch_size = app.state.batch_size
+        inference_function = partial(_INFERENCE_ROUTES[route_name].inference_function, batch_size=batch_size,
+                                     model_config=model_configuration,
+                                     max_tokens=app.state.max_tokens_per_batch)
+        inference_function = partial(_run_batch, route_name, batch_size, inference_function)
+        admission_controller = app.state.admission_controller
+        # the concurrency limit adapts to the batch latency, the request latency includes the wait for the batch
+        batcher = MicroBatcher(key, inference_function, batch_size, app.state.max_batch_wait_sec,
+                               app.state.model_executor,
+                               on_batch=admission_controller.observe_batch if admission_controller else None)
+        batcher.start()
+        app.state.batchers[key] = batcher
+    return batcher
+
+
+def _run_batch(route_name: str, batch_size: int, inference_function: Callable, texts: List[str]):
+    # runs on the model thread
+    timings = {}
+    start_time = time.perf_counter()
+    outputs = inference_function(texts, timings=timings)
+    timings[TOTAL] = time.perf_counter() - start_time
+    observe_batch(route_name, len(texts), batch_size, timings)
+    return outputs
+
+
+def _get_model_configuration(model: str) -> ModelConfiguration:
+    if model not in app.state.model_configurations:
+        raise UnknownModelError(model)
+    return app.state.model_configurations[model]
+
+
+def _get_cache_namespace(route_name: str, model: str) -> str:
+    inference_route = _INFERENCE_ROUTES[route_name]
+    model_configuration = app.state.model_configurations[model]
+    # outputs of the backends differ slightly, e.g. fp16 and int8, so they are cached separately
+    namespace = (f"{route_name}:{inference_route.get_model_name(model_configuration)}:"
+                 f"{model_configuration.inference_backend}")
+    app.state.inference_cache.register_namespace(namespace, inference_route.cache_codec)
+    return namespace
+
+
+def _get_model(request: Request) -> str:
+    return request.path_params.get('model') or request.headers.get(_MODEL_HEADER) or DEFAULT_MODEL
+
+
+async def health(_request_data, _request: Request) -> JSONResponse:
     return JSONResponse({"health": "ready"}, status_code=http.HTTPStatus.OK)
 
 
-def route_extract_embeddings(input_json):
-    return _run_inference(input_json, extract_embeddings)
+async def stats(_request: Request) -> JSONResponse:
+    admission_controller = app.state.admission_controller
+    output_data = {
+        'admission': admission_controller.get_stats() if admission_controller else None,
+        'batchers': {name: batcher.get_stats() for name, batcher in app.state.batchers.items()},
+        'models': model_registry.get_stats(),
+        'cache': app.state.inference_cache.get_stats() if app.state.inference_cache else None,
+        'process': {'pid': os.getpid(), **get_process_memory()},
+    }
+    return JSONResponse(output_data, status_code=http.HTTPStatus.OK)
 
 
-def route_classify_texts(input_json):
-    return _run_inference(input_json, run_classifier)
+async def prometheus_metrics(_request: Request) -> Response:
+    # samples of all workers are read from the multiprocess directory
+    content = await concurrency.run_in_threadpool(generate_metrics)
+    return Response(content, media_type=CONTENT_TYPE_LATEST)
 
 
-def _run_inference(input_json, inference_function):
-    data = input_json['data']
-    logger.debug(f"Received request: {input_json}, size: {len(data)}")
+async def route_extract_embeddings(request_data: ServiceFunctionRequest, request: Request,
+                                   output_format: Optional[str] = None):
+    model = _get_model(request)
+    output_format = output_format or _get_model_configuration(model).embedding_output_format
+    encode_outputs = partial(encode_embeddings, output_format=output_format)
+    if output_format == ARRAY and app.state.codec.supports_numpy:
+        # rows of the embeddings matrix are written to the response as they are
+        encode_outputs = None
+    return await _run_inference(request_data, 'extract_embeddings', model, encode_outputs, request.state.timings)
+
+
+async def route_classify_texts(request_data: ServiceFunctionRequest, request: Request,
+                               output_format: Optional[str] = None):
+    model = _get_model(request)
+    model_configuration = _get_model_configuration(model)
+    output_format = output_format or model_configuration.classifier_output_format
+    labels = await concurrency.run_in_threadpool(get_labels, app.state.batch_size, model_configuration)
+    encode_outputs = partial(encode_classifications, labels=labels, output_format=output_format)
+    # the ids format sends the label names once per response instead of once per row
+    return await _run_inference(request_data, 'classify_texts', model, encode_outputs, request.state.timings,
+                                labels if output_format == IDS else None)
+
+
+async def _run_inference(request_data: ServiceFunctionRequest, route_name: str, model: str, encode_outputs=None,
+                         timings: Optional[Dict[str, float]] = None, labels: Optional[List[str]] = None):
+    timings = {} if timings is None else timings
+    logger.debug(f"Received request: {request_data}, size: {len(request_data)}")
+    batcher = _get_batcher(route_name, model)
+    if 0 < app.state.stream_min_rows <= len(request_data):
+        return StreamingResponse(_iter_response_chunks(request_data, batcher, route_name, model, encode_outputs,
+                                                       timings, labels),
+                                 status_code=http.HTTPStatus.OK, media_type='application/json')
+    inference_start = time.perf_counter()
+    outputs = await _infer(batcher, route_name, model, request_data.texts)
+    timings[INFERENCE] = time.perf_counter() - inference_start
+    serialize_start = time.perf_counter()
+    # encoding and rendering of large responses is CPU heavy, keep it off the event loop
+    response = await concurrency.run_in_threadpool(_create_response, request_data.idx, outputs, encode_outputs,
+                                                   labels)
+    timings[SERIALIZE] = time.perf_counter() - serialize_start
+    return response
+
+
+async def _infer(batcher: MicroBatcher, route_name: str, model: str, texts: Sequence[str]):
+    cache = app.state.inference_cache
+    if cache is None:
+        return await batcher.submit(texts)
+    # only unique texts without cached outputs go through the model, hashing, decoding and the sqlite tier run in the
+    # threadpool to keep them off the event loop
+    lookup = await concurrency.run_in_threadpool(cache.lookup, _get_cache_namespace(route_name, model), texts)
+    outputs = await batcher.submit(lookup.missing_texts)
+    return await concurrency.run_in_threadpool(cache.complete, lookup, outputs)
+
+
+async def _iter_response_chunks(request_data: ServiceFunctionRequest, batcher: MicroBatcher, route_name: str,
+                                model: str, encode_outputs, timings: Dict[str, float],
+                                labels: Optional[List[str]] = None) -> AsyncIterator[bytes]:
+    """
+    Yields the response body one model batch at a time, the rows of a batch are written as soon as the batch
+    completes, so the first bytes are sent after the first batch and only a few batches are kept in memory
+    """
     batch_size = app.state.batch_size
-    model_configuration = app.state.model_configuration
-    input_rows = [InputRow(idx=data_row[0], text=data_row[1]) for data_row in data]
-    num_batches = len(input_rows) // batch_size + 1
-    output_rows = []
-    for i in range(num_batches):
-        batch_rows = input_rows[i * batch_size:(i + 1) * batch_size]
-        batch_output_rows = inference_function(batch_rows, batch_size, model_configuration)
-        output_rows += batch_output_rows
-    output_data = {'data': [[row.idx, row.output] for row in output_rows]}
-    logger.debug(f"Sending response: {output_data}")
-    return JSONResponse(content=output_data, status_code=http.HTTPStatus.OK)
-
-
-async def _run_with_throttling(method, request: Request) -> JSONResponse:
+    batches = iter_batches(request_data.texts, batch_size)
+    in_flight = collections.deque()
+    timings[INFERENCE] = timings[SERIALIZE] = 0.0
+    separator = b''
+    try:
+        yield _RESPONSE_ENVELOPE_START
+        for batch in batches:
+            in_flight.append((batch.offset, asyncio.ensure_future(_infer(batcher, route_name, model, batch.items))))
+            if len(in_flight) <= _STREAM_PREFETCH_BATCHES:
+                continue
+            offset, task = in_flight.popleft()
+            yield await _encode_chunk(request_data, offset, task, encode_outputs, timings, separator)
+            separator = b','
+        while in_flight:
+            offset, task = in_flight.popleft()
+            yield await _encode_chunk(request_data, offset, task, encode_outputs, timings, separator)
+            separator = b','
+        yield b']' + encode_response_fields(app.state.codec, labels=labels) + b'}'
+    finally:
+        # the client disconnected or a batch failed, the remaining batches are not needed
+        for _, task in in_flight:
+            task.cancel()
+
+
+async def _encode_chunk(request_data: ServiceFunctionRequest, offset: int, task: asyncio.Future, encode_outputs,
+                        timings: Dict[str, float], separator: bytes) -> bytes:
+    inference_start = time.perf_counter()
+    outputs = await task
+    serialize_start = time.perf_counter()
+    timings[INFERENCE] += serialize_start - inference_start
+    chunk = await concurrency.run_in_threadpool(_encode_rows, request_data.idx[offset:offset + len(outputs)],
+                                                outputs, encode_outputs)
+    timings[SERIALIZE] += time.perf_counter() - serialize_start
+    return separator + chunk
+
+
+def _encode_rows(idx, outputs, encode_outputs=None) -> bytes:
+    if encode_outputs is not None:
+        outputs = encode_outputs(outputs)
+    return encode_response_rows(app.state.codec, idx, outputs)
+
+
+def _create_response(idx, outputs, encode_outputs=None, labels: Optional[List[str]] = None) -> Response:
+    if encode_outputs is not None and len(idx) > 0:
+        outputs = encode_outputs(outputs)
+    content = encode_response(app.state.codec, idx, outputs, labels=labels)
+    logger.debug(f"Sending response: {content}")
+    return Response(content=content, status_code=http.HTTPStatus.OK, media_type='application/json')
+
+
+async def _run_with_throttling(method, request: Request, route: str = '', admission: bool = True) -> Response:
     app = cast(Starlette, request.app)
 
     start_time = time.time()
-    if _CONCURRENT_REQUESTS_MAX:
-        if app.state.concurrent_requests >= int(_CONCURRENT_REQUESTS_MAX):
-            app.state.throttle_requests += 1
-            logger.debug(f'Number of throttled requests: {app.state.throttle_requests}')
+    request.state.timings = timings = {}
+    admission_controller = app.state.admission_controller if admission else None
+    if admission_controller is not None:
+        try:
+            await admission_controller.acquire()
+        except AdmissionRejected as e:
+            logger.debug(f'Throttled request: {e}, admission: {admission_controller.get_stats()}')
+            observe_rejection(e.reason)
+            observe_request(route, http.HTTPStatus.TOO_MANY_REQUESTS, {})
             return JSONResponse(
                 {"error": "Too many requests"}, status_code=http.HTTPStatus.TOO_MANY_REQUESTS
             )
-
+        finally:
+            observe_admission(admission_controller)
+    admitted_time = time.time()
+    timings[QUEUE] = admitted_time - start_time
+    status = http.HTTPStatus.INTERNAL_SERVER_ERROR
+    batch_size = None
+    finish_request = None
     try:
-        async with app.state.semaphore:
-            app.state.success_requests += 1
-            app.state.concurrent_requests += 1
-            input_json = await request.json()
-            batch_size = len(input_json['data'])
-            resp = await concurrency.run_in_threadpool(method, input_json)
-            total_batch_time = time.time() - start_time
-            logger.info(
-                f'Number of success requests: {app.state.success_requests}, batch_size: {batch_size}, batch_time: {total_batch_time}')
-            return resp
+        request_data = None
+        if request.method == 'POST':
+            try:
+                request_data = decode_request(app.state.codec, await request.body())
+            except InvalidRequestError as e:
+                status = http.HTTPStatus.BAD_REQUEST
+                return JSONResponse({"error": str(e)}, status_code=status)
+        timings[PARSE] = time.time() - admitted_time
+        batch_size = len(request_data) if request_data is not None else None
+        try:
+            resp = await method(request_data, request)
+        except UnknownModelError as e:
+            status = http.HTTPStatus.NOT_FOUND
+            return JSONResponse({"error": f"Unknown model: {e}"}, status_code=status)
+        status = resp.status_code
+        if isinstance(resp, StreamingResponse):
+            # the request holds its admission slot and is observed until the whole body is sent
+            finish_request = partial(_finish_request, admission_controller, route, timings, batch_size, start_time,
+                                     admitted_time)
+            resp = _FinishingStreamingResponse(resp, finish_request)
+        return resp
     finally:
-        app.state.concurrent_requests -= 1
+        if finish_request is None:
+            _finish_request(admission_controller, route, timings, batch_size, start_time, admitted_time, status)
+
+
+def _finish_request(admission_controller, route: str, timings: Dict[str, float], batch_size: Optional[int],
+                    start_time: float, admitted_time: float, status: int):
+    if admission_controller is not None:
+        admission_controller.release(time.time() - admitted_time, status == http.HTTPStatus.OK)
+        observe_admission(admission_controller)
+    timings[TOTAL] = time.time() - start_time
+    observe_request(route, status, timings, batch_size)
+    if status == http.HTTPStatus.OK:
+        logger.info(f'Request completed, batch_size: {batch_size}, batch_time: {timings[TOTAL]}, '
+                    f'queue_time: {timings[QUEUE]}')
 
 
 def _create_endpoint(method):
-    async def async_method(request) -> JSONResponse:
+    async def async_method(request) -> Response:
         resp = await method(request)
         return resp
 
     return async_method
 
 
+def _create_throttled_route(path: str, method, methods: List[str], admission: bool = True) -> Route:
+    return Route(path, _create_endpoint(partial(_run_with_throttling, method, route=path, admission=admission)),
+                 methods=methods)
+
+
+def _create_inference_routes(prefix: str):
+    return [
+        _create_throttled_route(f'{prefix}/extract_embeddings', route_extract_embeddings, methods=["POST"]),
+        *[_create_throttled_route(f'{prefix}/extract_embeddings/{output_format}',
+                                  partial(route_extract_embeddings, output_format=output_format), methods=["POST"])
+          for output_format in EMBEDDING_OUTPUT_FORMATS],
+        _create_throttled_route(f'{prefix}/classify_texts', route_classify_texts, methods=["POST"]),
+        *[_create_throttled_route(f'{prefix}/classify_texts/{output_format}',
+                                  partial(route_classify_texts, output_format=output_format), methods=["POST"])
+          for output_format in CLASSIFIER_OUTPUT_FORMATS],
+    ]
+
+
 def run_app() -> Starlette:
     routes = [
-        Route('/health', _create_endpoint(partial(_run_with_throttling, health)), methods=["GET"]),
-        Route('/extract_embeddings', _create_endpoint(partial(_run_with_throttling, route_extract_embeddings)),
-              methods=["POST"]),
-        Route('/classify_texts', _create_endpoint(partial(_run_with_throttling, route_classify_texts)),
-              methods=["POST"]),
+        # health checks are never queued or throttled
+        _create_throttled_route('/health', health, methods=["GET"], admission=False),
+        *_create_inference_routes(''),
+        *_create_inference_routes('/models/{model}'),
+        Route('/stats', stats, methods=["GET"]),
+        Route('/metrics', prometheus_metrics, methods=["GET"]),
     ]
 
     return Starlette(routes=routes, lifespan=lifespan)
@@ -0,0 +1,146 @@
+import os
+import re
+import tempfile
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Any, List
+
+import torch
+
+from spcs_utils import init_logger
+
+logger = init_logger("InferenceBackends")
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+AUTO = 'auto'
+TORCH_FP16 = 'torch_fp16'
+TORCH_FP32 = 'torch_fp32'
+TORCH_INT8 = 'torch_int8'
+ONNX = 'onnx'
+
+INFERENCE_BACKENDS = [AUTO, TORCH_FP16, TORCH_FP32, TORCH_INT8, ONNX]
+
+_ONNX_CACHE_DIR_ENV = 'ONNX_CACHE_DIR'
+_ONNX_OPSET_VERSION = 14
+
+
+@dataclass
+class InferencePipeline:
+    """
+    Model prepared for the backend with its tokenizer, the model is called with the padded tokenizer outputs
+    """
+    model: Any
+    tokenizer: Any
+    device: torch.device
+    backend: str
+
+
+class OnnxModel:
+    """
+    ONNX Runtime session that is called like the hf model it was exported from, returns the single exported output
+    """
+
+    def __init__(self, session, config, output_name: str, size_bytes: int):
+        self.config = config
+        self.size_bytes = size_bytes
+        self._session = session
+        self._input_names = [model_input.name for model_input in session.get_inputs()]
+        self._output_name = output_name
+
+    def __call__(self, **inputs) -> SimpleNamespace:
+        feeds = {name: inputs[name].cpu().numpy() for name in self._input_names}
+        output = self._session.run([self._output_name], feeds)[0]
+        return SimpleNamespace(**{self._output_name: torch.from_numpy(output)})
+
+
+def get_available_backends() -> List[str]:
+    return [backend for backend in INFERENCE_BACKENDS if backend != ONNX or onnxruntime is not None]
+
+
+def resolve_backend(backend: str) -> str:
+    """
+    :param backend: one of INFERENCE_BACKENDS, auto is torch_fp16 on GPU and torch_fp32 on CPU
+    :return: backend that can run on this machine
+    """
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend: {backend}, supported backends: {INFERENCE_BACKENDS}")
+    if backend == AUTO:
+        return TORCH_FP16 if torch.cuda.is_available() else TORCH_FP32
+    if backend == TORCH_FP16 and not torch.cuda.is_available():
+        logger.warning(f"{TORCH_FP16} is slow or unsupported without a GPU, using {TORCH_FP32}")
+        return TORCH_FP32
+    if backend == ONNX and onnxruntime is None:
+        raise ValueError(f"The {ONNX} backend requires the onnxruntime package")
+    return backend
+
+
+def create_inference_pipeline(model, tokenizer, backend: str, device: int, output_name: str,
+                              model_name: str) -> InferencePipeline:
+    """
+    Prepares the hf model for the backend
+    :param model: hf model in fp32
+    :param tokenizer: hf tokenizer of the model
+    :param backend: one of INFERENCE_BACKENDS
+    :param device: cuda device used by the torch_fp16 and torch_fp32 backends when a GPU is available
+    :param output_name: model output used by the caller, e.g. last_hidden_state or logits, the onnx export keeps only it
+    :param model_name: name of the model, used for the onnx export cache
+    """
+    backend = resolve_backend(backend)
+    model = model.eval()
+    torch_device = torch.device('cpu')
+    if backend in (TORCH_FP16, TORCH_FP32) and torch.cuda.is_available():
+        torch_device = torch.device(f"cuda:{device}")
+    if backend == TORCH_FP16:
+        model = model.half()
+    elif backend == TORCH_FP32:
+        model = model.float()
+    elif backend == TORCH_INT8:
+        # weights of the linear layers are stored as int8, activations are quantized on the fly, CPU only
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend == ONNX:
+        model = _create_onnx_model(model, tokenizer, output_name, model_name)
+    if isinstance(model, torch.nn.Module):
+        model = model.to(torch_device)
+    logger.info(f"Created {backend} pipeline of {model_name} on {torch_device}")
+    return InferencePipeline(model=model, tokenizer=tokenizer, device=torch_device, backend=backend)
+
+
+def get_onnx_cache_dir() -> str:
+    return os.environ.get(_ONNX_CACHE_DIR_ENV, os.path.join(os.path.expanduser('~'), '.cache', 'spcs_onnx'))
+
+
+def _create_onnx_model(model, tokenizer, output_name: str, model_name: str) -> OnnxModel:
+    model_path = os.path.join(get_onnx_cache_dir(), re.sub(r'[^A-Za-z0-9_.-]', '_', model_name), f"{output_name}.onnx")
+    if os.path.exists(model_path):
+        logger.info(f"Using the cached onnx export: {model_path}")
+    else:
+        _export_onnx(model, tokenizer, output_name, model_path)
+    session_options = onnxruntime.SessionOptions()
+    session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = onnxruntime.InferenceSession(model_path, session_options, providers=['CPUExecutionProvider'])
+    return OnnxModel(session, model.config, output_name, os.path.getsize(model_path))
+
+
+def _export_onnx(model, tokenizer, output_name: str, model_path: str):
+    os.makedirs(os.path.dirname(model_path), exist_ok=True)
+    sample = dict(tokenizer(['onnx export sample text'], return_tensors='pt'))
+    input_names = list(sample.keys())
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+    dynamic_axes[output_name] = {0: 'batch', 1: 'sequence'} if output_name == 'last_hidden_state' else {0: 'batch'}
+    # exported to a temporary file first, workers loading the model at the same time never see a partial export
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(model_path), suffix='.onnx.tmp')
+    os.close(fd)
+    try:
+        with torch.no_grad():
+            torch.onnx.export(model.float().cpu(), (sample,), tmp_path, input_names=input_names,
+                              output_names=[output_name], dynamic_axes=dynamic_axes,
+                              opset_version=_ONNX_OPSET_VERSION)
+        os.replace(tmp_path, model_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    logger.info(f"Exported the onnx model: {model_path}")
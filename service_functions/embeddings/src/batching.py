@@ -0,0 +1,221 @@
+import asyncio
+import collections
+import contextlib
+import itertools
+import time
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, List, Optional, Sequence, Tuple
+
+import numpy as np
+from spcs_utils import init_logger
+
+logger = init_logger("MicroBatcher")
+
+
+@dataclass
+class BatcherStats:
+    """
+    Counters describing how well the batcher fills model batches
+    """
+    requests: int = 0
+    rows: int = 0
+    batches: int = 0
+    failed_batches: int = 0
+    batch_time_sec: float = 0.0
+
+    def as_dict(self, batch_size: int, queue_depth: int) -> dict:
+        capacity = self.batches * batch_size
+        return {
+            'requests': self.requests,
+            'rows': self.rows,
+            'batches': self.batches,
+            'failed_batches': self.failed_batches,
+            'queue_depth': queue_depth,
+            'batch_fill_ratio': self.rows / capacity if capacity else 0.0,
+            'avg_rows_per_batch': self.rows / self.batches if self.batches else 0.0,
+            'avg_batch_time_sec': self.batch_time_sec / self.batches if self.batches else 0.0,
+        }
+
+
+class _PendingRequest:
+    """
+    Rows of a single http request waiting in the batcher queue
+    """
+
+    def __init__(self, rows: Sequence[Any], future: asyncio.Future, enqueued_at: float):
+        self.rows = rows
+        self.future = future
+        self.enqueued_at = enqueued_at
+        self.offset = 0
+        self.remaining = len(rows)
+        self.chunks: List[Sequence[Any]] = []
+
+    def take(self, max_rows: int) -> Tuple[int, int]:
+        start = self.offset
+        self.offset = min(len(self.rows), start + max_rows)
+        return start, self.offset
+
+    def is_consumed(self) -> bool:
+        return self.offset >= len(self.rows)
+
+
+class MicroBatcher:
+    """
+    Coalesces rows from concurrent requests into model batches.
+
+    Rows are queued in arrival order. A batch is dispatched as soon as `batch_size` rows are queued, or when the oldest
+    queued row has waited `max_wait_sec`. Batches run one at a time on the model executor and the outputs are scattered
+    back to the requests they came from, in the original row order.
+    """
+
+    def __init__(self,
+                 name: str,
+                 inference_function: Callable[[List[Any]], Sequence[Any]],
+                 batch_size: int,
+                 max_wait_sec: float,
+                 executor: Executor,
+                 on_batch: Optional[Callable[[float], None]] = None):
+        """
+        :param name: name used in logs and metrics
+        :param inference_function: function that runs the model on a list of rows and returns outputs in the same order
+        :param batch_size: max number of rows in a single model batch
+        :param max_wait_sec: max time the oldest queued row waits for the batch to fill up
+        :param executor: executor that owns the model thread
+        :param on_batch: called on the event loop with the latency of every successful batch
+        """
+        self.name = name
+        self.batch_size = batch_size
+        self.stats = BatcherStats()
+        self._inference_function = inference_function
+        self._max_wait_sec = max_wait_sec
+        self._executor = executor
+        self._on_batch = on_batch
+        self._pending: Deque[_PendingRequest] = collections.deque()
+        self._queue_depth = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Number of rows waiting to be scheduled into a model batch
+        """
+        return self._queue_depth
+
+    def get_stats(self) -> dict:
+        return self.stats.as_dict(self.batch_size, self._queue_depth)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name=f"batcher-{self.name}")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+        for request in self._pending:
+            if not request.future.done():
+                request.future.set_exception(RuntimeError(f"Batcher {self.name} stopped"))
+        self._pending.clear()
+        self._queue_depth = 0
+
+    async def submit(self, rows: Sequence[Any]) -> Sequence[Any]:
+        """
+        Queues the rows and waits until all of them went through the model
+        :param rows: rows of a single request
+        :return: outputs in the same order as the rows
+        """
+        if len(rows) == 0:
+            return []
+        loop = asyncio.get_running_loop()
+        request = _PendingRequest(rows, loop.create_future(), loop.time())
+        self._pending.append(request)
+        self._queue_depth += len(rows)
+        self.stats.requests += 1
+        self._wakeup.set()
+        return await request.future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if not self._pending:
+                continue
+            await self._wait_for_batch(loop)
+            batch, owners = self._take_batch()
+            if not batch:
+                continue
+            if self._pending:
+                self._wakeup.set()
+            await self._execute_batch(loop, batch, owners)
+
+    async def _wait_for_batch(self, loop: asyncio.AbstractEventLoop):
+        deadline = self._pending[0].enqueued_at + self._max_wait_sec
+        while self._queue_depth < self.batch_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+            self._wakeup.clear()
+
+    def _take_batch(self) -> Tuple[List[Any], List[Tuple[_PendingRequest, int, int]]]:
+        batch = []
+        owners = []
+        while self._pending and len(batch) < self.batch_size:
+            request = self._pending[0]
+            if request.future.done():
+                # the client went away, there is no one to deliver the outputs to
+                self._pending.popleft()
+                self._queue_depth -= len(request.rows) - request.offset
+                continue
+            start, end = request.take(self.batch_size - len(batch))
+            batch.extend(request.rows[start:end])
+            owners.append((request, len(batch) - (end - start), len(batch)))
+            self._queue_depth -= end - start
+            if request.is_consumed():
+                self._pending.popleft()
+        return batch, owners
+
+    async def _execute_batch(self, loop: asyncio.AbstractEventLoop, batch: List[Any],
+                             owners: List[Tuple[_PendingRequest, int, int]]):
+        start_time = time.time()
+        try:
+            outputs = await loop.run_in_executor(self._executor, self._inference_function, batch)
+        except Exception as e:
+            self.stats.failed_batches += 1
+            logger.exception(f"Batcher: {self.name}, batch of {len(batch)} rows failed")
+            for request, _, _ in owners:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+        batch_time = time.time() - start_time
+        self.stats.batches += 1
+        self.stats.rows += len(batch)
+        self.stats.batch_time_sec += batch_time
+        logger.debug(f"Batcher: {self.name}, batch_size: {len(batch)}, requests: {len(owners)}, "
+                     f"queue_depth: {self._queue_depth}, batch_time: {batch_time}")
+        if self._on_batch is not None:
+            self._on_batch(batch_time)
+        for request, begin, end in owners:
+            if request.future.done():
+                continue
+            request.chunks.append(outputs[begin:end])
+            request.remaining -= end - begin
+            if request.remaining == 0:
+                request.future.set_result(_concat(request.chunks))
+
+
+def _concat(chunks: List[Sequence[Any]]) -> Sequence[Any]:
+    if isinstance(chunks[0], np.ndarray):
+        return chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+    if len(chunks) == 1:
+        return list(chunks[0])
+    return list(itertools.chain.from_iterable(chunks))
+
@@ -0,0 +1,85 @@
+import json
+import random
+import time
+from dataclasses import replace
+from pathlib import Path
+
+import click
+import numpy as np
+
+from backends import AUTO, TORCH_FP32, get_available_backends
+from classifier import compute_scores
+from feature_extractor import compute_embeddings
+from model_registry import model_registry
+from spcs_utils import init_logger, load_toml_config, create_model_configuration, get_compute_pool_type
+
+logger = init_logger("BackendsBenchmark")
+
+
+def _get_words():
+    with open(Path(__file__).parent.parent.joinpath('english_words.txt')) as f:
+        return [line.strip() for line in f]
+
+
+def _run(function, texts, batch_size: int, model_config, max_tokens, repeats: int):
+    # the first call loads the model, exports it to onnx if needed and warms it up
+    function(texts[:batch_size], batch_size, model_config, max_tokens)
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        outputs = function(texts, batch_size, model_config, max_tokens)
+    return outputs, repeats * len(texts) / (time.perf_counter() - start_time)
+
+
+def _compare_embeddings(reference: np.ndarray, embeddings: np.ndarray) -> dict:
+    norms = np.linalg.norm(reference, axis=1) * np.linalg.norm(embeddings, axis=1)
+    cosine = np.sum(reference * embeddings, axis=1) / np.maximum(norms, 1e-12)
+    return {'max_abs_diff': float(np.max(np.abs(reference - embeddings))), 'mean_cosine': float(np.mean(cosine)),
+            'min_cosine': float(np.min(cosine))}
+
+
+def _compare_scores(reference: np.ndarray, scores: np.ndarray) -> dict:
+    return {'max_abs_diff': float(np.max(np.abs(reference - scores))),
+            'top1_agreement': float(np.mean(np.argmax(reference, axis=1) == np.argmax(scores, axis=1)))}
+
+
+@click.command()
+@click.option('--rows', default=512, help="number of texts")
+@click.option('--words', default=30, help="words per text")
+@click.option('--repeats', default=3, help="number of timed runs per backend")
+@click.option('--backend', 'backends', multiple=True, help="backends to compare, all available ones by default")
+def main(rows: int, words: int, repeats: int, backends):
+    """
+    Compares the throughput of the inference backends and the accuracy of their outputs to torch_fp32
+    """
+    config = load_toml_config()
+    compute_pool_config = config['compute_pool'][get_compute_pool_type()]
+    batch_size, max_tokens = compute_pool_config['batch_size'], compute_pool_config.get('max_tokens_per_batch')
+    model_config = create_model_configuration(config)
+    backends = list(backends) or [backend for backend in get_available_backends() if backend != AUTO]
+    if TORCH_FP32 in backends:
+        backends = [TORCH_FP32] + [backend for backend in backends if backend != TORCH_FP32]
+
+    random.seed(0)
+    vocabulary = _get_words()
+    texts = [" ".join(random.choice(vocabulary) for _ in range(random.randint(1, words))) for _ in range(rows)]
+    tasks = {'embeddings': (compute_embeddings, _compare_embeddings), 'classifier': (compute_scores, _compare_scores)}
+    results = []
+    references = {}
+    for backend in backends:
+        backend_config = replace(model_config, inference_backend=backend)
+        for task, (function, compare) in tasks.items():
+            outputs, rows_per_sec = _run(function, texts, batch_size, backend_config, max_tokens, repeats)
+            result = {'backend': backend, 'task': task, 'rows_per_sec': rows_per_sec}
+            if backend == TORCH_FP32:
+                references[task] = outputs
+            if task in references:
+                result.update(compare(references[task], outputs))
+            logger.info(f"{result}")
+            results.append(result)
+        # only the models of one backend are kept in memory
+        model_registry.clear()
+    print(json.dumps({'rows': rows, 'batch_size': batch_size, 'results': results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import json
+import time
+
+import click
+
+from spcs_utils import init_logger, iter_batches, map_batches_ahead, InputRow, OutputRow
+
+logger = init_logger("BatchingBenchmark")
+
+
+def _fake_model(rows, model_time_sec: float):
+    # sleeping releases the GIL like a model forward pass on the GPU does
+    time.sleep(model_time_sec)
+    return [OutputRow(idx=row.idx, output=row.text) for row in rows]
+
+
+def _run_sequential(rows, batch_size: int, model_time_sec: float) -> int:
+    num_batches = len(rows) // batch_size + 1
+    output_rows = []
+    model_calls = 0
+    for i in range(num_batches):
+        batch_rows = rows[i * batch_size:(i + 1) * batch_size]
+        output_rows += _fake_model(batch_rows, model_time_sec)
+        model_calls += 1
+    return model_calls
+
+
+def _run_streaming(rows, batch_size: int, model_time_sec: float) -> int:
+    output_rows = [None] * len(rows)
+    model_calls = 0
+    for batch, batch_output_rows in map_batches_ahead(iter_batches(rows, batch_size),
+                                                      lambda batch: _fake_model(batch.items, model_time_sec)):
+        output_rows[batch.offset:batch.offset + len(batch_output_rows)] = batch_output_rows
+        model_calls += 1
+    return model_calls
+
+
+def _benchmark(name: str, run_function, rows, batch_size: int, model_time_sec: float) -> dict:
+    start_time = time.perf_counter()
+    model_calls = run_function(rows, batch_size, model_time_sec)
+    total_time = time.perf_counter() - start_time
+    overhead = total_time - model_calls * model_time_sec
+    return {
+        'name': name,
+        'model_calls': model_calls,
+        'total_ms': 1000 * total_time,
+        'overhead_per_batch_ms': 1000 * overhead / model_calls,
+    }
+
+
+@click.command()
+@click.option('--rows', default=100000, help="number of rows")
+@click.option('--batch-size', default=500, help="batch size, by default the rows divide evenly into batches")
+@click.option('--model-ms', default=5.0, help="simulated model time per batch")
+def main(rows: int, batch_size: int, model_ms: float):
+    """
+    Compares the per batch overhead of the sequential batch loop and the streaming batch iterator
+    """
+    input_rows = [InputRow(idx=i, text=f"text {i}") for i in range(rows)]
+    results = [
+        _benchmark('sequential', _run_sequential, input_rows, batch_size, model_ms / 1000),
+        _benchmark('streaming', _run_streaming, input_rows, batch_size, model_ms / 1000),
+    ]
+    for result in results:
+        logger.info(f"{result['name']}: model calls: {result['model_calls']}, total: {result['total_ms']:.1f} ms, "
+                    f"overhead per batch: {result['overhead_per_batch_ms']:.3f} ms")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
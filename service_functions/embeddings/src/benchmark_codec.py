@@ -0,0 +1,87 @@
+import json
+import random
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+
+from codec import create_codec, decode_request, encode_response, get_available_codecs
+from embedding_formats import ARRAY, EMBEDDING_OUTPUT_FORMATS, encode_embeddings
+from spcs_utils import init_logger
+
+logger = init_logger("CodecBenchmark")
+
+
+def _get_words():
+    with open(Path(__file__).parent.parent.joinpath('english_words.txt')) as f:
+        return [line.strip() for line in f]
+
+
+def _measure_ms(function, repeats: int) -> float:
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return 1000 * (time.perf_counter() - start_time) / repeats
+
+
+def _baseline_decode(body: bytes):
+    # the previous request path: stdlib json and one list per row
+    data = json.loads(body)['data']
+    return [row[0] for row in data], [row[1] for row in data]
+
+
+def _baseline_encode(idx, outputs) -> bytes:
+    return json.dumps({'data': [[i, output] for i, output in zip(idx, outputs)]}).encode('utf-8')
+
+
+@click.command()
+@click.option('--rows', default=1024, help="rows per request, the service function MAX_BATCH_ROWS")
+@click.option('--words', default=30, help="words per text")
+@click.option('--hidden-size', default=768, help="embedding dimension")
+@click.option('--repeats', default=5, help="number of repeats per measurement")
+def main(rows: int, words: int, hidden_size: int, repeats: int):
+    """
+    Compares request decoding and response encoding time and payload sizes of the available json codecs
+    """
+    random.seed(0)
+    vocabulary = _get_words()
+    texts = [" ".join(random.choice(vocabulary) for _ in range(words)) for _ in range(rows)]
+    request_body = json.dumps({'data': [[i, text] for i, text in enumerate(texts)]}).encode('utf-8')
+    idx = list(range(rows))
+    embeddings = np.random.default_rng(0).standard_normal((rows, hidden_size)).astype(np.float16).astype(np.float32)
+
+    results = []
+    encoded_outputs = {fmt: encode_embeddings(embeddings, fmt) for fmt in EMBEDDING_OUTPUT_FORMATS}
+    results.append({
+        'codec': 'baseline',
+        'request_bytes': len(request_body),
+        'decode_ms': _measure_ms(lambda: _baseline_decode(request_body), repeats),
+        'responses': {fmt: {
+            'encode_ms': _measure_ms(lambda: _baseline_encode(idx, encode_embeddings(embeddings, fmt)), repeats),
+            'bytes': len(_baseline_encode(idx, encoded_outputs[fmt])),
+        } for fmt in EMBEDDING_OUTPUT_FORMATS},
+    })
+    for codec_name in get_available_codecs():
+        codec = create_codec(codec_name)
+        responses = {}
+        for fmt in EMBEDDING_OUTPUT_FORMATS:
+            if fmt == ARRAY and codec.supports_numpy:
+                encode = lambda: encode_response(codec, idx, embeddings)
+            else:
+                encode = lambda: encode_response(codec, idx, encode_embeddings(embeddings, fmt))
+            responses[fmt] = {'encode_ms': _measure_ms(encode, repeats), 'bytes': len(encode())}
+        results.append({
+            'codec': codec_name,
+            'request_bytes': len(request_body),
+            'decode_ms': _measure_ms(lambda: decode_request(codec, request_body), repeats),
+            'responses': responses,
+        })
+    for result in results:
+        logger.info(f"codec: {result['codec']}, decode: {result['decode_ms']:.2f} ms, " + ", ".join(
+            f"{fmt}: {r['encode_ms']:.1f} ms / {r['bytes'] / 1024:.0f} KiB" for fmt, r in result['responses'].items()))
+    print(json.dumps({'rows': rows, 'hidden_size': hidden_size, 'results': results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import json
+import time
+
+import click
+import numpy as np
+
+from embedding_formats import EMBEDDING_OUTPUT_FORMATS, encode_embeddings
+from spcs_utils import init_logger
+
+logger = init_logger("EmbeddingFormatsBenchmark")
+
+
+def _benchmark_format(embeddings: np.ndarray, output_format: str, repeats: int) -> dict:
+    encode_time, serialize_time, payload_size = 0.0, 0.0, 0
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        outputs = encode_embeddings(embeddings, output_format)
+        encode_time += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        payload = json.dumps({'data': [[idx, output] for idx, output in enumerate(outputs)]})
+        serialize_time += time.perf_counter() - start_time
+        payload_size = len(payload)
+    return {
+        'format': output_format,
+        'encode_ms': 1000 * encode_time / repeats,
+        'json_ms': 1000 * serialize_time / repeats,
+        'total_ms': 1000 * (encode_time + serialize_time) / repeats,
+        'payload_bytes': payload_size,
+    }
+
+
+@click.command()
+@click.option('--rows', default=1000, help="number of embeddings per response")
+@click.option('--hidden-size', default=768, help="embedding dimension")
+@click.option('--repeats', default=5, help="number of repeats per format")
+def main(rows: int, hidden_size: int, repeats: int):
+    """
+    Compares the serialization cost of the embedding output formats per response of `rows` embeddings
+    """
+    embeddings = np.random.default_rng(0).standard_normal((rows, hidden_size)).astype(np.float16).astype(np.float32)
+    results = [_benchmark_format(embeddings, output_format, repeats) for output_format in EMBEDDING_OUTPUT_FORMATS]
+    for result in results:
+        logger.info(f"format: {result['format']}, encode: {result['encode_ms']:.1f} ms, "
+                    f"json: {result['json_ms']:.1f} ms, total: {result['total_ms']:.1f} ms, "
+                    f"payload: {result['payload_bytes'] / 1024:.0f} KiB")
+    print(json.dumps({'rows': rows, 'hidden_size': hidden_size, 'results': results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import json
+import time
+
+import click
+import numpy as np
+import torch
+
+from pooling import POOLING_METHODS, pool_embeddings
+from spcs_utils import init_logger
+
+logger = init_logger("PoolingBenchmark")
+
+
+def _synchronize(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def _measure_ms(function, device: torch.device, repeats: int) -> float:
+    function()
+    _synchronize(device)
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    _synchronize(device)
+    return 1000 * (time.perf_counter() - start_time) / repeats
+
+
+def _baseline(hidden_states: torch.Tensor) -> np.ndarray:
+    # the previous path: the hf feature-extraction pipeline copied the whole hidden state tensor to nested lists
+    # and the CLS embedding was taken on the host
+    nested = hidden_states.float().cpu().numpy().tolist()
+    return np.array([row[0] for row in nested], dtype=np.float32)
+
+
+@click.command()
+@click.option('--batch-size', default=128, help="rows per model batch")
+@click.option('--sequence-length', default=256, help="padded tokens per row")
+@click.option('--hidden-size', default=768, help="embedding dimension")
+@click.option('--repeats', default=10, help="number of repeats per measurement")
+def main(batch_size: int, sequence_length: int, hidden_size: int, repeats: int):
+    """
+    Compares the device to host transfer time and size of the full hidden states to the embeddings pooled on the device
+    """
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    dtype = torch.float16 if device.type == 'cuda' else torch.float32
+    generator = torch.Generator().manual_seed(0)
+    hidden_states = torch.randn(batch_size, sequence_length, hidden_size, generator=generator).to(device, dtype)
+    lengths = torch.randint(1, sequence_length + 1, (batch_size,), generator=generator)
+    attention_mask = (torch.arange(sequence_length).unsqueeze(0) < lengths.unsqueeze(1)).long().to(device)
+
+    results = [{
+        'method': 'baseline_cls_on_host',
+        'ms': _measure_ms(lambda: _baseline(hidden_states), device, repeats),
+        'host_bytes': hidden_states.numel() * 4,
+    }]
+    for pooling in POOLING_METHODS:
+        for normalize in (False, True):
+            pool = lambda: pool_embeddings(hidden_states, attention_mask, pooling, normalize).cpu().numpy()
+            results.append({
+                'method': f"{pooling}{'_normalized' if normalize else ''}",
+                'ms': _measure_ms(pool, device, repeats),
+                'host_bytes': batch_size * hidden_size * 4,
+            })
+    for result in results:
+        logger.info(f"{result['method']}: {result['ms']:.2f} ms, "
+                    f"copied to host: {result['host_bytes'] / 2 ** 20:.2f} MiB")
+    print(json.dumps({'device': str(device), 'batch_size': batch_size, 'sequence_length': sequence_length,
+                      'hidden_size': hidden_size, 'results': results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
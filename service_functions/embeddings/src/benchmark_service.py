@@ -0,0 +1,181 @@
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import click
+import httpx
+import numpy as np
+import toml
+
+from spcs_utils import init_logger, load_toml_config
+
+logger = init_logger("ServiceBenchmark")
+
+_TINY_MODEL = 'prajjwal1/bert-tiny'
+
+
+def _get_words() -> List[str]:
+    with open(Path(__file__).parent.parent.joinpath('english_words.txt')) as f:
+        return [line.strip() for line in f]
+
+
+class TrafficGenerator:
+    """
+    Synthetic service function requests, {"data": [[idx, text], ...]}, with random texts of english words
+    """
+
+    def __init__(self, rows_per_request: int, min_words: int, max_words: int, length_distribution: str, seed: int):
+        self._rows_per_request = rows_per_request
+        self._min_words = min_words
+        self._max_words = max_words
+        self._length_distribution = length_distribution
+        self._random = random.Random(seed)
+        self._vocabulary = _get_words()
+
+    def _get_num_words(self) -> int:
+        if self._length_distribution == 'lognormal':
+            # many short texts and a long tail, closer to real text columns than uniform lengths
+            median = max(self._min_words, (self._min_words + self._max_words) / 4)
+            num_words = int(self._random.lognormvariate(np.log(median), 0.75))
+        else:
+            num_words = self._random.randint(self._min_words, self._max_words)
+        return min(max(num_words, self._min_words), self._max_words)
+
+    def create_request(self) -> bytes:
+        rows = [[i, ' '.join(self._random.choices(self._vocabulary, k=self._get_num_words()))]
+                for i in range(self._rows_per_request)]
+        return json.dumps({'data': rows}).encode('utf-8')
+
+
+async def _run_client(client: httpx.AsyncClient, route: str, bodies: List[bytes], deadline: float,
+                      results: List[tuple]):
+    while bodies and time.perf_counter() < deadline:
+        body = bodies.pop()
+        start_time = time.perf_counter()
+        try:
+            response = await client.post(route, content=body, headers={'Content-Type': 'application/json'})
+            status = response.status_code
+        except httpx.HTTPError as e:
+            logger.debug(f"Request failed: {e!r}")
+            status = 0
+        results.append((status, time.perf_counter() - start_time))
+
+
+async def _run_load(client: httpx.AsyncClient, route: str, traffic: TrafficGenerator, num_requests: int,
+                    concurrency: int, duration_sec: float, warmup_requests: int, rows_per_request: int) -> dict:
+    for _ in range(warmup_requests):
+        response = await client.post(route, content=traffic.create_request(),
+                                     headers={'Content-Type': 'application/json'})
+        response.raise_for_status()
+    # bodies are generated up front, so the generation time doesn't count as latency
+    bodies = [traffic.create_request() for _ in range(num_requests)]
+    results = []
+    start_time = time.perf_counter()
+    await asyncio.gather(*[_run_client(client, route, bodies, start_time + duration_sec, results)
+                           for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start_time
+    return _summarize(results, elapsed, rows_per_request)
+
+
+def _summarize(results: List[tuple], elapsed: float, rows_per_request: int) -> dict:
+    statuses = [status for status, _ in results]
+    ok_latencies = np.array([latency for status, latency in results if status == 200]) * 1000
+    num_ok = len(ok_latencies)
+    summary = {
+        'requests': len(results),
+        'elapsed_sec': elapsed,
+        'status_counts': {str(status): statuses.count(status) for status in sorted(set(statuses))},
+        'rows_per_sec': num_ok * rows_per_request / elapsed if elapsed > 0 else 0.0,
+        'requests_per_sec': num_ok / elapsed if elapsed > 0 else 0.0,
+        'throttled_rate': statuses.count(429) / len(results) if results else 0.0,
+        'error_rate': sum(1 for status in statuses if status not in (200, 429)) / len(results) if results else 0.0,
+    }
+    if num_ok:
+        summary['latency_ms'] = {
+            'mean': float(np.mean(ok_latencies)),
+            'p50': float(np.percentile(ok_latencies, 50)),
+            'p95': float(np.percentile(ok_latencies, 95)),
+            'p99': float(np.percentile(ok_latencies, 99)),
+            'max': float(np.max(ok_latencies)),
+        }
+    return summary
+
+
+def _create_local_config(embedding_model: Optional[str], classifier_model: Optional[str]) -> str:
+    """
+    Writes a copy of config.toml with the benchmark models, used by the in-process app
+    """
+    config = load_toml_config()
+    if embedding_model:
+        config['general']['embedding_model_name'] = embedding_model
+        config['general']['embedding_tokenizer_name'] = embedding_model
+    if classifier_model:
+        config['general']['classifier_model_name'] = classifier_model
+    fd, config_path = tempfile.mkstemp(suffix='.toml', prefix='benchmark_config_')
+    with os.fdopen(fd, 'w') as f:
+        toml.dump(config, f)
+    return config_path
+
+
+async def _benchmark_in_process(route: str, **kwargs) -> dict:
+    # imported here, the app reads CONFIG_PATH and starts the metrics of the worker on import
+    from async_app import app
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url='http://benchmark', timeout=None) as client:
+            return await _run_load(client, route, **kwargs)
+
+
+async def _benchmark_url(url: str, route: str, **kwargs) -> dict:
+    async with httpx.AsyncClient(base_url=url, timeout=None) as client:
+        return await _run_load(client, route, **kwargs)
+
+
+@click.command()
+@click.option('--url', default=None, help="url of a running service, e.g. http://localhost:9000, "
+                                          "the app is started in-process if not set")
+@click.option('--route', default='/extract_embeddings', help="route to benchmark, e.g. /classify_texts")
+@click.option('--requests', 'num_requests', default=200, help="max number of requests")
+@click.option('--duration', 'duration_sec', default=60.0, help="max duration in seconds")
+@click.option('--concurrency', default=8, help="number of concurrent clients")
+@click.option('--rows', 'rows_per_request', default=64, help="rows per request, the service function MAX_BATCH_ROWS")
+@click.option('--min-words', default=1, help="min words per text")
+@click.option('--max-words', default=64, help="max words per text")
+@click.option('--length-distribution', type=click.Choice(['uniform', 'lognormal']), default='uniform',
+              help="distribution of the number of words per text")
+@click.option('--warmup-requests', default=2, help="requests sent before the measurement")
+@click.option('--embedding-model', default=_TINY_MODEL, help="embedding model of the in-process app")
+@click.option('--classifier-model', default=_TINY_MODEL, help="classifier model of the in-process app")
+@click.option('--seed', default=0, help="seed of the synthetic texts")
+def main(url: Optional[str], route: str, num_requests: int, duration_sec: float, concurrency: int,
+         rows_per_request: int, min_words: int, max_words: int, length_distribution: str, warmup_requests: int,
+         embedding_model: str, classifier_model: str, seed: int):
+    """
+    Replays synthetic service function traffic against the service and reports latency percentiles,
+    throughput and the rate of throttled requests as json
+    """
+    traffic = TrafficGenerator(rows_per_request, min_words, max_words, length_distribution, seed)
+    kwargs = dict(traffic=traffic, num_requests=num_requests, concurrency=concurrency, duration_sec=duration_sec,
+                  warmup_requests=warmup_requests, rows_per_request=rows_per_request)
+    if url:
+        summary = asyncio.run(_benchmark_url(url, route, **kwargs))
+    else:
+        os.environ['CONFIG_PATH'] = _create_local_config(embedding_model, classifier_model)
+        try:
+            summary = asyncio.run(_benchmark_in_process(route, **kwargs))
+        finally:
+            os.remove(os.environ.pop('CONFIG_PATH'))
+    summary.update({'target': url or 'in-process', 'route': route, 'concurrency': concurrency,
+                    'rows_per_request': rows_per_request, 'length_distribution': length_distribution})
+    logger.info(f"requests: {summary['requests']}, rows/s: {summary['rows_per_sec']:.1f}, "
+                f"latency: {summary.get('latency_ms')}, throttled: {summary['throttled_rate']:.1%}")
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import json
+import random
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+import torch
+
+from feature_extractor import get_embedding_pipeline, compute_embeddings
+from spcs_utils import init_logger, load_toml_config, get_compute_pool_type, create_model_configuration
+from token_batching import get_max_length, plan_token_batches
+
+logger = init_logger("TokenBatchingBenchmark")
+
+
+def _get_words():
+    with open(Path(__file__).parent.parent.joinpath('english_words.txt')) as f:
+        return [line.strip() for line in f]
+
+
+def _get_random_phrases(words, num_rows: int, max_words: int, long_ratio: float):
+    # mostly short phrases with a tail of long ones, the mix that makes fixed size batches pad the most
+    phrases = []
+    for _ in range(num_rows):
+        num_words = random.randint(1, max_words) if random.random() < long_ratio else random.randint(1, 20)
+        phrases.append(" ".join(random.choice(words) for _ in range(num_words)))
+    return phrases
+
+
+def _padded_tokens(lengths, batches) -> int:
+    return sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+
+
+def _run_fixed_batches(embedding_pipeline, texts, batch_size: int):
+    model, tokenizer = embedding_pipeline.model, embedding_pipeline.tokenizer
+    max_length = get_max_length(tokenizer, model)
+    with torch.inference_mode():
+        for i in range(0, len(texts), batch_size):
+            inputs = tokenizer(texts[i:i + batch_size], padding=True, truncation=True, max_length=max_length,
+                               return_tensors='pt').to(embedding_pipeline.device)
+            model(**inputs).last_hidden_state[:, 0].float().cpu().numpy()
+
+
+@click.command()
+@click.option('--rows', default=2048, help="number of texts")
+@click.option('--max-words', default=400, help="max number of words of the long texts")
+@click.option('--long-ratio', default=0.05, help="ratio of the long texts")
+@click.option('--batch-size', type=int, help="max rows per batch, defaults to the compute pool config")
+@click.option('--max-tokens', type=int, help="max tokens per batch, defaults to the compute pool config")
+@click.option('--skip-model', is_flag=True, help="only compare the number of padded tokens, skip the model runs")
+def main(rows: int, max_words: int, long_ratio: float, batch_size: int, max_tokens: int, skip_model: bool):
+    """
+    Compares fixed size arrival order batches with token length bucketed batches
+    """
+    random.seed(0)
+    config = load_toml_config()
+    compute_pool_config = config["compute_pool"][get_compute_pool_type()]
+    batch_size = batch_size or compute_pool_config['batch_size']
+    max_tokens = max_tokens or compute_pool_config.get('max_tokens_per_batch')
+    model_configuration = create_model_configuration(config)
+    texts = _get_random_phrases(_get_words(), rows, max_words, long_ratio)
+
+    embedding_pipeline = get_embedding_pipeline(batch_size, model_configuration)
+    tokenizer = embedding_pipeline.tokenizer
+    max_length = get_max_length(tokenizer, embedding_pipeline.model)
+    lengths = [len(input_ids) for input_ids in tokenizer(texts, truncation=True, max_length=max_length)['input_ids']]
+    fixed_batches = [np.arange(i, min(i + batch_size, rows)) for i in range(0, rows, batch_size)]
+    bucketed_batches = plan_token_batches(lengths, batch_size, max_tokens)
+    result = {
+        'rows': rows,
+        'batch_size': batch_size,
+        'max_tokens': max_tokens,
+        'tokens': int(sum(lengths)),
+        'fixed': {'batches': len(fixed_batches), 'padded_tokens': _padded_tokens(lengths, fixed_batches)},
+        'bucketed': {'batches': len(bucketed_batches), 'padded_tokens': _padded_tokens(lengths, bucketed_batches)},
+    }
+    if not skip_model:
+        # warmup
+        compute_embeddings(texts[:batch_size], batch_size, model_configuration, max_tokens)
+        start_time = time.time()
+        _run_fixed_batches(embedding_pipeline, texts, batch_size)
+        result['fixed']['rows_per_sec'] = rows / (time.time() - start_time)
+        start_time = time.time()
+        compute_embeddings(texts, batch_size, model_configuration, max_tokens)
+        result['bucketed']['rows_per_sec'] = rows / (time.time() - start_time)
+    logger.info(f"padded tokens, fixed: {result['fixed']['padded_tokens']}, "
+                f"bucketed: {result['bucketed']['padded_tokens']}, real: {result['tokens']}")
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import os
+import tempfile
+from typing import List, Sequence
+
+from spcs_utils import init_logger
+
+logger = init_logger("Checkpoint")
+
+_MARKER_SUFFIX = '.done'
+
+
+class CheckpointManifest:
+    """
+    Records the processed input files as empty marker files on the stage, one per input file.
+
+    A marker is written only after the output of the file is uploaded, so it is the commit of the output: after a
+    restart, files with a marker are skipped and all other files are processed again, their outputs overwritten.
+    The marker name holds the md5 of the input file from LIST, a changed input file is processed again.
+    """
+
+    def __init__(self, manifest_path: str):
+        """
+        :param manifest_path: stage path of the markers, e.g. $stage_name/$stage_output_path/_manifest
+        """
+        self._manifest_path = manifest_path
+        self._completed = set()
+
+    def load(self, cur):
+        cur.execute(f"LIST @{self._manifest_path}/")
+        self._completed = {os.path.basename(row[0]) for row in cur.fetchall()}
+        logger.info(f"Loaded {len(self._completed)} completed files from the manifest: {self._manifest_path}")
+
+    def is_completed(self, stage_file_metadata) -> bool:
+        return get_marker_name(stage_file_metadata) in self._completed
+
+    def get_pending_files(self, stage_files_metadata: Sequence) -> List:
+        pending_files = [f for f in stage_files_metadata if not self.is_completed(f)]
+        logger.info(f"Skipping {len(stage_files_metadata) - len(pending_files)} completed files, "
+                    f"pending: {len(pending_files)}")
+        return pending_files
+
+    def commit(self, cur, stage_file_metadata):
+        """
+        Marks the input file as completed, must be called after its output is uploaded
+        """
+        marker_name = get_marker_name(stage_file_metadata)
+        with tempfile.TemporaryDirectory() as local_dir:
+            local_marker = os.path.join(local_dir, marker_name)
+            open(local_marker, 'wb').close()
+            cur.execute(f"PUT file://{local_marker} @{self._manifest_path} AUTO_COMPRESS=FALSE OVERWRITE=TRUE")
+        self._completed.add(marker_name)
+
+
+def get_marker_name(stage_file_metadata) -> str:
+    filepath, size, md5, date = stage_file_metadata
+    return f"{os.path.basename(filepath)}.{md5}{_MARKER_SUFFIX}"
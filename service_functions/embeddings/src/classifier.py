@@ -1,50 +1,111 @@
 import os
-from typing import List
+from functools import partial
+from typing import Dict, List, Optional
 
+import numpy as np
 import torch
-from transformers import pipeline, AutoModelForSequenceClassification, AutoTokenizer
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
 
-from spcs_utils import init_logger, InputRow, OutputRow, ModelConfiguration
+from backends import create_inference_pipeline
+from classifier_formats import pack_top_k
+from model_cache import from_pretrained
+from model_registry import model_registry
+from spcs_utils import init_logger, ModelConfiguration, map_batches_ahead, BatchExecutor, iter_timed, timed, TOKENIZE, \
+    FORWARD
+from token_batching import TokenBatch, get_max_length, iter_token_batches
 
 logger = init_logger("TextClassifier")
 
-classifier_pipeline = None
+# forward passes of every call run on the same thread, one pool per process
+_forward_executor = BatchExecutor(thread_name_prefix='classifier_forward')
 
+_TOP_K = 2
 
-def run_classifier(rows: List[InputRow], batch_size: int, model_config: ModelConfiguration) -> List[OutputRow]:
+
+def classify(texts: List[str], batch_size: int, model_config: ModelConfiguration,
+             max_tokens: Optional[int] = None, timings: Optional[Dict[str, float]] = None) -> np.ndarray:
     """
-    Main function that uses model and tokenizer to produce text classification
-    :param rows: List of input rows
-    :param batch_size: Batch size that will be used by the hf pipeline
+    Classifies the texts
+    :param texts: List of input texts
+    :param batch_size: Max number of rows in a single model batch
     :param model_config: model and tokenizer config
-    :return: --
+    :param max_tokens: Max number of padded tokens in a single model batch, None means no limit
+    :param timings: tokenization and model forward times are added to it, in seconds
+    :return: top k label ids and scores of every text packed by `pack_top_k`, in the order of the texts,
+        see `encode_classifications`
+    """
+    return _execute_inference(get_classifier_pipeline(batch_size, model_config), texts, batch_size, max_tokens,
+                              timings, _TOP_K)
+
+
+def get_labels(batch_size: int, model_config: ModelConfiguration) -> List[str]:
+    """
+    Label names of the classifier by label id
+    """
+    config = get_classifier_pipeline(batch_size, model_config).model.config
+    return [config.id2label[i] for i in range(config.num_labels)]
+
+
+def compute_scores(texts: List[str], batch_size: int, model_config: ModelConfiguration,
+                   max_tokens: Optional[int] = None) -> np.ndarray:
+    """
+    Scores of all labels of the texts
+    :return: float32 matrix of [len(texts), num_labels], in the order of the texts
     """
-    texts = [row.text for row in rows]
-    global classifier_pipeline
-    if classifier_pipeline is None:
-        classifier_pipeline = _create_classifier_pipeline(_get_cuda_device(), batch_size, model_config)
-    classifier_outputs = classifier_pipeline(texts)
-    max_scores_outputs = []
-    for output_list in classifier_outputs:
-        max_scores_outputs.append(str(output_list))
-    return [OutputRow(idx=rows[idx].idx, output=max_scores_outputs[idx]) for idx in range(len(max_scores_outputs))]
+    return _execute_inference(get_classifier_pipeline(batch_size, model_config), texts, batch_size, max_tokens)
+
+
+def _execute_inference(classifier_pipeline, texts: List[str], batch_size: int,
+                       max_tokens: Optional[int] = None, timings: Optional[Dict[str, float]] = None,
+                       top_k: Optional[int] = None) -> np.ndarray:
+    model, tokenizer = classifier_pipeline.model, classifier_pipeline.tokenizer
+    num_labels = model.config.num_labels
+    top_k = None if top_k is None else min(top_k, num_labels)
+    scores = np.empty((len(texts), num_labels if top_k is None else 2 * top_k), dtype=np.float32)
+    # texts are tokenized once and batched by token length, so short texts are not padded to the longest one
+    token_batches = iter_timed(
+        iter_token_batches(tokenizer, texts, batch_size, max_tokens, get_max_length(tokenizer, model)),
+        timings, TOKENIZE)
+    # the next batch is padded and the outputs of the previous one are stored while the model runs
+    forward = timed(partial(_forward, model, classifier_pipeline.device, top_k), timings, FORWARD)
+    for token_batch, batch_scores in map_batches_ahead(token_batches, forward, executor=_forward_executor):
+        scores[token_batch.indices] = batch_scores
+    return scores
+
+
+def _forward(model, device, top_k: Optional[int], token_batch: TokenBatch) -> np.ndarray:
+    with torch.inference_mode():
+        inputs = {key: value.to(device) for key, value in token_batch.inputs.items()}
+        logits = model(**inputs).logits.float()
+        # same score function as the hf text-classification pipeline
+        if model.config.problem_type == 'multi_label_classification' or model.config.num_labels == 1:
+            scores = torch.sigmoid(logits)
+        else:
+            scores = torch.softmax(logits, dim=-1)
+        if top_k is None:
+            return scores.cpu().numpy()
+        # top k on the device, only [batch, k] ids and scores are copied to the host
+        top_scores, top_ids = torch.topk(scores, top_k, dim=-1)
+        return pack_top_k(top_ids.cpu().numpy(), top_scores.cpu().numpy())
+
+
+def get_classifier_pipeline(batch_size: int, model_config: ModelConfiguration):
+    """
+    Returns the classifier pipeline of the model config, the pipeline is loaded on first use
+    """
+    key = ('text-classification', model_config.classifier_model_name, model_config.inference_backend)
+    return model_registry.get(key, partial(_create_classifier_pipeline, _get_cuda_device(), batch_size, model_config))
 
 
 def _create_classifier_pipeline(device: int, batch_size: int, model_config: ModelConfiguration):
     num_gpus = torch.cuda.device_count()
     logger.info(f"Creating classifier pipeline on worker: {os.getpid()}, available gpus: {num_gpus}")
 
-    model = AutoModelForSequenceClassification.from_pretrained(model_config.classifier_model_name)
-    tokenizer = AutoTokenizer.from_pretrained(model_config.classifier_model_name)
-
-    classifier = pipeline(
-        "text-classification",
-        model=model,
-        tokenizer=tokenizer,
-        top_k=2,
-        device=torch.device(f"cuda:{device}" if torch.cuda.is_available() else "cpu"),
-        batch_size=batch_size)
-    return classifier
+    model = from_pretrained(AutoModelForSequenceClassification, model_config.classifier_model_name)
+    tokenizer = from_pretrained(AutoTokenizer, model_config.classifier_model_name)
+
+    return create_inference_pipeline(model, tokenizer, model_config.inference_backend, device, 'logits',
+                                     model_config.classifier_model_name)
 
 
 def _get_cuda_device() -> int:
@@ -0,0 +1,59 @@
+import json
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+TEXT = 'text'
+IDS = 'ids'
+OBJECT = 'object'
+
+CLASSIFIER_OUTPUT_FORMATS = [TEXT, IDS, OBJECT]
+
+
+def pack_top_k(label_ids: np.ndarray, scores: np.ndarray) -> np.ndarray:
+    """
+    Packs the top k label ids and scores of every row into a single float32 [rows, 2 * k] matrix, so top k results
+    are batched, cached and concatenated like embeddings. Label ids are exact in float32 up to 2 ** 24.
+    :param label_ids: [rows, k] label ids, highest score first
+    :param scores: [rows, k] scores of the labels
+    """
+    return np.concatenate([label_ids.astype(np.float32), scores.astype(np.float32)], axis=1)
+
+
+def unpack_top_k(top_k: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :param top_k: [rows, 2 * k] matrix created by `pack_top_k`
+    :return: int32 [rows, k] label ids and float32 [rows, k] scores
+    """
+    k = top_k.shape[1] // 2
+    return top_k[:, :k].astype(np.int32), top_k[:, k:]
+
+
+def encode_classifications(top_k: np.ndarray, labels: Sequence[str], output_format: str) -> List:
+    """
+    Converts the top k matrix to per row values that can be sent in the service function response
+    :param top_k: [rows, 2 * k] matrix created by `pack_top_k`
+    :param labels: label names by label id
+    :param output_format: one of CLASSIFIER_OUTPUT_FORMATS
+        * text - string of the list of {'label': ..., 'score': ...} dicts, the original output format
+        * ids - [[label ids], [scores]], the label names are sent once per response in the label table
+        * object - {label: score}, can be returned as Snowflake OBJECT
+    :return: list of encoded classifications
+    """
+    label_ids, scores = unpack_top_k(top_k)
+    if output_format == IDS:
+        return [[row_ids, row_scores] for row_ids, row_scores in zip(label_ids.tolist(), scores.tolist())]
+    if output_format == OBJECT:
+        return [dict(zip([labels[i] for i in row_ids], row_scores))
+                for row_ids, row_scores in zip(label_ids.tolist(), scores.tolist())]
+    if output_format == TEXT:
+        return [str([{'label': labels[i], 'score': score} for i, score in zip(row_ids, row_scores)])
+                for row_ids, row_scores in zip(label_ids.tolist(), scores.tolist())]
+    raise ValueError(f"Unknown classifier output format: {output_format}, supported: {CLASSIFIER_OUTPUT_FORMATS}")
+
+
+def encode_label_table(labels: Sequence[str]) -> str:
+    """
+    Label names by label id of the ids format, e.g. stored once per output file
+    """
+    return json.dumps(list(labels))
@@ -0,0 +1,163 @@
+import json
+from dataclasses import dataclass
+from typing import Any, List, Optional, Sequence
+
+import numpy as np
+
+from spcs_utils import init_logger
+
+logger = init_logger("Codec")
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+AUTO = 'auto'
+ORJSON = 'orjson'
+MSGSPEC = 'msgspec'
+JSON = 'json'
+
+
+class InvalidRequestError(ValueError):
+    pass
+
+
+@dataclass
+class ServiceFunctionRequest:
+    """
+    Rows of a service function request as two columns
+    """
+    idx: List[int]
+    texts: List[str]
+
+    def __len__(self) -> int:
+        return len(self.idx)
+
+
+def _to_json_compatible(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Type is not JSON serializable: {type(value)}")
+
+
+class JsonCodec:
+    """
+    Standard library json, always available
+    """
+    name = JSON
+    supports_numpy = False
+
+    @staticmethod
+    def loads(body: bytes) -> Any:
+        return json.loads(body)
+
+    @staticmethod
+    def dumps(value: Any) -> bytes:
+        return json.dumps(value, separators=(',', ':'), default=_to_json_compatible).encode('utf-8')
+
+
+class OrjsonCodec:
+    """
+    orjson, serializes numpy arrays natively, without converting them to lists of python floats
+    """
+    name = ORJSON
+    supports_numpy = True
+
+    @staticmethod
+    def loads(body: bytes) -> Any:
+        return orjson.loads(body)
+
+    @staticmethod
+    def dumps(value: Any) -> bytes:
+        return orjson.dumps(value, default=_to_json_compatible, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+class MsgspecCodec:
+    name = MSGSPEC
+    supports_numpy = False
+
+    def __init__(self):
+        self._decoder = msgspec.json.Decoder()
+        self._encoder = msgspec.json.Encoder(enc_hook=_to_json_compatible)
+
+    def loads(self, body: bytes) -> Any:
+        return self._decoder.decode(body)
+
+    def dumps(self, value: Any) -> bytes:
+        return self._encoder.encode(value)
+
+
+_CODECS = {
+    ORJSON: (lambda: orjson is not None, OrjsonCodec),
+    MSGSPEC: (lambda: msgspec is not None, MsgspecCodec),
+    JSON: (lambda: True, JsonCodec),
+}
+
+
+def get_available_codecs() -> List[str]:
+    return [name for name, (is_available, _) in _CODECS.items() if is_available()]
+
+
+def create_codec(name: str = AUTO):
+    """
+    :param name: orjson, msgspec, json or auto, the fastest available one
+    :return: codec with `loads`, `dumps` and `supports_numpy`, falls back to json if the requested library is not installed
+    """
+    if name == AUTO:
+        name = get_available_codecs()[0]
+    if name not in _CODECS:
+        raise ValueError(f"Unknown json codec: {name}, supported codecs: {[AUTO, *_CODECS.keys()]}")
+    is_available, codec_class = _CODECS[name]
+    if not is_available():
+        logger.warning(f"Json codec {name} is not installed, using {JSON}")
+        codec_class = JsonCodec
+    logger.info(f"Using json codec: {codec_class.name}")
+    return codec_class()
+
+
+def decode_request(codec, body: bytes) -> ServiceFunctionRequest:
+    """
+    Decodes the service function request body, {"data": [[idx, text], ...]}, into columns
+    :raises InvalidRequestError: if the body is not a valid service function request
+    """
+    try:
+        data = codec.loads(body)['data']
+        return ServiceFunctionRequest(idx=[row[0] for row in data], texts=[row[1] for row in data])
+    except Exception as e:
+        raise InvalidRequestError(f"Invalid service function request: {e}") from e
+
+
+def encode_response(codec, idx: Sequence[int], outputs: Sequence[Any], labels: Optional[List[str]] = None) -> bytes:
+    """
+    Encodes the service function response, {"data": [[idx, output], ...]}
+    :param idx: row numbers of the request
+    :param outputs: per row outputs, rows of a numpy matrix are written without conversion by the orjson codec
+    :param labels: label table of the classifier ids format, sent once per response next to the data
+    """
+    response = {'data': list(zip(idx, outputs))}
+    if labels is not None:
+        response['labels'] = labels
+    return codec.dumps(response)
+
+
+def encode_response_rows(codec, idx: Sequence[int], outputs: Sequence[Any]) -> bytes:
+    """
+    Encodes rows of the service function response without the enclosing brackets,
+    the chunks of a streamed response are joined with commas inside the {"data": [...]} envelope
+    """
+    return codec.dumps(list(zip(idx, outputs)))[1:-1]
+
+
+def encode_response_fields(codec, labels: Optional[List[str]] = None) -> bytes:
+    """
+    Encodes the fields of a streamed response that follow the data, e.g. b',"labels":[...]', empty if there are none
+    """
+    return b'' if labels is None else b',"labels":' + codec.dumps(labels)
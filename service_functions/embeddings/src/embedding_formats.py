@@ -0,0 +1,47 @@
+import base64
+from typing import List
+
+import numpy as np
+
+TEXT = 'text'
+ARRAY = 'array'
+BASE64_FLOAT32 = 'base64_float32'
+BASE64_FLOAT16 = 'base64_float16'
+
+EMBEDDING_OUTPUT_FORMATS = [TEXT, ARRAY, BASE64_FLOAT32, BASE64_FLOAT16]
+
+_BASE64_DTYPES = {
+    BASE64_FLOAT32: np.dtype('<f4'),
+    BASE64_FLOAT16: np.dtype('<f2'),
+}
+
+
+def encode_embeddings(embeddings: np.ndarray, output_format: str) -> List:
+    """
+    Converts a [rows, hidden] embeddings matrix to per row values that can be sent in the service function response
+    :param embeddings: embeddings matrix, one row per input text
+    :param output_format: one of EMBEDDING_OUTPUT_FORMATS
+        * text - space separated floats, the original output format
+        * array - list of floats, can be returned as Snowflake ARRAY and cast to VECTOR
+        * base64_float32/base64_float16 - base64 encoded little-endian floats
+    :return: list of encoded embeddings
+    """
+    if output_format == TEXT:
+        return [' '.join(map(str, row)) for row in embeddings.tolist()]
+    if output_format == ARRAY:
+        return embeddings.tolist()
+    if output_format in _BASE64_DTYPES:
+        data = np.ascontiguousarray(embeddings, dtype=_BASE64_DTYPES[output_format])
+        if data.size == 0:
+            return [''] * len(data)
+        row_bytes = data.shape[1] * data.itemsize
+        buffer = memoryview(data).cast('B')
+        return [base64.b64encode(buffer[i * row_bytes:(i + 1) * row_bytes]).decode('ascii') for i in range(len(data))]
+    raise ValueError(f"Unknown embedding output format: {output_format}, supported: {EMBEDDING_OUTPUT_FORMATS}")
+
+
+def decode_base64_embedding(value: str, output_format: str = BASE64_FLOAT32) -> np.ndarray:
+    """
+    Decodes a single base64 encoded embedding, useful on the client side
+    """
+    return np.frombuffer(base64.b64decode(value), dtype=_BASE64_DTYPES[output_format]).astype(np.float32)
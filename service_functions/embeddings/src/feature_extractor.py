@@ -1,30 +1,50 @@
 import os
-from typing import List
+from functools import partial
+from typing import Dict, List, Optional
 
+import numpy as np
 import torch
-from transformers import AutoTokenizer, AutoModel, pipeline
+from transformers import AutoTokenizer, AutoModel
 
-from spcs_utils import init_logger, InputRow, OutputRow, ModelConfiguration
+from backends import create_inference_pipeline
+from model_cache import from_pretrained
+from model_registry import model_registry
+from pooling import CLS, pool_embeddings
+from spcs_utils import init_logger, ModelConfiguration, map_batches_ahead, BatchExecutor, iter_timed, timed, TOKENIZE, \
+    FORWARD
+from token_batching import TokenBatch, get_max_length, iter_token_batches
 
 logger = init_logger("FeatureExtractor")
 
-embedding_pipeline = None
+# forward passes of every call run on the same thread, one pool per process
+_forward_executor = BatchExecutor(thread_name_prefix='embedding_forward')
 
+# max number of tokens of the tokenizer, texts are truncated to it or to the max positions of the model
+EMBEDDING_MAX_LENGTH = 4096
 
-def extract_embeddings(rows: List[InputRow], batch_size: int, model_config: ModelConfiguration) -> List[OutputRow]:
+
+def compute_embeddings(texts: List[str], batch_size: int, model_config: ModelConfiguration,
+                       max_tokens: Optional[int] = None, timings: Optional[Dict[str, float]] = None) -> np.ndarray:
     """
-    Main function that uses model and tokenizer to produce text embeddings
-    :param rows: List of input rows
-    :param batch_size: Batch size that will be used by the hf pipeline
+    Produces embeddings of the texts, pooled as set in the model config
+    :param texts: List of input texts
+    :param batch_size: Max number of rows in a single model batch
     :param model_config: model and tokenizer config
-    :return: List of embeddings
+    :param max_tokens: Max number of padded tokens in a single model batch, None means no limit
+    :param timings: tokenization and model forward times are added to it, in seconds
+    :return: float32 matrix of [len(texts), hidden_size], in the order of the texts
+    """
+    return _execute_inference(get_embedding_pipeline(batch_size, model_config), texts, batch_size, max_tokens,
+                              timings, model_config.embedding_pooling, model_config.embedding_normalize)
+
+
+def get_embedding_pipeline(batch_size: int, model_config: ModelConfiguration):
     """
-    texts = [row.text for row in rows]
-    global embedding_pipeline
-    if embedding_pipeline is None:
-        embedding_pipeline = _create_embedding_pipeline(_get_cuda_device(), batch_size, model_config)
-    result = _execute_inference(embedding_pipeline, texts)
-    return [OutputRow(idx=rows[idx].idx, output=result['outputs'][idx]) for idx in range(len(result['outputs']))]
+    Returns the embedding pipeline of the model config, the pipeline is loaded on first use
+    """
+    key = ('feature-extraction', model_config.embedding_model_name, model_config.embedding_tokenizer_name,
+           model_config.inference_backend)
+    return model_registry.get(key, partial(_create_embedding_pipeline, _get_cuda_device(), batch_size, model_config))
 
 
 def _create_embedding_pipeline(device: int, batch_size: int, model_config: ModelConfiguration):
@@ -32,22 +52,12 @@ def _create_embedding_pipeline(device: int, batch_size: int, model_config: Model
     logger.info(
         f"Creating embedding pipeline on worker: {os.getpid()}, available gpus: {num_gpus}")
 
-    tokenizer = AutoTokenizer.from_pretrained(model_config.embedding_model_name, padding=True, truncation=True,
-                                              return_tensors='pt', model_max_length=4096,
-                                              force_download=False)
-    model = AutoModel.from_pretrained(model_config.embedding_tokenizer_name, trust_remote_code=True,
-                                      force_download=False)
-    # use fp16
-    model = model.half()
-
-    embedding_pipeline = pipeline(
-        "feature-extraction",
-        model=model,
-        tokenizer=tokenizer,
-        device=torch.device(f"cuda:{device}" if torch.cuda.is_available() else "cpu"),
-        batch_size=batch_size,
-    )
-    return embedding_pipeline
+    tokenizer = from_pretrained(AutoTokenizer, model_config.embedding_model_name, padding=True, truncation=True,
+                                return_tensors='pt', model_max_length=EMBEDDING_MAX_LENGTH)
+    model = from_pretrained(AutoModel, model_config.embedding_tokenizer_name, trust_remote_code=True)
+    # fp16 on GPU, fp32, int8 or onnx runtime on CPU, depending on the backend of the compute pool
+    return create_inference_pipeline(model, tokenizer, model_config.inference_backend, device, 'last_hidden_state',
+                                     model_config.embedding_model_name)
 
 
 def _get_cuda_device() -> int:
@@ -58,16 +68,26 @@ def _get_cuda_device() -> int:
     return 0
 
 
-def _generate_embedding_sync(embedding_pipeline, input_texts: list):
-    result = _execute_inference(embedding_pipeline, input_texts)
-    return result['outputs']
-
-
-def _execute_inference(embedding_pipeline, input_batch: list):
-    results = dict(inputs=[], outputs=[], index=0)
-    embeddings = embedding_pipeline(input_batch, truncation=True)
-    outputs = [' '.join(map(str, embedding[0][0])) for embedding in embeddings]
-    results["inputs"].extend(input_batch)
-    results["outputs"].extend(outputs)
-    results["index"] = 0
-    return results
+def _execute_inference(embedding_pipeline, input_batch: list, batch_size: int,
+                       max_tokens: Optional[int] = None, timings: Optional[Dict[str, float]] = None,
+                       pooling: str = CLS, normalize: bool = False) -> np.ndarray:
+    model, tokenizer = embedding_pipeline.model, embedding_pipeline.tokenizer
+    embeddings = np.empty((len(input_batch), model.config.hidden_size), dtype=np.float32)
+    # texts are tokenized once and batched by token length, so short texts are not padded to the longest one
+    token_batches = iter_timed(
+        iter_token_batches(tokenizer, input_batch, batch_size, max_tokens, get_max_length(tokenizer, model)),
+        timings, TOKENIZE)
+    # the next batch is padded and the outputs of the previous one are stored while the model runs
+    forward = timed(partial(_forward, model, embedding_pipeline.device, pooling, normalize), timings, FORWARD)
+    for token_batch, batch_embeddings in map_batches_ahead(token_batches, forward, executor=_forward_executor):
+        embeddings[token_batch.indices] = batch_embeddings
+    return embeddings
+
+
+def _forward(model, device, pooling: str, normalize: bool, token_batch: TokenBatch) -> np.ndarray:
+    with torch.inference_mode():
+        inputs = {key: value.to(device) for key, value in token_batch.inputs.items()}
+        hidden_states = model(**inputs).last_hidden_state
+        # only the pooled [batch, hidden] embeddings are copied to the host
+        attention_mask = inputs.get('attention_mask', torch.ones_like(inputs['input_ids']))
+        return pool_embeddings(hidden_states, attention_mask, pooling, normalize).cpu().numpy()
@@ -0,0 +1,157 @@
+import heapq
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+
+from spcs_utils import init_logger
+
+logger = init_logger("FileAssignment")
+
+ROUND_ROBIN = 'round_robin'
+SIZE = 'size'
+DYNAMIC = 'dynamic'
+ASSIGNMENT_MODES = [ROUND_ROBIN, SIZE, DYNAMIC]
+
+
+def _get_name(stage_file_metadata) -> str:
+    return stage_file_metadata[0]
+
+
+def _get_size(stage_file_metadata) -> int:
+    return int(stage_file_metadata[1])
+
+
+def assign_round_robin(stage_files_metadata: Sequence, rank: int, world_size: int) -> List:
+    return [stage_files_metadata[idx] for idx in range(rank, len(stage_files_metadata), world_size)]
+
+
+def assign_by_size(stage_files_metadata: Sequence, rank: int, world_size: int) -> List:
+    """
+    Longest processing time first packing: files are sorted by size, largest first, and every file goes to the rank
+    with the smallest total size so far. Every rank computes the same assignment from the LIST output.
+    :return: files of the rank, largest first
+    """
+    # sorting by name too, so all ranks agree on the order of files of the same size
+    ordered_files = sorted(stage_files_metadata, key=lambda f: (-_get_size(f), _get_name(f)))
+    loads = [(0, r) for r in range(world_size)]
+    assigned_files = []
+    for stage_file_metadata in ordered_files:
+        load, file_rank = heapq.heappop(loads)
+        heapq.heappush(loads, (load + _get_size(stage_file_metadata), file_rank))
+        if file_rank == rank:
+            assigned_files.append(stage_file_metadata)
+    return assigned_files
+
+
+class ClaimTable:
+    """
+    Snowflake table of the files claimed by the ranks of a job. A claim is a MERGE, MERGE statements on the same table
+    don't run in parallel, so exactly one rank claims every file.
+    """
+
+    def __init__(self, cur, table_name: str, job_name: str):
+        """
+        :param cur: snowflake cursor
+        :param table_name: name of the claim table, created if it doesn't exist
+        :param job_name: claims of different jobs sharing the table are kept apart
+        """
+        self._cur = cur
+        self._table_name = table_name
+        self._job_name = job_name
+        # files claimed by this process, released again if the job fails before they are completed
+        self.claimed_files = []
+        self._cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {self._table_name} (
+            job_name STRING,
+            file_name STRING,
+            rank INT,
+            claimed_at TIMESTAMP_LTZ
+        )
+        """)
+
+    def get_claimed_files(self) -> Dict[str, int]:
+        """
+        :return: rank of every claimed file
+        """
+        self._cur.execute(f"SELECT file_name, rank FROM {self._table_name} WHERE job_name = %s", (self._job_name,))
+        return {file_name: rank for file_name, rank in self._cur.fetchall()}
+
+    def claim(self, file_name: str, rank: int) -> bool:
+        """
+        Claims the file for the rank. A file claimed by the same rank before is claimed again, so a restarted replica
+        takes back the files it didn't finish.
+        :return: True if the rank owns the file
+        """
+        self._cur.execute(f"""
+        MERGE INTO {self._table_name} t
+        USING (SELECT %s AS job_name, %s AS file_name, %s AS rank) s
+        ON t.job_name = s.job_name AND t.file_name = s.file_name
+        WHEN MATCHED AND t.rank = s.rank THEN UPDATE SET claimed_at = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN INSERT (job_name, file_name, rank, claimed_at)
+            VALUES (s.job_name, s.file_name, s.rank, CURRENT_TIMESTAMP())
+        """, (self._job_name, file_name, rank))
+        claimed = sum(self._cur.fetchone()) > 0
+        if claimed:
+            self.claimed_files.append(file_name)
+        return claimed
+
+    def release(self, file_names: Iterable[str], rank: int):
+        """
+        Deletes the claims of the rank on the files, so any rank can claim them again
+        """
+        file_names = list(file_names)
+        if not file_names:
+            return
+        placeholders = ', '.join(['%s'] * len(file_names))
+        self._cur.execute(f"DELETE FROM {self._table_name} WHERE job_name = %s AND rank = %s "
+                          f"AND file_name IN ({placeholders})", (self._job_name, rank, *file_names))
+        logger.info(f"rank: {rank}, released claims: {len(file_names)}")
+
+
+def iter_claimed_files(stage_files_metadata: Sequence, rank: int, world_size: int,
+                       claim_table: ClaimTable) -> Iterator:
+    """
+    Work stealing over the claim table. The rank first claims the files of its size based assignment, largest first,
+    then steals the files of the other ranks, smallest first, the ones their owners would get to last.
+    Files are claimed lazily, one at a time, as the caller asks for the next file. Files claimed by this rank before,
+    e.g. by a run that crashed, are yielded again, the caller leaves the completed files out of `stage_files_metadata`.
+    """
+    own_files = assign_by_size(stage_files_metadata, rank, world_size)
+    own_names = {_get_name(f) for f in own_files}
+    other_files = sorted((f for f in stage_files_metadata if _get_name(f) not in own_names),
+                         key=lambda f: (_get_size(f), _get_name(f)))
+    claimed_files = claim_table.get_claimed_files()
+    num_claimed = 0
+    num_stolen = 0
+    for stage_file_metadata in own_files + other_files:
+        file_name = _get_name(stage_file_metadata)
+        is_own = file_name in own_names
+        # claims of this rank are left over by a restart of the rank, the claim is renewed
+        if claimed_files.get(file_name, rank) != rank:
+            continue
+        if not claim_table.claim(file_name, rank):
+            claimed_files = claim_table.get_claimed_files()
+            continue
+        num_claimed += 1
+        num_stolen += 0 if is_own else 1
+        yield stage_file_metadata
+    logger.info(f"rank: {rank}, claimed files: {num_claimed}, stolen: {num_stolen}")
+
+
+def get_assigned_files(stage_files_metadata: Sequence, rank: int, world_size: int, mode: str = ROUND_ROBIN,
+                       claim_table: Optional[ClaimTable] = None):
+    """
+    :param stage_files_metadata: rows of the LIST command, (name, size, md5, last_modified)
+    :param rank: rank of this replica
+    :param world_size: number of replicas
+    :param mode: round_robin, size or dynamic
+    :param claim_table: claim table of the dynamic mode
+    :return: files of this rank, a lazy iterator in the dynamic mode
+    """
+    if mode == ROUND_ROBIN:
+        return assign_round_robin(stage_files_metadata, rank, world_size)
+    if mode == SIZE:
+        return assign_by_size(stage_files_metadata, rank, world_size)
+    if mode == DYNAMIC:
+        if claim_table is None:
+            raise ValueError("The dynamic file assignment requires a claim table")
+        return iter_claimed_files(stage_files_metadata, rank, world_size, claim_table)
+    raise ValueError(f"Unknown file assignment mode: {mode}, supported modes: {ASSIGNMENT_MODES}")
@@ -0,0 +1,126 @@
+import gc
+import os
+import shutil
+import tempfile
+import time
+
+_MULTIPROC_DIR_ENV = 'PROMETHEUS_MULTIPROC_DIR'
+
+# prometheus_client picks the multiprocess mode when it is imported, the directory is created here, in the gunicorn
+# master, before the app is imported. The workers inherit it, every worker writes its samples there and /metrics
+# aggregates all of them. A directory created here is removed when the master exits.
+_created_multiproc_dir = None
+if not os.environ.get(_MULTIPROC_DIR_ENV):
+    _created_multiproc_dir = tempfile.mkdtemp(prefix='prometheus_')
+    os.environ[_MULTIPROC_DIR_ENV] = _created_multiproc_dir
+
+# spcs_utils doesn't import torch, the hooks import the model modules when they run, so the master only loads the
+# models when it preloads them
+from spcs_utils import create_model_configuration, get_compute_pool_type, init_logger, load_toml_config  # noqa: E402
+
+logger = init_logger("GunicornConf")
+
+_WARMUP_MODELS = ['extract_embeddings', 'classify_texts']
+_worker_start_time = None
+
+
+def _get_batch_size(config) -> int:
+    return config["compute_pool"][get_compute_pool_type()]['batch_size']
+
+
+def _get_warmup_models(config):
+    return config.get('service', {}).get('warmup_models', _WARMUP_MODELS)
+
+
+def _format_memory(memory) -> str:
+    return f"rss: {memory['rss'] / 2 ** 20:.0f} MiB, shared: {memory['shared'] / 2 ** 20:.0f} MiB"
+
+
+def preload_models(config):
+    """
+    Loads the models in the gunicorn master before the workers are forked. The weights are moved to shared memory,
+    so all workers map the same pages instead of loading a copy each. Only for CPU pools, CUDA can't be used in a
+    process that forks.
+    """
+    import torch
+    from backends import ONNX
+    from classifier import get_classifier_pipeline
+    from feature_extractor import get_embedding_pipeline
+    from metrics import get_process_memory
+    from model_registry import get_packed_params_size, model_registry
+
+    start_time = time.time()
+    model_config = create_model_configuration(config)
+    if model_config.inference_backend == ONNX:
+        # ONNX Runtime sessions and their thread pools are not fork safe, every worker creates its own session
+        logger.warning(f"Models are not preloaded, the {ONNX} backend can't be preloaded")
+        return
+    batch_size = _get_batch_size(config)
+    warmup_models = _get_warmup_models(config)
+    if 'extract_embeddings' in warmup_models:
+        get_embedding_pipeline(batch_size, model_config)
+    if 'classify_texts' in warmup_models:
+        get_classifier_pipeline(batch_size, model_config)
+    for model in model_registry.get_models():
+        torch_model = getattr(model, 'model', model)
+        if isinstance(torch_model, torch.nn.Module):
+            torch_model.share_memory()
+            packed_size = get_packed_params_size(torch_model)
+            if packed_size:
+                # packed int8 weights can't be moved to shared memory, the workers share their pages copy on write
+                # as long as the pages are only read, a write copies the touched pages into the worker
+                logger.info(f"Packed weights of {type(torch_model).__name__} are not in shared memory: "
+                            f"{packed_size / 2 ** 20:.0f} MiB")
+    # objects created so far are never freed, the gc doesn't touch them and their pages stay shared after the fork
+    gc.freeze()
+    logger.info(f"Preloaded models in the master: {warmup_models}, time: {time.time() - start_time:.1f} s, "
+                f"{_format_memory(get_process_memory())}")
+
+
+def when_ready(_server):
+    config = load_toml_config()
+    if config.get('service', {}).get('preload_models', False):
+        # checked without touching CUDA, a process that initialized CUDA can't fork
+        if get_compute_pool_type().startswith('GPU'):
+            logger.warning("Models are not preloaded, preloading is supported on CPU compute pools only")
+        else:
+            preload_models(config)
+
+
+def post_fork(_server, _worker):
+    global _worker_start_time
+    _worker_start_time = time.time()
+
+
+def post_worker_init(_worker):
+    """
+    Warms up the models of the worker, they are loaded here unless they were preloaded in the master
+    """
+    from classifier import classify
+    from feature_extractor import compute_embeddings
+    from metrics import get_process_memory, observe_worker_ready
+
+    config = load_toml_config()
+    model_config = create_model_configuration(config)
+    batch_size = _get_batch_size(config)
+    warmup_models = _get_warmup_models(config)
+    if 'extract_embeddings' in warmup_models:
+        compute_embeddings(['test'], batch_size, model_config)
+    if 'classify_texts' in warmup_models:
+        classify(['test'], batch_size, model_config)
+    startup_time = time.time() - (_worker_start_time or time.time())
+    observe_worker_ready(startup_time)
+    logger.info(f"Worker {os.getpid()} ready, warmed up: {warmup_models}, startup time: {startup_time:.1f} s, "
+                f"{_format_memory(get_process_memory())}")
+
+
+def child_exit(_server, worker):
+    from metrics import mark_process_dead
+
+    # gauges of the dead worker must not be summed into the metrics of the live ones
+    mark_process_dead(worker.pid)
+
+
+def on_exit(_server):
+    if _created_multiproc_dir is not None:
+        shutil.rmtree(_created_multiproc_dir, ignore_errors=True)
@@ -0,0 +1,248 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from spcs_utils import init_logger
+
+logger = init_logger("InferenceCache")
+
+_DISK_PRUNE_INTERVAL = 1000
+
+
+class NDArrayCodec:
+    """
+    Stores float32 vectors, e.g. embeddings
+    """
+
+    @staticmethod
+    def encode(value: np.ndarray) -> bytes:
+        return np.ascontiguousarray(value, dtype='<f4').tobytes()
+
+    @staticmethod
+    def decode(value: bytes) -> np.ndarray:
+        return np.frombuffer(value, dtype='<f4')
+
+
+@dataclass
+class CacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    deduplicated: int = 0
+
+    def as_dict(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'deduplicated': self.deduplicated,
+            'hit_ratio': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+
+@dataclass
+class CacheLookup:
+    """
+    Result of a cache lookup of the texts of a single request
+    """
+    namespace: str
+    keys: List[bytes]
+    values: Dict[bytes, Any]
+    missing_keys: List[bytes] = field(default_factory=list)
+    missing_texts: List[str] = field(default_factory=list)
+
+
+class InferenceCache:
+    """
+    Two tier cache of model outputs keyed by (namespace, normalized text hash).
+
+    The first tier is an in-process LRU. The optional second tier is a memory mapped sqlite file, workers started by
+    gunicorn open the same file, so an output computed by one worker is a hit for all the others.
+    """
+
+    def __init__(self, max_entries: int, disk_path: Optional[str] = None, disk_max_entries: int = 0,
+                 disk_mmap_size: int = 2 ** 30):
+        """
+        :param max_entries: max number of entries of the in-process tier
+        :param disk_path: path of the sqlite file of the disk tier, None disables the disk tier
+        :param disk_max_entries: max number of entries of the disk tier, 0 means no limit
+        :param disk_mmap_size: number of bytes of the sqlite file mapped to memory
+        """
+        self.stats = CacheStats()
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[tuple, Any]" = OrderedDict()
+        self._codecs = {}
+        self._disk_path = disk_path
+        self._disk_max_entries = disk_max_entries
+        self._disk_mmap_size = disk_mmap_size
+        self._disk_connection = None
+        self._disk_pid = None
+        self._disk_puts = 0
+        self._lock = threading.Lock()
+
+    def register_namespace(self, namespace: str, codec):
+        """
+        :param namespace: e.g. route, model and inference settings, outputs of different models never share entries
+        :param codec: e.g. NDArrayCodec, used to store the outputs in the disk tier
+        """
+        self._codecs[namespace] = codec
+
+    def lookup(self, namespace: str, texts: Sequence[str]) -> CacheLookup:
+        """
+        Finds cached outputs of the texts and the unique texts that still have to go through the model
+        """
+        keys = [get_text_key(text) for text in texts]
+        values = {}
+        missing_keys = []
+        with self._lock:
+            for key in keys:
+                if key in values:
+                    continue
+                value = self._entries.get((namespace, key))
+                if value is not None:
+                    self._entries.move_to_end((namespace, key))
+                    values[key] = value
+                    self.stats.memory_hits += 1
+                else:
+                    missing_keys.append(key)
+        if missing_keys and self._disk_path:
+            disk_values = self._disk_get(namespace, missing_keys)
+            self.stats.disk_hits += len(disk_values)
+            self._memory_put(namespace, disk_values)
+            values.update(disk_values)
+        lookup = CacheLookup(namespace=namespace, keys=keys, values=values)
+        seen = set(values.keys())
+        for key, text in zip(keys, texts):
+            if key in seen:
+                continue
+            seen.add(key)
+            lookup.missing_keys.append(key)
+            lookup.missing_texts.append(text)
+        self.stats.misses += len(lookup.missing_keys)
+        self.stats.deduplicated += len(keys) - len(lookup.values) - len(lookup.missing_keys)
+        return lookup
+
+    def complete(self, lookup: CacheLookup, outputs: Sequence[Any]) -> Sequence[Any]:
+        """
+        Stores the outputs of the missing texts and returns the outputs of all texts of the lookup, in order
+        :param lookup: result of the lookup
+        :param outputs: model outputs of `lookup.missing_texts`
+        :return: outputs of `lookup.keys`, a matrix when the outputs are vectors
+        """
+        new_values = {}
+        for key, output in zip(lookup.missing_keys, outputs):
+            # copy the rows, so cache entries don't keep the whole batch matrix alive
+            new_values[key] = output.copy() if isinstance(output, np.ndarray) else output
+        self._memory_put(lookup.namespace, new_values)
+        if self._disk_path and new_values:
+            self._disk_put(lookup.namespace, new_values)
+        values = lookup.values
+        values.update(new_values)
+        results = [values[key] for key in lookup.keys]
+        if isinstance(outputs, np.ndarray) or (results and isinstance(results[0], np.ndarray)):
+            return np.stack(results) if results else outputs
+        return results
+
+    def get_stats(self) -> dict:
+        stats = self.stats.as_dict()
+        stats['memory_entries'] = len(self._entries)
+        stats['disk_path'] = self._disk_path
+        return stats
+
+    def _memory_put(self, namespace: str, values: Dict[bytes, Any]):
+        with self._lock:
+            for key, value in values.items():
+                self._entries[(namespace, key)] = value
+                self._entries.move_to_end((namespace, key))
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def _get_disk_connection(self) -> sqlite3.Connection:
+        # connections must not be shared with forked workers, every process opens its own
+        if self._disk_connection is None or self._disk_pid != os.getpid():
+            connection = sqlite3.connect(self._disk_path, timeout=5, check_same_thread=False,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"PRAGMA mmap_size={int(self._disk_mmap_size)}")
+            connection.execute("""
+            CREATE TABLE IF NOT EXISTS inference_cache (
+                namespace TEXT NOT NULL,
+                key BLOB NOT NULL,
+                value BLOB NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+            """)
+            self._disk_connection = connection
+            self._disk_pid = os.getpid()
+        return self._disk_connection
+
+    def _disk_get(self, namespace: str, keys: List[bytes]) -> Dict[bytes, Any]:
+        codec = self._codecs[namespace]
+        values = {}
+        try:
+            with self._lock:
+                connection = self._get_disk_connection()
+                # stay below the default sqlite limit of variables per statement
+                for i in range(0, len(keys), 500):
+                    chunk = keys[i:i + 500]
+                    placeholders = ','.join('?' * len(chunk))
+                    rows = connection.execute(
+                        f"SELECT key, value FROM inference_cache WHERE namespace = ? AND key IN ({placeholders})",
+                        [namespace, *chunk]).fetchall()
+                    for key, value in rows:
+                        values[key] = codec.decode(value)
+        except sqlite3.Error:
+            logger.exception(f"Failed to read the disk cache: {self._disk_path}")
+        return values
+
+    def _disk_put(self, namespace: str, values: Dict[bytes, Any]):
+        codec = self._codecs[namespace]
+        rows = [(namespace, key, codec.encode(value)) for key, value in values.items()]
+        try:
+            with self._lock:
+                connection = self._get_disk_connection()
+                connection.execute("BEGIN")
+                connection.executemany(
+                    "INSERT OR REPLACE INTO inference_cache (namespace, key, value) VALUES (?, ?, ?)", rows)
+                connection.execute("COMMIT")
+                self._disk_puts += len(rows)
+                if self._disk_max_entries and self._disk_puts >= _DISK_PRUNE_INTERVAL:
+                    self._disk_puts = 0
+                    self._disk_prune(connection)
+        except sqlite3.Error:
+            logger.exception(f"Failed to write the disk cache: {self._disk_path}")
+
+    def _disk_prune(self, connection: sqlite3.Connection):
+        num_entries = connection.execute("SELECT count(*) FROM inference_cache").fetchone()[0]
+        if num_entries > self._disk_max_entries:
+            # the oldest rows are removed first
+            connection.execute(
+                "DELETE FROM inference_cache WHERE rowid IN (SELECT rowid FROM inference_cache ORDER BY rowid LIMIT ?)",
+                [num_entries - self._disk_max_entries])
+
+
+def get_text_key(text: str) -> bytes:
+    normalized_text = unicodedata.normalize('NFC', text).strip()
+    return hashlib.blake2b(normalized_text.encode('utf-8'), digest_size=16).digest()
+
+
+def create_inference_cache(config) -> Optional[InferenceCache]:
+    """
+    Creates the cache from the [cache] section of config.toml, returns None when the cache is disabled
+    """
+    cache_config = config.get('cache', {})
+    if not cache_config.get('enabled', False):
+        return None
+    return InferenceCache(max_entries=cache_config.get('max_entries', 100000),
+                          disk_path=cache_config.get('disk_path') or None,
+                          disk_max_entries=cache_config.get('disk_max_entries', 0),
+                          disk_mmap_size=cache_config.get('disk_mmap_size_mb', 1024) * 2 ** 20)
@@ -0,0 +1,155 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, List
+
+from spcs_utils import init_logger
+
+logger = init_logger("JobPipeline")
+
+DOWNLOAD = 'download'
+DOWNLOAD_WAIT = 'download_wait'
+INFERENCE = 'inference'
+UPLOAD = 'upload'
+UPLOAD_WAIT = 'upload_wait'
+
+
+@dataclass
+class PipelineConfiguration:
+    download_threads: int = 2
+    prefetch_files: int = 2
+    upload_threads: int = 1
+    upload_queue_depth: int = 2
+
+
+def create_pipeline_configuration(config) -> PipelineConfiguration:
+    """
+    Creates the pipeline configuration from the [job] section of config.toml
+    """
+    job_config = config.get('job', {})
+    default_configuration = PipelineConfiguration()
+    return PipelineConfiguration(
+        download_threads=job_config.get('download_threads', default_configuration.download_threads),
+        prefetch_files=job_config.get('prefetch_files', default_configuration.prefetch_files),
+        upload_threads=job_config.get('upload_threads', default_configuration.upload_threads),
+        upload_queue_depth=job_config.get('upload_queue_depth', default_configuration.upload_queue_depth))
+
+
+@dataclass
+class _StageTime:
+    count: int = 0
+    total_sec: float = 0.0
+    max_sec: float = 0.0
+
+
+class StageTimer:
+    """
+    Accumulates the time spent in every stage of the job, from all threads.
+
+    The `*_wait` stages measure the time the inference loop is blocked: a large download wait means downloads are the
+    bottleneck, a large upload wait means uploads are, otherwise the model is.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: Dict[str, _StageTime] = {}
+
+    @contextmanager
+    def measure(self, stage: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start_time)
+
+    def add(self, stage: str, duration_sec: float):
+        with self._lock:
+            stage_time = self._stages.setdefault(stage, _StageTime())
+            stage_time.count += 1
+            stage_time.total_sec += duration_sec
+            stage_time.max_sec = max(stage_time.max_sec, duration_sec)
+
+    def get_summary(self) -> dict:
+        with self._lock:
+            return {stage: {'count': t.count, 'total_sec': t.total_sec, 'max_sec': t.max_sec}
+                    for stage, t in self._stages.items()}
+
+    def log_summary(self, wall_time_sec: float):
+        summary = self.get_summary()
+        for stage, stage_time in summary.items():
+            logger.info(f"stage: {stage}, count: {stage_time['count']}, total: {stage_time['total_sec']:.1f} s, "
+                        f"max: {stage_time['max_sec']:.1f} s")
+        waits = {stage: summary.get(stage, {}).get('total_sec', 0.0) for stage in (DOWNLOAD_WAIT, UPLOAD_WAIT)}
+        waits[INFERENCE] = summary.get(INFERENCE, {}).get('total_sec', 0.0)
+        bottleneck = max(waits, key=waits.get)
+        logger.info(f"wall time: {wall_time_sec:.1f} s, bottleneck stage: {bottleneck}")
+
+
+class BackgroundUploader:
+    """
+    Runs uploads in background threads. At most `queue_depth` uploads are pending, `submit` blocks when the queue
+    is full, so finished outputs never pile up on the local disk.
+    """
+
+    def __init__(self, upload_function: Callable, num_threads: int, queue_depth: int, timer: StageTimer):
+        """
+        :param upload_function: function that uploads a single output, called from the upload threads
+        :param num_threads: number of upload threads
+        :param queue_depth: max number of pending uploads, including the running ones
+        :param timer: the time of the uploads and the time `submit` is blocked are recorded here
+        """
+        self._upload_function = upload_function
+        self._timer = timer
+        self._slots = threading.BoundedSemaphore(max(queue_depth, 1))
+        self._executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='upload')
+        self._futures: List[Future] = []
+
+    def submit(self, *args):
+        self._raise_failed()
+        with self._timer.measure(UPLOAD_WAIT):
+            self._slots.acquire()
+        try:
+            self._futures.append(self._executor.submit(self._upload, *args))
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def close(self):
+        """
+        Waits for the pending uploads, raises the error of the first failed upload
+        """
+        self._executor.shutdown(wait=True)
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # the job already failed, the uploads in flight are finished but their errors are only logged
+            self._executor.shutdown(wait=True)
+            for future in self._futures:
+                if future.exception() is not None:
+                    logger.error(f"Upload failed: {future.exception()}")
+
+    def _upload(self, *args):
+        try:
+            with self._timer.measure(UPLOAD):
+                self._upload_function(*args)
+        finally:
+            self._slots.release()
+
+    def _raise_failed(self):
+        pending = []
+        for future in self._futures:
+            if not future.done():
+                pending.append(future)
+            elif future.exception() is not None:
+                raise future.exception()
+        self._futures = pending
@@ -1,19 +1,37 @@
+import itertools
+import json
 import os
 import tempfile
+import threading
 import time
 import uuid
+from contextlib import closing
+from functools import partial
+from typing import Iterable, Optional
+
 import click
 
+import numpy as np
 import pandas as pd
-from pandas import DataFrame
-from spcs_utils import init_logger, load_toml_config, get_compute_pool_type, get_connection, InputRow, \
-    ModelConfiguration
+import pyarrow as pa
+import pyarrow.parquet as pq
+from spcs_utils import init_logger, load_toml_config, get_compute_pool_type, get_connection, \
+    ModelConfiguration, create_model_configuration, iter_batches, map_batches_ahead
 
-from feature_extractor import extract_embeddings
-from classifier import run_classifier
+from embedding_formats import ARRAY, encode_embeddings
+from feature_extractor import compute_embeddings
+from classifier import classify, get_labels
+from classifier_formats import IDS, OBJECT, encode_classifications, encode_label_table, unpack_top_k
+from checkpoint import CheckpointManifest
+from file_assignment import DYNAMIC, ROUND_ROBIN, ClaimTable, get_assigned_files
+from job_pipeline import DOWNLOAD, DOWNLOAD_WAIT, INFERENCE, BackgroundUploader, PipelineConfiguration, StageTimer, \
+    create_pipeline_configuration
 
 logger = init_logger("EmbeddingsJobMain")
 
+_READ_BATCH_ROWS = 8192
+_MANIFEST_DIR = '_manifest'
+
 
 def download_file(cur, stage_source_file, local_dest_dir):
     cur.execute(f"""
@@ -40,46 +58,214 @@ def get_world_size():
     return int(os.environ['WORLD_SIZE'])
 
 
-def process_df(df, filename, batch_size, model_configuration: ModelConfiguration, task: str):
-    rows = [InputRow(idx=row['ID'], text=row['TEXT']) for _, row in df.iterrows()]
-    num_batches = len(rows) // batch_size + 1
-    output_rows = []
-    logger.info(f"file: {filename} has {num_batches} batches with batch_size: {batch_size}")
-    for i in range(0, num_batches):
-        logger.info(f"processing file:{filename}, batch {i}")
-        batch_rows = rows[i * batch_size:(i + 1) * batch_size]
-        if task == 'extract_embeddings':
-            output_rows += extract_embeddings(batch_rows, batch_size, model_configuration)
-        else:
-            output_rows += run_classifier(batch_rows, batch_size, model_configuration)
-    return output_rows
+def process_record_batch(record_batch: pa.RecordBatch,
+                         batch_size: int,
+                         model_configuration: ModelConfiguration,
+                         task: str,
+                         max_tokens: Optional[int] = None) -> pa.Array:
+    """
+    Runs the model on the TEXT column of the record batch
+    :return: output column, one value per row
+    """
+    texts = record_batch.column('TEXT').to_pylist()
+    if task == 'extract_embeddings':
+        embeddings = compute_embeddings(texts, batch_size, model_configuration, max_tokens)
+        return _embeddings_to_arrow(embeddings, model_configuration.embedding_output_format)
+    top_k = classify(texts, batch_size, model_configuration, max_tokens)
+    return _classifications_to_arrow(top_k, batch_size, model_configuration)
 
 
-def write_output_to_stage(cur, local_dir, filename, df: DataFrame, stage_path):
-    local_file = os.path.join(local_dir, filename)
-    df.to_parquet(path=local_file)
-    sql = f"PUT file://{local_file} @{stage_path}"
+def _get_output_type(model_configuration: ModelConfiguration, task: str) -> pa.DataType:
+    if task == 'extract_embeddings' and model_configuration.embedding_output_format == ARRAY:
+        return pa.list_(pa.float32())
+    if task == 'classify_texts' and model_configuration.classifier_output_format == IDS:
+        return pa.struct([('ids', pa.list_(pa.int32())), ('scores', pa.list_(pa.float32()))])
+    return pa.string()
+
+
+def _get_output_metadata(batch_size: int, model_configuration: ModelConfiguration, task: str) -> Optional[dict]:
+    if task == 'classify_texts' and model_configuration.classifier_output_format == IDS:
+        # label table of the label ids, stored once per output file
+        return {'labels': encode_label_table(get_labels(batch_size, model_configuration))}
+    return None
+
+
+def _embeddings_to_arrow(embeddings: np.ndarray, output_format: str) -> pa.Array:
+    if output_format == ARRAY:
+        # list array on top of the embeddings buffer, no per value python objects
+        offsets = np.arange(len(embeddings) + 1, dtype=np.int32) * embeddings.shape[1]
+        return pa.ListArray.from_arrays(pa.array(offsets), pa.array(embeddings.ravel()))
+    return pa.array(encode_embeddings(embeddings, output_format), type=pa.string())
+
+
+def _classifications_to_arrow(top_k: np.ndarray, batch_size: int,
+                              model_configuration: ModelConfiguration) -> pa.Array:
+    output_format = model_configuration.classifier_output_format
+    if output_format == IDS:
+        # struct of list arrays on top of the top k buffers, no per value python objects
+        label_ids, scores = unpack_top_k(top_k)
+        offsets = pa.array(np.arange(len(top_k) + 1, dtype=np.int32) * label_ids.shape[1])
+        return pa.StructArray.from_arrays([pa.ListArray.from_arrays(offsets, pa.array(label_ids.ravel())),
+                                           pa.ListArray.from_arrays(offsets, pa.array(scores.ravel()))],
+                                          names=['ids', 'scores'])
+    outputs = encode_classifications(top_k, get_labels(batch_size, model_configuration), output_format)
+    if output_format == OBJECT:
+        # json text that PARSE_JSON turns into an OBJECT
+        outputs = [json.dumps(output) for output in outputs]
+    return pa.array(outputs, type=pa.string())
+
+
+def process_parquet_file(input_file: str,
+                         output_file: str,
+                         read_batch_rows: int,
+                         batch_size: int,
+                         model_configuration: ModelConfiguration,
+                         task: str,
+                         max_tokens: Optional[int] = None) -> int:
+    """
+    Streams the input parquet file through the model in record batches of `read_batch_rows` rows and writes the
+    outputs to the output parquet file, so only a few record batches are held in memory at a time
+    :return: number of processed rows
+    """
+    parquet_file = pq.ParquetFile(input_file)
+    schema = pa.schema([('idx', parquet_file.schema_arrow.field('ID').type),
+                        ('output', _get_output_type(model_configuration, task))],
+                       metadata=_get_output_metadata(batch_size, model_configuration, task))
+    record_batches = parquet_file.iter_batches(batch_size=read_batch_rows, columns=['ID', 'TEXT'])
+    num_rows = 0
+    # written under a temporary name, a file with the final name is always complete
+    tmp_output_file = f"{output_file}.tmp"
+    with pq.ParquetWriter(tmp_output_file, schema) as writer:
+        # the model runs on the next record batch while the outputs of the current one are written
+        for record_batch, outputs in map_batches_ahead(
+                record_batches,
+                partial(process_record_batch, batch_size=batch_size, model_configuration=model_configuration,
+                        task=task, max_tokens=max_tokens)):
+            writer.write_table(pa.Table.from_arrays([record_batch.column('ID'), outputs], schema=schema))
+            num_rows += record_batch.num_rows
+            logger.info(f"file: {input_file}, processed rows: {num_rows}/{parquet_file.metadata.num_rows}")
+    os.replace(tmp_output_file, output_file)
+    return num_rows
+
+
+def upload_file_to_stage(cur, local_file: str, stage_path: str):
+    sql = f"PUT file://{local_file} @{stage_path} OVERWRITE=TRUE"
     result = cur.execute(sql)
     logger.debug(f"query:{sql}, result: {result}")
 
 
+def write_output_to_stage(cur, local_dir, filename, table: pa.Table, stage_path):
+    local_file = os.path.join(local_dir, filename)
+    pq.write_table(table, local_file)
+    upload_file_to_stage(cur, local_file, stage_path)
+
+
+def download_input_file(cur, dest_dir: str, stage_file_metadata) -> str:
+    """
+    Downloads the stage file into a directory of its own, files from different stage folders can share a name
+    :return: path of the local file
+    """
+    filepath, size, hash, date = stage_file_metadata
+    local_dir = tempfile.mkdtemp(dir=dest_dir)
+    download_file(cur, filepath, local_dir)
+    return os.path.join(local_dir, os.path.basename(filepath))
+
+
+def upload_output_file(cur, local_file: str, stage_path: str, stage_file_metadata=None,
+                       manifest: Optional[CheckpointManifest] = None):
+    upload_file_to_stage(cur, local_file, stage_path)
+    if manifest is not None:
+        manifest.commit(cur, stage_file_metadata)
+    os.remove(local_file)
+    os.rmdir(os.path.dirname(local_file))
+
+
+def infer_local_file(local_file: str,
+                     batch_size: int,
+                     model_configuration: ModelConfiguration,
+                     task: str,
+                     max_tokens: Optional[int] = None,
+                     read_batch_rows: int = _READ_BATCH_ROWS) -> str:
+    """
+    Runs the model on the downloaded file and removes it
+    :return: path of the local output file
+    """
+    local_dir = os.path.dirname(local_file)
+    local_output_file = os.path.join(local_dir, f"output_{os.path.basename(local_file)}")
+    process_parquet_file(local_file, local_output_file, read_batch_rows, batch_size, model_configuration, task,
+                         max_tokens)
+    os.remove(local_file)
+    return local_output_file
+
+
 def process_file(cur,
                  dest_dir: str,
                  stage_file_metadata,
                  stage_output_path: str,
                  batch_size: int,
                  model_configuration: ModelConfiguration,
-                 task: str):
-    filepath, size, hash, date = stage_file_metadata
-    filename = os.path.basename(filepath)
-    download_file(cur, filepath, dest_dir)
-    local_file_dest = os.path.join(dest_dir, filename)
-    df = pd.read_parquet(local_file_dest)
-    output_rows = process_df(df, filename, batch_size, model_configuration, task)
-    output_df = pd.DataFrame([row.__dict__ for row in output_rows])
-    output_dir = os.path.join(dest_dir, "output")
-    os.makedirs(output_dir, exist_ok=True)
-    write_output_to_stage(cur, output_dir, f"output_{filename}", output_df, stage_output_path)
+                 task: str,
+                 max_tokens: Optional[int] = None,
+                 read_batch_rows: int = _READ_BATCH_ROWS,
+                 manifest: Optional[CheckpointManifest] = None):
+    local_file = download_input_file(cur, dest_dir, stage_file_metadata)
+    local_output_file = infer_local_file(local_file, batch_size, model_configuration, task, max_tokens,
+                                         read_batch_rows)
+    upload_output_file(cur, local_output_file, stage_output_path, stage_file_metadata, manifest)
+
+
+def process_files(conn,
+                  dest_dir: str,
+                  stage_files_metadata: Iterable,
+                  stage_output_path: str,
+                  batch_size: int,
+                  model_configuration: ModelConfiguration,
+                  task: str,
+                  pipeline_configuration: PipelineConfiguration,
+                  max_tokens: Optional[int] = None,
+                  read_batch_rows: int = _READ_BATCH_ROWS,
+                  manifest: Optional[CheckpointManifest] = None):
+    """
+    Processes the files in a three stage pipeline, so the model does not wait for the stage transfers:
+    download threads fetch up to `prefetch_files` files ahead, the model runs on the current file in this thread
+    and upload threads PUT the finished outputs, at most `upload_queue_depth` of them pending.
+    Every uploaded output is committed to the manifest, when given.
+    """
+    start_time = time.time()
+    timer = StageTimer()
+    thread_cursors = threading.local()
+
+    def get_cursor():
+        # every thread runs its GET and PUT commands on a cursor of its own
+        if not hasattr(thread_cursors, 'cursor'):
+            thread_cursors.cursor = conn.cursor()
+        return thread_cursors.cursor
+
+    def download(stage_file_metadata) -> str:
+        with timer.measure(DOWNLOAD):
+            return download_input_file(get_cursor(), dest_dir, stage_file_metadata)
+
+    def upload(stage_file_metadata, local_output_file: str):
+        upload_output_file(get_cursor(), local_output_file, stage_output_path, stage_file_metadata, manifest)
+
+    downloads = map_batches_ahead(stage_files_metadata, download, prefetch=pipeline_configuration.prefetch_files,
+                                  max_workers=pipeline_configuration.download_threads)
+    with closing(downloads), BackgroundUploader(upload, pipeline_configuration.upload_threads,
+                                                pipeline_configuration.upload_queue_depth, timer) as uploader:
+        download_wait_start = time.perf_counter()
+        for idx, (stage_file_metadata, local_file) in enumerate(downloads):
+            download_wait = time.perf_counter() - download_wait_start
+            timer.add(DOWNLOAD_WAIT, download_wait)
+            inference_start = time.perf_counter()
+            local_output_file = infer_local_file(local_file, batch_size, model_configuration, task, max_tokens,
+                                                 read_batch_rows)
+            inference_time = time.perf_counter() - inference_start
+            timer.add(INFERENCE, inference_time)
+            uploader.submit(stage_file_metadata, local_output_file)
+            logger.info(f"file: {stage_file_metadata[0]} (#{idx + 1}), "
+                        f"download wait: {download_wait:.2f} s, inference: {inference_time:.2f} s")
+            download_wait_start = time.perf_counter()
+    timer.log_summary(time.time() - start_time)
 
 
 def create_pd_dataset(cur,
@@ -97,10 +283,9 @@ def create_pd_dataset(cur,
 
 
 def get_local_batches(df, batch_size: int, rank: int, world_size: int):
-    pointer = 0
-    while pointer < len(df):
-        yield df.iloc[pointer + rank * batch_size: pointer + (rank + 1) * batch_size]
-        pointer += world_size * batch_size
+    # batch i goes to the rank i % world_size
+    for batch in itertools.islice(iter_batches(df, batch_size), rank, None, world_size):
+        yield batch.items
 
 
 def process_batch(cur,
@@ -112,11 +297,12 @@ def process_batch(cur,
                   batch_size: int,
                   model_configuration: ModelConfiguration,
                   task: str):
-    output_rows = process_df(df, 'test', batch_size, model_configuration, task)
-    output_df = pd.DataFrame([row.__dict__ for row in output_rows])
+    record_batch = pa.RecordBatch.from_pandas(df[['ID', 'TEXT']], preserve_index=False)
+    outputs = process_record_batch(record_batch, batch_size, model_configuration, task)
+    output_table = pa.Table.from_arrays([record_batch.column('ID'), outputs], names=['idx', 'output'])
     output_dir = os.path.join(dest_dir, "output")
     os.makedirs(output_dir, exist_ok=True)
-    write_output_to_stage(cur, output_dir, f"output_{rank}_{batch_id}", output_df, stage_output_path)
+    write_output_to_stage(cur, output_dir, f"output_{rank}_{batch_id}", output_table, stage_output_path)
 
 
 def execute(job_id: str,
@@ -126,7 +312,13 @@ def execute(job_id: str,
             stage_output_path: str,
             model_configuration: ModelConfiguration,
             snowflake_creds_config,
-            task: str):
+            task: str,
+            pipeline_configuration: PipelineConfiguration,
+            max_tokens: Optional[int] = None,
+            read_batch_rows: int = _READ_BATCH_ROWS,
+            assignment: str = ROUND_ROBIN,
+            claim_table_name: Optional[str] = None,
+            checkpoint: bool = True):
     stage_full_data_path = f"{stage_name}/{stage_data_path}/"
     stage_full_output_path = f"{stage_name}/{stage_output_path}"
     logger.info(f"starting job: {job_id}, stage_data: {stage_full_data_path}, stage_output: {stage_full_output_path}")
@@ -136,10 +328,45 @@ def execute(job_id: str,
         files = cur.fetchall()
         world_size = get_world_size()
         rank = get_rank()
-        logger.info(f"Processing {len(files)} files, world_size: {world_size}, rank: {rank}")
+        logger.info(f"Processing {len(files)} files, world_size: {world_size}, rank: {rank}, assignment: {assignment}")
+        manifest = None
+        if checkpoint:
+            manifest = CheckpointManifest(f"{stage_full_output_path}/{_MANIFEST_DIR}")
+            manifest.load(cur)
+        claim_table = None
+        if assignment == DYNAMIC:
+            claim_table = ClaimTable(cur, claim_table_name, get_job_name())
+            # any rank can claim any file, completed files are left out of the claims
+            if manifest is not None:
+                files = manifest.get_pending_files(files)
+        local_files = get_assigned_files(files, rank, world_size, assignment, claim_table)
+        if manifest is not None and assignment != DYNAMIC:
+            # the assignment is computed from all files, so all ranks agree on it after a restart of a single rank
+            local_files = manifest.get_pending_files(local_files)
         with tempfile.TemporaryDirectory() as tmpdir:
-            for idx in range(rank, len(files), world_size):
-                process_file(cur, tmpdir, files[idx], stage_full_output_path, batch_size, model_configuration, task)
+            try:
+                process_files(conn, tmpdir, local_files, stage_full_output_path, batch_size, model_configuration,
+                              task, pipeline_configuration, max_tokens, read_batch_rows, manifest)
+            except BaseException:
+                if claim_table is not None:
+                    _release_unfinished_claims(claim_table, files, rank, manifest)
+                raise
+
+
+def _release_unfinished_claims(claim_table: ClaimTable, stage_files_metadata, rank: int,
+                               manifest: Optional[CheckpointManifest]):
+    """
+    Releases the files claimed by the failed run that are not completed, e.g. the ones claimed by the download
+    prefetch, so the other ranks can steal them. Without a manifest all claims are released, outputs are overwritten.
+    """
+    files_by_name = {f[0]: f for f in stage_files_metadata}
+    unfinished = [name for name in claim_table.claimed_files
+                  if manifest is None or not manifest.is_completed(files_by_name[name])]
+    try:
+        claim_table.release(unfinished, rank)
+    except Exception as e:
+        # the claims are renewed by a restart of this rank
+        logger.warning(f"Failed to release claims: {unfinished}, error: {e}")
 
 
 def get_job_name():
@@ -154,17 +381,23 @@ def main(task: str):
     world_size = get_world_size()
     job_id = f"{get_job_name()}-{world_size}-{rank}"
     config = load_toml_config()
-    model_configuration = ModelConfiguration(classifier_model_name=config['general']['classifier_model_name'],
-                                             embedding_model_name=config['general']['embedding_model_name'],
-                                             embedding_tokenizer_name=config['general']['embedding_tokenizer_name'])
+    model_configuration = create_model_configuration(config)
     stage_name = config['job']['stage_name']
     stage_data_path = config['job']['stage_data_path']
     stage_output_path = config['job']['stage_output_path']
-    batch_size = config["compute_pool"][get_compute_pool_type()]['batch_size']
+    read_batch_rows = config['job'].get('read_batch_rows', _READ_BATCH_ROWS)
+    pipeline_configuration = create_pipeline_configuration(config)
+    assignment = config['job'].get('assignment', ROUND_ROBIN)
+    claim_table_name = config['job'].get('claim_table', 'EMBEDDINGS_JOB_CLAIMS')
+    checkpoint = config['job'].get('checkpoint', True)
+    compute_pool_config = config["compute_pool"][get_compute_pool_type()]
+    batch_size = compute_pool_config['batch_size']
+    max_tokens = compute_pool_config.get('max_tokens_per_batch')
 
     snowflake_creds_config = config['snowflake']['credentials']
     execute(job_id, batch_size, stage_name, stage_data_path, stage_output_path, model_configuration,
-            snowflake_creds_config, task)
+            snowflake_creds_config, task, pipeline_configuration, max_tokens, read_batch_rows, assignment,
+            claim_table_name, checkpoint)
     total_time = time.time() - start_time
     logger.info(f"Finished processing, waiting, time: {total_time}")
     time.sleep(1000000)
@@ -1,10 +1,9 @@
-import os
-
 import click
 from gunicorn.app.base import BaseApplication
+# creates the prometheus multiprocess directory, must be imported before the app
+from gunicorn_conf import child_exit, on_exit, post_fork, post_worker_init, when_ready
 from async_app import app
-from spcs_utils import load_toml_config, init_logger, InputRow, ModelConfiguration
-from classifier import run_classifier
+from spcs_utils import load_toml_config, init_logger
 
 logger = init_logger("GunicornMain")
 
@@ -23,16 +22,6 @@ except ImportError:
 DEBUG = True
 
 
-def load_model(_):
-    global sess
-    print('fork')
-    config = load_toml_config()
-    model_config = ModelConfiguration(classifier_model_name=config['general']['classifier_model_name'],
-                                      embedding_model_name=config['general']['embedding_model_name'],
-                                      embedding_tokenizer_name=config['general']['embedding_tokenizer_name'])
-    run_classifier([InputRow(idx=0, text='test')], batch_size=1, model_config=model_config)
-
-
 class StandaloneApplication(BaseApplication):
     def __init__(self, app, options=None):
         self.options = options or {}
@@ -44,7 +33,12 @@ class StandaloneApplication(BaseApplication):
                   if key in self.cfg.settings and value is not None}
         for key, value in config.items():
             self.cfg.set(key.lower(), value)
-        self.cfg.set('post_worker_init', load_model)
+        # the same hooks as `gunicorn -c gunicorn_conf.py`
+        self.cfg.set('when_ready', when_ready)
+        self.cfg.set('post_fork', post_fork)
+        self.cfg.set('post_worker_init', post_worker_init)
+        self.cfg.set('child_exit', child_exit)
+        self.cfg.set('on_exit', on_exit)
 
     def load(self):
         return self.application
@@ -0,0 +1,125 @@
+import os
+from typing import Dict, Optional
+
+import torch
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, \
+    generate_latest, multiprocess
+
+from spcs_utils import TOKENIZE, FORWARD
+
+PARSE = 'parse'
+QUEUE = 'queue'
+INFERENCE = 'inference'
+SERIALIZE = 'serialize'
+TOTAL = 'total'
+
+_LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+_ROWS_BUCKETS = tuple(2 ** i for i in range(14))
+_RATIO_BUCKETS = (.1, .2, .3, .4, .5, .6, .7, .8, .9, 1.0)
+
+# set by the gunicorn config before prometheus_client is imported, see gunicorn_conf.py. Without it, e.g. in
+# benchmarks, the metrics of the current process are reported
+_MULTIPROC_DIR_ENV = 'PROMETHEUS_MULTIPROC_DIR'
+
+REQUEST_LATENCY = Histogram('embeddings_request_latency_seconds',
+                            'Request latency by stage: parse, queue, inference, serialize and total',
+                            ['route', 'stage'], buckets=_LATENCY_BUCKETS)
+REQUESTS = Counter('embeddings_requests', 'Finished requests by http status', ['route', 'status'])
+REQUEST_ROWS = Histogram('embeddings_request_rows', 'Rows per request', ['route'], buckets=_ROWS_BUCKETS)
+BATCH_LATENCY = Histogram('embeddings_batch_latency_seconds',
+                          'Model batch latency by stage: tokenize, forward and total',
+                          ['route', 'stage'], buckets=_LATENCY_BUCKETS)
+BATCH_FILL_RATIO = Histogram('embeddings_batch_fill_ratio', 'Rows per model batch divided by the batch size',
+                             ['route'], buckets=_RATIO_BUCKETS)
+ADMISSION_REJECTED = Counter('embeddings_admission_rejected', 'Requests rejected with 429 by reason', ['reason'])
+ADMISSION_RUNNING = Gauge('embeddings_admission_running', 'Requests being processed', multiprocess_mode='livesum')
+ADMISSION_QUEUED = Gauge('embeddings_admission_queued', 'Requests waiting for admission', multiprocess_mode='livesum')
+ADMISSION_LIMIT = Gauge('embeddings_admission_limit', 'Concurrency limit', multiprocess_mode='livesum')
+PROCESS_MEMORY = Gauge('embeddings_process_memory_bytes', 'Resident memory of the worker processes',
+                       multiprocess_mode='livesum')
+PROCESS_SHARED_MEMORY = Gauge('embeddings_process_shared_memory_bytes',
+                              'Resident memory of the worker processes that is shared with other processes',
+                              multiprocess_mode='livesum')
+WORKER_STARTUP = Gauge('embeddings_worker_startup_seconds', 'Time from the worker fork to the end of the warmup',
+                       multiprocess_mode='liveall')
+GPU_MEMORY = Gauge('embeddings_gpu_memory_bytes', 'GPU memory of the worker processes, allocated and reserved',
+                   ['type'], multiprocess_mode='livesum')
+
+
+def observe_request(route: str, status: int, timings: Dict[str, float], num_rows: Optional[int] = None):
+    """
+    :param route: path of the route, e.g. /models/{model}/extract_embeddings
+    :param status: http status of the response
+    :param timings: seconds spent in every stage of the request
+    :param num_rows: number of rows of the request, None when the request was not parsed
+    """
+    for stage, duration_sec in timings.items():
+        REQUEST_LATENCY.labels(route, stage).observe(duration_sec)
+    REQUESTS.labels(route, str(status)).inc()
+    if num_rows is not None:
+        REQUEST_ROWS.labels(route).observe(num_rows)
+
+
+def observe_batch(route: str, num_rows: int, batch_size: int, timings: Dict[str, float]):
+    for stage in (TOKENIZE, FORWARD, TOTAL):
+        if stage in timings:
+            BATCH_LATENCY.labels(route, stage).observe(timings[stage])
+    BATCH_FILL_RATIO.labels(route).observe(num_rows / batch_size)
+    _update_memory_gauges()
+
+
+def observe_admission(admission_controller):
+    ADMISSION_RUNNING.set(admission_controller.running)
+    ADMISSION_QUEUED.set(admission_controller.queued)
+    ADMISSION_LIMIT.set(int(admission_controller.limit))
+
+
+def observe_rejection(reason: str):
+    ADMISSION_REJECTED.labels(reason).inc()
+
+
+def mark_process_dead(pid: int):
+    """
+    Drops the gauge samples of a dead worker, called by the gunicorn master
+    """
+    if _is_multiprocess():
+        multiprocess.mark_process_dead(pid)
+
+
+def generate_metrics() -> bytes:
+    if not _is_multiprocess():
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def observe_worker_ready(startup_sec: float):
+    WORKER_STARTUP.set(startup_sec)
+    _update_memory_gauges()
+
+
+def get_process_memory() -> Dict[str, int]:
+    """
+    Resident and shared resident memory of the current process in bytes, zeros where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            _, resident, shared = f.read().split()[:3]
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        return {'rss': int(resident) * page_size, 'shared': int(shared) * page_size}
+    except (OSError, ValueError):
+        return {'rss': 0, 'shared': 0}
+
+
+def _update_memory_gauges():
+    process_memory = get_process_memory()
+    PROCESS_MEMORY.set(process_memory['rss'])
+    PROCESS_SHARED_MEMORY.set(process_memory['shared'])
+    if torch.cuda.is_available():
+        GPU_MEMORY.labels('allocated').set(torch.cuda.memory_allocated())
+        GPU_MEMORY.labels('reserved').set(torch.cuda.memory_reserved())
+
+
+def _is_multiprocess() -> bool:
+    return bool(os.environ.get(_MULTIPROC_DIR_ENV))
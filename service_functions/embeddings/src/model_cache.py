@@ -0,0 +1,115 @@
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+from spcs_utils import init_logger
+
+logger = init_logger("ModelCache")
+
+_MODEL_CACHE_DIR_ENV = 'MODEL_CACHE_DIR'
+_SHM_DIR = '/dev/shm'
+_COMPLETE_MARKER = '.complete'
+
+
+def get_model_cache_dir() -> str:
+    """
+    MODEL_CACHE_DIR, e.g. the mount path of a stage volume shared by all replicas, otherwise /dev/shm,
+    so restarted containers on the same node don't download the weights again
+    """
+    if _MODEL_CACHE_DIR_ENV in os.environ:
+        return os.environ[_MODEL_CACHE_DIR_ENV]
+    if os.path.isdir(_SHM_DIR):
+        return os.path.join(_SHM_DIR, 'model_cache')
+    return os.path.join(os.path.expanduser('~'), '.cache', 'spcs_models')
+
+
+def from_pretrained(pretrained_class, model_name: str, **kwargs):
+    """
+    Loads the model, tokenizer or processor from the local model cache, the hugging face hub is used only when
+    the cache has no copy. A loaded hub copy is saved to the cache as safetensors, which are memory mapped on load.
+    :param pretrained_class: e.g. AutoModel or AutoTokenizer
+    :param model_name: hub name of the model
+    :param kwargs: arguments of `from_pretrained`
+    """
+    start_time = time.time()
+    cache_path = os.path.join(get_model_cache_dir(), re.sub(r'[^A-Za-z0-9_.-]', '_', model_name),
+                              _get_cache_key(pretrained_class, kwargs))
+    if _is_complete(cache_path):
+        pretrained = pretrained_class.from_pretrained(cache_path, **kwargs)
+        source = 'cache'
+    else:
+        with _file_lock(f"{cache_path}.lock"):
+            # another replica may have populated the cache while this one waited for the lock
+            if _is_complete(cache_path):
+                pretrained = pretrained_class.from_pretrained(cache_path, **kwargs)
+                source = 'cache'
+            else:
+                pretrained = pretrained_class.from_pretrained(model_name, **kwargs)
+                _save(pretrained, cache_path)
+                source = 'hub'
+    logger.info(f"Loaded {pretrained_class.__name__} of {model_name} from the {source} in "
+                f"{time.time() - start_time:.1f} s, cache: {cache_path}")
+    return pretrained
+
+
+def _get_cache_key(pretrained_class, kwargs) -> str:
+    """
+    The loaded copy depends on the arguments, e.g. torch_dtype, so copies loaded with different arguments are kept apart
+    """
+    if not kwargs:
+        return pretrained_class.__name__
+    arguments = repr(sorted((key, repr(value)) for key, value in kwargs.items()))
+    return f"{pretrained_class.__name__}-{hashlib.sha1(arguments.encode()).hexdigest()[:12]}"
+
+
+def _is_complete(cache_path: str) -> bool:
+    return os.path.exists(os.path.join(cache_path, _COMPLETE_MARKER))
+
+
+def _save(pretrained, cache_path: str):
+    """
+    Saves to a temporary directory that is renamed to the cache path, readers never see a partial copy
+    """
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(cache_path), prefix='.tmp_')
+    try:
+        if _is_model(pretrained):
+            pretrained.save_pretrained(tmp_path, safe_serialization=True)
+        else:
+            pretrained.save_pretrained(tmp_path)
+        open(os.path.join(tmp_path, _COMPLETE_MARKER), 'w').close()
+        # a partial copy left by a crashed replica is replaced
+        shutil.rmtree(cache_path, ignore_errors=True)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        logger.warning(f"Failed to save {cache_path} to the model cache: {e!r}")
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _is_model(pretrained) -> bool:
+    return hasattr(pretrained, 'state_dict')
+
+
+@contextmanager
+def _file_lock(lock_path: str):
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, 'a') as lock_file:
+        locked = False
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            locked = True
+        except OSError as e:
+            # e.g. file systems without locks, concurrent replicas may download the model twice,
+            # the atomic rename still keeps the cache consistent
+            logger.warning(f"Model cache lock is not supported: {lock_path}, {e!r}")
+        try:
+            yield
+        finally:
+            if locked:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
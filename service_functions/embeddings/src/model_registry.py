@@ -0,0 +1,160 @@
+import gc
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, List
+
+import torch
+
+from spcs_utils import init_logger
+
+logger = init_logger("ModelRegistry")
+
+
+@dataclass
+class _LoadedModel:
+    model: Any
+    size_bytes: int
+
+
+class ModelRegistry:
+    """
+    Keeps loaded models in memory and evicts the least recently used ones when the memory budget is exceeded.
+
+    Models are loaded lazily on first use. Concurrent first requests of the same model wait for a single load.
+    """
+
+    def __init__(self, memory_budget_bytes: int = 0):
+        """
+        :param memory_budget_bytes: max memory of all loaded models, 0 means no limit
+        """
+        self._memory_budget_bytes = memory_budget_bytes
+        self._lock = threading.Lock()
+        self._models: "OrderedDict[Hashable, _LoadedModel]" = OrderedDict()
+        self._loading: Dict[Hashable, Future] = {}
+
+    def set_memory_budget(self, memory_budget_bytes: int):
+        with self._lock:
+            self._memory_budget_bytes = memory_budget_bytes
+            evicted = self._evict_over_budget(keep=None)
+        _release_memory(evicted)
+
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """
+        Returns the model registered under the key, loads it with the loader if it is not loaded yet
+        :param key: model key, e.g. (task, model name)
+        :param loader: function that loads the model
+        :return: the loaded model
+        """
+        with self._lock:
+            loaded_model = self._models.get(key)
+            if loaded_model is not None:
+                self._models.move_to_end(key)
+                return loaded_model.model
+            future = self._loading.get(key)
+            is_loader = future is None
+            if is_loader:
+                future = Future()
+                self._loading[key] = future
+        if not is_loader:
+            return future.result()
+
+        start_time = time.time()
+        try:
+            model = loader()
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            future.set_exception(e)
+            raise
+        size_bytes = _get_model_size(model)
+        with self._lock:
+            del self._loading[key]
+            self._models[key] = _LoadedModel(model, size_bytes)
+            evicted = self._evict_over_budget(keep=key)
+        future.set_result(model)
+        logger.info(f"Loaded model: {key}, size: {size_bytes / 2 ** 20:.0f} MiB, time: {time.time() - start_time}")
+        _release_memory(evicted)
+        return model
+
+    def get_models(self) -> List[Any]:
+        """
+        Loaded models, least recently used first
+        """
+        with self._lock:
+            return [loaded_model.model for loaded_model in self._models.values()]
+
+    def clear(self):
+        """
+        Evicts all loaded models
+        """
+        with self._lock:
+            evicted = list(self._models.keys())
+            self._models.clear()
+        _release_memory(evicted)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'memory_budget_bytes': self._memory_budget_bytes,
+                'memory_used_bytes': sum(m.size_bytes for m in self._models.values()),
+                'models': [{'key': str(key), 'size_bytes': m.size_bytes} for key, m in self._models.items()],
+                'loading': [str(key) for key in self._loading],
+            }
+
+    def _evict_over_budget(self, keep) -> List[Hashable]:
+        evicted = []
+        if not self._memory_budget_bytes:
+            return evicted
+        used_bytes = sum(m.size_bytes for m in self._models.values())
+        for key in list(self._models.keys()):
+            if used_bytes <= self._memory_budget_bytes:
+                break
+            if key == keep:
+                continue
+            used_bytes -= self._models.pop(key).size_bytes
+            evicted.append(key)
+        if used_bytes > self._memory_budget_bytes:
+            logger.warning(f"Loaded models use {used_bytes} bytes, over the budget of {self._memory_budget_bytes}")
+        return evicted
+
+
+def _get_model_size(model) -> int:
+    # hf pipelines keep the torch model in the model attribute
+    torch_model = getattr(model, 'model', model)
+    if not isinstance(torch_model, torch.nn.Module):
+        # e.g. onnx runtime sessions report the size of the model file
+        return getattr(torch_model, 'size_bytes', 0)
+    tensors = list(torch_model.parameters()) + list(torch_model.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors) + get_packed_params_size(torch_model)
+
+
+def get_packed_params_size(torch_model: torch.nn.Module) -> int:
+    """
+    Size of the weights of dynamically quantized (int8) linear layers, they are kept in packed params
+    and are neither in `parameters()` nor in `buffers()`
+    """
+    size_bytes = 0
+    for module in torch_model.modules():
+        # the packed params module holds the packed weights, the quantized linear layer holds the module
+        packed_params = getattr(module, '_packed_params', None)
+        if packed_params is None or isinstance(packed_params, torch.nn.Module) or not hasattr(module, '_weight_bias'):
+            continue
+        for tensor in module._weight_bias():
+            if tensor is not None:
+                size_bytes += tensor.numel() * tensor.element_size()
+    return size_bytes
+
+
+def _release_memory(evicted_keys: List[Hashable]):
+    if not evicted_keys:
+        return
+    logger.info(f"Evicted models: {evicted_keys}")
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+model_registry = ModelRegistry()
@@ -0,0 +1,37 @@
+import torch
+
+CLS = 'cls'
+MEAN = 'mean'
+MAX = 'max'
+
+POOLING_METHODS = [CLS, MEAN, MAX]
+
+
+def pool_embeddings(hidden_states: torch.Tensor, attention_mask: torch.Tensor, pooling: str = CLS,
+                    normalize: bool = False) -> torch.Tensor:
+    """
+    Reduces the token embeddings to a single embedding per text, on the device of the hidden states,
+    so only the [batch, hidden] result has to be copied to the host
+    :param hidden_states: [batch, sequence, hidden] last hidden state of the model
+    :param attention_mask: [batch, sequence] mask of the tokenizer, padding tokens are 0
+    :param pooling: one of POOLING_METHODS
+        * cls - embedding of the first token, the original output
+        * mean - mean of the embeddings of the tokens that are not padding
+        * max - element-wise max of the embeddings of the tokens that are not padding
+    :param normalize: scale the embeddings to unit L2 norm, dot product equals cosine similarity
+    :return: float32 [batch, hidden] tensor
+    """
+    hidden_states = hidden_states.float()
+    if pooling == CLS:
+        embeddings = hidden_states[:, 0]
+    elif pooling == MEAN:
+        mask = attention_mask.to(hidden_states.device).unsqueeze(-1).to(hidden_states.dtype)
+        embeddings = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+    elif pooling == MAX:
+        mask = attention_mask.to(hidden_states.device).unsqueeze(-1).bool()
+        embeddings = hidden_states.masked_fill(~mask, torch.finfo(hidden_states.dtype).min).max(dim=1).values
+    else:
+        raise ValueError(f"Unknown pooling method: {pooling}, supported methods: {POOLING_METHODS}")
+    if normalize:
+        embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=-1)
+    return embeddings
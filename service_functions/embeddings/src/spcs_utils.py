@@ -1,13 +1,27 @@
+import collections
 import logging
 import os
 import os.path
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
+from typing import Callable, Dict, Iterable, Iterator, NamedTuple, Optional, Sequence, Tuple, TypeVar
 
 import snowflake.connector
 import toml
 from snowflake.snowpark import Session
 
+DEFAULT_MODEL = 'default'
+# stages of the model inference, see `iter_timed` and `timed`
+TOKENIZE = 'tokenize'
+FORWARD = 'forward'
+
+_CONFIG_PATH_ENV = 'CONFIG_PATH'
+
+T = TypeVar('T')
+R = TypeVar('R')
+
 
 @dataclass
 class ModelConfiguration:
@@ -17,6 +31,11 @@ class ModelConfiguration:
     classifier_model_name: str
     embedding_model_name: str
     embedding_tokenizer_name: str
+    embedding_output_format: str = 'text'
+    inference_backend: str = 'auto'
+    embedding_pooling: str = 'cls'
+    embedding_normalize: bool = False
+    classifier_output_format: str = 'text'
 
 
 @dataclass
@@ -37,6 +56,153 @@ class OutputRow:
     output: str
 
 
+class Batch(NamedTuple):
+    """
+    Slice of the input items
+    """
+    offset: int
+    items: Sequence
+
+
+def iter_batches(items: Sequence, batch_size: int) -> Iterator[Batch]:
+    """
+    Yields consecutive batches of at most `batch_size` items, the last batch is never empty
+    :param items: sequence that supports slicing, e.g. list, numpy array or pyarrow array
+    :param batch_size: max number of items in a batch
+    """
+    for offset in range(0, len(items), batch_size):
+        yield Batch(offset, items[offset:offset + batch_size])
+
+
+class BatchExecutor:
+    """
+    Thread pool of `map_batches_ahead` held by the caller and reused by all of its calls, e.g. one per micro-batch
+    of the service, so the threads are not started and joined on every call. A forked process creates a pool of its
+    own, the threads of the parent don't exist in the child.
+    """
+
+    def __init__(self, max_workers: int = 1, thread_name_prefix: str = 'batch'):
+        self._max_workers = max_workers
+        self._thread_name_prefix = thread_name_prefix
+        self._executor = None
+        self._pid = None
+
+    def get(self) -> ThreadPoolExecutor:
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers,
+                                                thread_name_prefix=self._thread_name_prefix)
+            self._pid = os.getpid()
+        return self._executor
+
+
+def map_batches_ahead(batches: Iterable[T], batch_function: Callable[[T], R],
+                      prefetch: int = 1, max_workers: int = 1,
+                      executor: Optional[BatchExecutor] = None) -> Iterator[Tuple[T, R]]:
+    """
+    Runs the function on the batches in a background thread, up to `prefetch` batches ahead of the caller,
+    so the caller assembles the results of one batch while the model runs on the next one.
+    :param batches: input batches, consumed lazily
+    :param batch_function: function to run on every batch, e.g. model inference
+    :param prefetch: number of batches submitted ahead of the one the caller is working on
+    :param max_workers: number of threads running the function, more than one only for thread safe functions
+    :param executor: thread pool of the caller, reused instead of a pool of `max_workers` threads per call
+    :return: iterator of (batch, result) in the order of the batches
+    """
+    if executor is not None:
+        yield from _map_batches_ahead(batches, batch_function, prefetch, executor.get())
+        return
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='batch') as thread_pool:
+        yield from _map_batches_ahead(batches, batch_function, prefetch, thread_pool)
+
+
+def _map_batches_ahead(batches: Iterable[T], batch_function: Callable[[T], R], prefetch: int,
+                       thread_pool: ThreadPoolExecutor) -> Iterator[Tuple[T, R]]:
+    in_flight = collections.deque()
+    try:
+        for batch in batches:
+            in_flight.append((batch, thread_pool.submit(batch_function, batch)))
+            if len(in_flight) > prefetch:
+                batch, future = in_flight.popleft()
+                yield batch, future.result()
+        while in_flight:
+            batch, future = in_flight.popleft()
+            yield batch, future.result()
+    finally:
+        # the caller stopped early or a batch failed, the batches that didn't start are not needed
+        for _, future in in_flight:
+            future.cancel()
+
+
+def iter_timed(items: Iterable[T], timings: Optional[Dict[str, float]], key: str) -> Iterator[T]:
+    """
+    Yields the items, the time spent producing them is added to `timings[key]`
+    :param items: e.g. a generator that tokenizes the inputs
+    :param timings: stage times in seconds, None disables the timing
+    :param key: stage name
+    """
+    if timings is None:
+        yield from items
+        return
+    iterator = iter(items)
+    while True:
+        start_time = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            timings[key] = timings.get(key, 0.0) + time.perf_counter() - start_time
+        yield item
+
+
+def timed(function: Callable[..., R], timings: Optional[Dict[str, float]], key: str) -> Callable[..., R]:
+    """
+    Wraps the function, the time spent in its calls is added to `timings[key]`
+    """
+    if timings is None:
+        return function
+
+    def timed_function(*args, **kwargs) -> R:
+        start_time = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings[key] = timings.get(key, 0.0) + time.perf_counter() - start_time
+
+    return timed_function
+
+
+def create_model_configuration(config) -> ModelConfiguration:
+    """
+    Creates the model configuration from the [general] section of config.toml,
+    the inference backend comes from the section of the compute pool
+    """
+    general_config = config['general']
+    compute_pool_config = config.get('compute_pool', {}).get(get_compute_pool_type(), {})
+    return ModelConfiguration(classifier_model_name=general_config['classifier_model_name'],
+                              embedding_model_name=general_config['embedding_model_name'],
+                              embedding_tokenizer_name=general_config['embedding_tokenizer_name'],
+                              embedding_output_format=general_config.get('embedding_output_format', 'text'),
+                              embedding_pooling=general_config.get('embedding_pooling', 'cls'),
+                              embedding_normalize=general_config.get('embedding_normalize', False),
+                              classifier_output_format=general_config.get('classifier_output_format', 'text'),
+                              inference_backend=compute_pool_config.get('backend', 'auto'))
+
+
+def create_model_configurations(config) -> Dict[str, ModelConfiguration]:
+    """
+    Creates the configurations of all served models. The [general] section defines the default model,
+    every [models.<name>] section defines an additional model, missing fields default to the [general] section.
+    """
+    default_configuration = create_model_configuration(config)
+    model_configurations = {DEFAULT_MODEL: default_configuration}
+    for model_name, model_config in config.get('models', {}).items():
+        params = {field.name: model_config.get(field.name, getattr(default_configuration, field.name))
+                  for field in fields(ModelConfiguration)}
+        model_configurations[model_name] = ModelConfiguration(**params)
+    return model_configurations
+
+
 def init_logger(log_name: str):
     logger = logging.getLogger(log_name)
     log_level = os.environ.get('LOG_LEVEL', 'INFO')
@@ -117,6 +283,11 @@ def _get_test_connection(config):
 
 
 def load_toml_config():
+    """
+    Loads config.toml of the project, CONFIG_PATH overrides its path, e.g. for local benchmarks
+    """
+    if _CONFIG_PATH_ENV in os.environ:
+        return toml.load(os.environ[_CONFIG_PATH_ENV])
     path = Path(__file__)
     return toml.load(path.parent.parent.joinpath("config.toml"))
 
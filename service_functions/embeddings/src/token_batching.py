@@ -0,0 +1,84 @@
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+import torch
+
+
+@dataclass
+class TokenBatch:
+    """
+    Padded model inputs of a subset of the input texts
+    """
+    indices: np.ndarray  # positions of the batch rows in the input texts
+    inputs: Dict[str, torch.Tensor]
+
+
+def get_max_length(tokenizer, model) -> int:
+    """
+    Max number of tokens of a single text, texts are truncated to it
+    """
+    max_length = tokenizer.model_max_length
+    max_position_embeddings = getattr(model.config, 'max_position_embeddings', None)
+    if max_position_embeddings:
+        max_length = min(max_length, max_position_embeddings)
+    return max_length
+
+
+def plan_token_batches(lengths: Sequence[int], max_rows: int, max_tokens: Optional[int] = None) -> List[np.ndarray]:
+    """
+    Groups rows of similar token length together, so short rows are not padded to the length of the long ones.
+
+    Rows are sorted by length and a batch is closed when it has `max_rows` rows, or when its padded size,
+    rows * longest row, would go over `max_tokens`. A row longer than `max_tokens` gets a batch of its own.
+    :param lengths: number of tokens of every row
+    :param max_rows: max number of rows in a batch
+    :param max_tokens: max number of tokens in a padded batch, None means no limit
+    :return: list of batches, each batch holds the positions of its rows
+    """
+    order = np.argsort(np.asarray(lengths, dtype=np.int64), kind='stable')
+    batches = []
+    start = 0
+    for end in range(1, len(order) + 1):
+        is_last = end == len(order)
+        rows = end - start
+        if not is_last:
+            next_padded_tokens = (rows + 1) * lengths[order[end]]
+            if rows < max_rows and (max_tokens is None or next_padded_tokens <= max_tokens):
+                continue
+        batches.append(order[start:end])
+        start = end
+    return batches
+
+
+def iter_token_batches(tokenizer, texts: List[str], max_rows: int, max_tokens: Optional[int],
+                       max_length: int) -> Iterator[TokenBatch]:
+    """
+    Tokenizes all texts once and yields length bucketed padded batches
+    :param tokenizer: hf tokenizer
+    :param texts: input texts
+    :param max_rows: max number of rows in a batch
+    :param max_tokens: max number of tokens in a padded batch, None means no limit
+    :param max_length: texts are truncated to this number of tokens
+    :return: iterator of batches, the caller restores the input order with `TokenBatch.indices`
+    """
+    encodings = tokenizer(texts, truncation=True, max_length=max_length)
+    lengths = [len(input_ids) for input_ids in encodings['input_ids']]
+    for indices in plan_token_batches(lengths, max_rows, max_tokens):
+        yield TokenBatch(indices=indices, inputs=_pad(tokenizer, encodings, indices, lengths))
+
+
+def _pad(tokenizer, encodings, indices: np.ndarray, lengths: Sequence[int]) -> Dict[str, torch.Tensor]:
+    batch_length = max(lengths[i] for i in indices)
+    padded = {}
+    for key in encodings.keys():
+        pad_value = tokenizer.pad_token_id if key == 'input_ids' else 0
+        values = np.full((len(indices), batch_length), pad_value, dtype=np.int64)
+        for row, i in enumerate(indices):
+            row_values = encodings[key][i]
+            if tokenizer.padding_side == 'left':
+                values[row, batch_length - len(row_values):] = row_values
+            else:
+                values[row, :len(row_values)] = row_values
+        padded[key] = torch.from_numpy(values)
+    return padded
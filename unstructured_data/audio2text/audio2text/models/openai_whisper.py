@@ -1,6 +1,7 @@
 from typing import List
 
 import torch
+from audio2text.model_cache import from_pretrained
 from audio2text.utils import InputRow, OutputRow
 from transformers import AutoModelForSpeechSeq2Seq, pipeline
 from transformers import AutoProcessor
@@ -18,11 +19,11 @@ class Model:
         is_cuda_available = torch.cuda.is_available()
         torch_dtype = torch.float16 if is_cuda_available else torch.float32
 
-        model = AutoModelForSpeechSeq2Seq.from_pretrained(
-            model_name, torch_dtype=torch_dtype, low_cpu_mem_usage=True, use_safetensors=True
+        model = from_pretrained(
+            AutoModelForSpeechSeq2Seq, model_name, torch_dtype=torch_dtype, low_cpu_mem_usage=True, use_safetensors=True
         )
         model.to(device)
-        processor = AutoProcessor.from_pretrained(model_name)
+        processor = from_pretrained(AutoProcessor, model_name)
         self.pipe = pipeline(
             "automatic-speech-recognition",
             model=model,